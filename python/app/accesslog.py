@@ -0,0 +1,258 @@
+"""
+Structured (JSON lines) access log with request IDs.
+
+`AccessLogMiddleware` gives every request an ID, taken from a well-formed
+`X-Request-ID` header or generated, echoes it in the response and keeps it in a
+context variable so the upstream calls can forward it (`request_id()`). Code on the
+request path adds fields to the request's record with `annotate()` / `add()`, and
+prompt and response sizes with `add_sizes()`; sizes are only kept when the log is
+configured to include them. Nothing from prompts or answers is ever logged.
+
+Handlers never wait for I/O: when the response is done the middleware appends the
+record (a small dict) to an in-memory queue, and a writer thread encodes and writes
+queued records in batches. The queue is bounded; records that don't fit are dropped
+and counted. Successful requests can be sampled, while errors (status >= 400) and
+requests slower than `slow_seconds` are always logged.
+
+Each batch goes out in one `write()`, so several workers can append to the same
+file without interleaving lines.
+"""
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Awaitable, BinaryIO, Callable, Deque, Dict, Optional
+
+from .fastjson import dumps
+
+Scope = Dict[str, Any]
+Message = Dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+# Client-supplied IDs are reused (and sent upstream) only if they look like an ID
+_VALID_ID = re.compile(rb"[A-Za-z0-9._:@/+=-]{1,128}")
+
+
+class AccessRecord:
+    __slots__ = ("request_id", "fields", "sizes")
+
+    def __init__(self, request_id: str, sizes: bool) -> None:
+        self.request_id = request_id
+        self.fields: Dict[str, Any] = {}
+        self.sizes = sizes
+
+
+_current: ContextVar[Optional[AccessRecord]] = ContextVar("asksage_access_record", default=None)
+
+
+def request_id() -> Optional[str]:
+    record = _current.get()
+    return record.request_id if record is not None else None
+
+
+def annotate(**fields: Any) -> None:
+    """Set fields of the current request's log record (no-op outside a request)."""
+    record = _current.get()
+    if record is not None:
+        record.fields.update(fields)
+
+
+def add(**counts: float) -> None:
+    """Add to numeric fields of the current request's log record."""
+    record = _current.get()
+    if record is not None:
+        for name, value in counts.items():
+            record.fields[name] = record.fields.get(name, 0) + value
+
+
+def add_sizes(**counts: float) -> None:
+    """Like `add()`, for prompt and response sizes: kept only when the log includes sizes."""
+    record = _current.get()
+    if record is not None and record.sizes:
+        for name, value in counts.items():
+            record.fields[name] = record.fields.get(name, 0) + value
+
+
+def open_sink(target: str) -> BinaryIO:
+    """`stdout`, `stderr` or a file path (appended to)."""
+    if target == "stdout":
+        return sys.stdout.buffer
+    if target == "stderr":
+        return sys.stderr.buffer
+    # Unbuffered, so each batch is a single write() on an O_APPEND file
+    return open(target, "ab", buffering=0)
+
+
+def _timestamp(seconds: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + f".{int(seconds % 1 * 1000):03d}Z"
+
+
+class AccessLog:
+    def __init__(
+        self,
+        sink: BinaryIO,
+        sample_rate: float = 1.0,
+        slow_seconds: float = 1.0,
+        sizes: bool = False,
+        max_queue: int = 10000,
+        rand: Callable[[], float] = random.random,
+    ) -> None:
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.sizes = sizes
+        self.max_queue = max_queue
+        self._rand = rand
+        # Appended by the event loop, drained by the writer thread (deque ops are thread-safe)
+        self._queue: Deque[Dict[str, Any]] = deque()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.write_errors = 0
+
+    def wants(self, status: int, seconds: float) -> bool:
+        if status >= 400 or seconds >= self.slow_seconds or self.sample_rate >= 1.0:
+            return True
+        if self.sample_rate > 0.0 and self._rand() < self.sample_rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+    def submit(self, entry: Dict[str, Any]) -> bool:
+        """Queue a record for writing; False (and counted) when the queue is full."""
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return False
+        self._queue.append(entry)
+        self.queued += 1
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="asksage-access-log", daemon=True)
+            self._thread.start()
+        if not self._wake.is_set():
+            self._wake.set()
+        return True
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Write what's queued and stop the writer."""
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self._stopping = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "slow_ms": self.slow_seconds * 1000,
+            "sizes": self.sizes,
+            "queue_depth": len(self._queue),
+            "max_queue": self.max_queue,
+            "queued": self.queued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "write_errors": self.write_errors,
+        }
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self._drain()
+            if self._stopping:
+                return
+
+    def _drain(self) -> None:
+        while self._queue:
+            lines = []
+            while self._queue and len(lines) < 1000:
+                entry = self._queue.popleft()
+                entry["ts"] = _timestamp(entry["ts"])
+                lines.append(dumps(entry))
+            try:
+                self.sink.write(b"\n".join(lines) + b"\n")
+                self.sink.flush()
+                self.written += len(lines)
+            except (OSError, ValueError):
+                self.write_errors += 1
+                self.dropped += len(lines)
+
+
+def _incoming_id(headers: Any) -> Optional[str]:
+    for name, value in headers:
+        if name == b"x-request-id":
+            return value.decode("latin-1") if _VALID_ID.fullmatch(value) else None
+    return None
+
+
+class AccessLogMiddleware:
+    def __init__(self, app: ASGIApp, log: Callable[[], Optional[AccessLog]]) -> None:
+        self.app = app
+        # Resolved per request so logging can be configured at runtime (and in tests);
+        # request IDs are handled even with no log
+        self.log = log
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        log = self.log()
+        rid = _incoming_id(scope.get("headers") or ()) or uuid.uuid4().hex
+        record = AccessRecord(rid, log is not None and log.sizes)
+        wall = time.time()
+        started = time.perf_counter()
+        status = 500
+        received = 0
+        sent = 0
+
+        async def counting_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            return message
+
+        async def send_with_id(message: Message) -> None:
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers") or []) + [(b"x-request-id", rid.encode("latin-1"))]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        token = _current.set(record)
+        try:
+            await self.app(scope, counting_receive if log is not None else receive, send_with_id)
+        finally:
+            _current.reset(token)
+            if log is not None:
+                seconds = time.perf_counter() - started
+                if log.wants(status, seconds):
+                    route = scope.get("route")
+                    client = scope.get("client")
+                    entry = {
+                        "ts": wall,
+                        "request_id": rid,
+                        "method": scope["method"],
+                        "path": scope["path"],
+                        "route": getattr(route, "path", None),
+                        "status": status,
+                        "duration_ms": round(seconds * 1000, 3),
+                        "request_bytes": received,
+                        "response_bytes": sent,
+                        "peer": client[0] if client else None,
+                    }
+                    entry.update(record.fields)
+                    log.submit(entry)
@@ -0,0 +1,296 @@
+"""
+Content-addressed on-disk cache of synthesized speech.
+
+Entries are files named after a hash of the Ask Sage TTS payload (plus the media
+type), bounded by total size with LRU eviction. Entries are written to a temporary
+file in the cache directory and renamed into place once complete, so concurrent
+writers of the same entry and crashes never leave a partial file under an entry's
+name.
+
+The index (entries, their last use and the size total) is a SQLite file in the
+directory, so the worker processes sharing the directory share one size bound and
+one LRU order, and evict each other's entries under the same lock that adds them.
+It survives restarts; a directory without one (or with audio files it doesn't list)
+is indexed from its files the first time it is opened.
+
+Hits are served straight from the file (`AudioFileResponse`), which supports
+Range requests and hands the path to the server when it implements the ASGI
+`http.response.pathsend` extension (zero-copy sendfile).
+"""
+import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.types import Receive, Scope, Send
+
+_TEMP_PREFIX = ".tmp-"
+_INDEX = ".index.sqlite"
+# Temporary files older than this are left over from a crash (not another worker's write)
+_STALE_TEMP_SECONDS = 3600.0
+
+
+class AudioEntry(NamedTuple):
+    path: str
+    size: int
+    media_type: str
+
+
+def _file_name(key: str, media_type: str) -> str:
+    # "audio/x-wav" -> "<key>.audio-x-wav"
+    return f"{key}.{media_type.replace('/', '-', 1)}"
+
+
+def _parse_file_name(name: str) -> Optional[Tuple[str, str]]:
+    """Inverse of `_file_name`: (key, media type), or None for unrelated files."""
+    if name.startswith("."):
+        # Temporary files and the index
+        return None
+    key, _, suffix = name.partition(".")
+    if not suffix or "-" not in suffix:
+        return None
+    return key, suffix.replace("-", "/", 1)
+
+
+class AudioCache:
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        # Totals over all processes, as of this process's last transaction
+        self._entries = 0
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.aborted_writes = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _db(self) -> sqlite3.Connection:
+        # Opened on first use, in the worker process (never inherited across a fork)
+        if self._conn is None:
+            conn = sqlite3.connect(
+                os.path.join(self.directory, _INDEX), check_same_thread=False, isolation_level=None, timeout=5.0
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY, media_type TEXT NOT NULL, size INTEGER NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._scan(conn)
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (name, value)"
+                    " VALUES ('bytes', (SELECT COALESCE(SUM(size), 0) FROM entries))"
+                )
+                self._evict(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                conn.close()
+                raise
+            self._conn = conn
+        return self._conn
+
+    def _scan(self, db: sqlite3.Connection) -> None:
+        """Index audio files the index doesn't list, drop rows whose file is gone."""
+        listed = {key: media_type for key, media_type in db.execute("SELECT key, media_type FROM entries")}
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            if entry.name.startswith(_TEMP_PREFIX):
+                if st.st_mtime < now - _STALE_TEMP_SECONDS:
+                    _unlink(entry.path)
+                continue
+            parsed = _parse_file_name(entry.name)
+            if parsed is None:
+                continue
+            key, media_type = parsed
+            if listed.pop(key, None) != media_type:
+                db.execute(
+                    "INSERT OR REPLACE INTO entries (key, media_type, size, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, media_type, st.st_size, st.st_mtime),
+                )
+        for key in listed:
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def _totals(self, db: sqlite3.Connection) -> int:
+        self._bytes = db.execute("SELECT value FROM meta WHERE name = 'bytes'").fetchone()[0]
+        self._entries = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return self._bytes
+
+    def _lookup(self, key: str) -> Optional[AudioEntry]:
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT media_type, size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            entry = AudioEntry(os.path.join(self.directory, _file_name(key, row[0])), row[1], row[0])
+            if not os.path.exists(entry.path):
+                # Removed behind the index's back
+                db.execute("BEGIN IMMEDIATE")
+                if db.execute("DELETE FROM entries WHERE key = ? AND media_type = ?", (key, row[0])).rowcount:
+                    db.execute("UPDATE meta SET value = value - ? WHERE name = 'bytes'", (row[1],))
+                self._totals(db)
+                db.execute("COMMIT")
+                return None
+            db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            return entry
+
+    async def get(self, key: str) -> Optional[AudioEntry]:
+        entry = await asyncio.to_thread(self._lookup, key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def writer(self, key: str, media_type: str) -> "AudioWriter":
+        return AudioWriter(self, key, media_type.split(";", 1)[0].strip() or "audio/mpeg")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "directory": self.directory,
+            "entries": self._entries,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "aborted_writes": self.aborted_writes,
+            "evictions": self.evictions,
+        }
+
+    def _add(self, key: str, entry: AudioEntry, temp_path: str) -> None:
+        # Runs in a thread; the file is renamed into place under the index's lock, so no
+        # other process evicts or re-adds the entry in between
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                os.replace(temp_path, entry.path)
+                old = db.execute("SELECT media_type, size FROM entries WHERE key = ?", (key,)).fetchone()
+                if old is not None and old[0] != entry.media_type:
+                    _unlink(os.path.join(self.directory, _file_name(key, old[0])))
+                db.execute(
+                    "INSERT OR REPLACE INTO entries (key, media_type, size, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, entry.media_type, entry.size, time.time()),
+                )
+                db.execute(
+                    "UPDATE meta SET value = value + ? WHERE name = 'bytes'",
+                    (entry.size - (old[1] if old is not None else 0),),
+                )
+                self._evict(db)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            self.writes += 1
+
+    def _evict(self, db: sqlite3.Connection) -> None:
+        # Inside the caller's transaction, so no other process adds or evicts meanwhile
+        total = self._totals(db)
+        while self.max_bytes and total > self.max_bytes:
+            row = db.execute("SELECT key, media_type, size FROM entries ORDER BY accessed_at LIMIT 1").fetchone()
+            if row is None:
+                break
+            key, media_type, size = row
+            _unlink(os.path.join(self.directory, _file_name(key, media_type)))
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            db.execute("UPDATE meta SET value = value - ? WHERE name = 'bytes'", (size,))
+            total = self._totals(db)
+            self.evictions += 1
+
+
+def _unlink(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class AudioWriter:
+    """Writes one entry to a temporary file; `commit()` renames it into place."""
+
+    def __init__(self, cache: AudioCache, key: str, media_type: str) -> None:
+        self._cache = cache
+        self.key = key
+        self.media_type = media_type
+        self.size = 0
+        fd, self._temp_path = tempfile.mkstemp(prefix=_TEMP_PREFIX, dir=cache.directory)
+        self._file = os.fdopen(fd, "wb")
+
+    async def write(self, chunk: bytes) -> None:
+        await asyncio.to_thread(self._file.write, chunk)
+        self.size += len(chunk)
+
+    async def commit(self) -> None:
+        path = os.path.join(self._cache.directory, _file_name(self.key, self.media_type))
+
+        def finish() -> None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._cache._add(self.key, AudioEntry(path, self.size, self.media_type), self._temp_path)
+
+        await asyncio.to_thread(finish)
+
+    async def abort(self) -> None:
+        def discard() -> None:
+            self._file.close()
+            _unlink(self._temp_path)
+
+        await asyncio.to_thread(discard)
+        self._cache.aborted_writes += 1
+
+
+class AudioFileResponse(FileResponse):
+    """
+    FileResponse for cache entries: the ETag is the entry's content address (so
+    `If-Range` is checked against it), and full-body responses use the server's
+    `http.response.pathsend` extension when it offers one.
+    """
+
+    def __init__(self, entry: AudioEntry, etag: str, headers: Optional[Dict[str, str]] = None) -> None:
+        super().__init__(entry.path, headers={**(headers or {}), "etag": etag}, media_type=entry.media_type)
+        self.etag = etag
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        request_headers = Headers(scope=scope)
+        if_range = request_headers.get("if-range")
+        if if_range is not None and if_range == self.etag:
+            # Content-addressed: a matching If-Range always refers to this file
+            scope = dict(scope, headers=[(k, v) for k, v in scope["headers"] if k != b"if-range"])
+        elif if_range is not None:
+            scope = dict(scope, headers=[(k, v) for k, v in scope["headers"] if k != b"range"])
+
+        pathsend = "http.response.pathsend" in scope.get("extensions", {})
+        if pathsend and "range" not in request_headers and scope["method"] != "HEAD":
+            stat_result = await asyncio.to_thread(os.stat, self.path)
+            self.set_stat_headers(stat_result)
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+            if self.background is not None:
+                await self.background()
+            return
+        await super().__call__(scope, receive, send)
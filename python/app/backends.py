@@ -0,0 +1,170 @@
+"""
+Load balancing across Ask Sage backends.
+
+A backend is a (base URL, API key) pair, so several keys against one server raise
+the rate limit ceiling and several servers survive one of them going away. The
+pool picks a backend per call (least outstanding requests, or smooth weighted
+round-robin), tracks 429/5xx/transport failures and latency per backend, and
+ejects a backend after consecutive failures for a backoff that doubles on each
+ejection in a row.
+"""
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+LEAST_OUTSTANDING = "least_outstanding"
+ROUND_ROBIN = "round_robin"
+
+
+def parse_backends(spec: str, default_key: str) -> List["Backend"]:
+    """
+    Parse `base_url|api_key|weight` entries separated by commas or whitespace.
+    The key and weight are optional (defaulting to `default_key` and 1).
+    """
+    backends = []
+    for item in spec.replace(",", " ").split():
+        base_url, _, rest = item.partition("|")
+        api_key, _, weight = rest.partition("|")
+        backends.append(Backend(base_url, api_key or default_key, int(weight or 1)))
+    return backends
+
+
+class Backend:
+    def __init__(self, base_url: str, api_key: str, weight: int = 1) -> None:
+        self.base_url = base_url.rstrip("/") + "/"
+        self.api_key = api_key
+        self.weight = max(1, weight)
+
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.transport_errors = 0
+        self.latency_ewma = 0.0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        # Ejections in a row without a success in between; doubles the backoff
+        self._ejection_level = 0
+        # Smooth weighted round-robin state
+        self._current_weight = 0
+
+    @property
+    def name(self) -> str:
+        # Identifies the key without exposing it
+        return f"{self.base_url}#{self.api_key[-4:]}" if self.api_key else self.base_url
+
+    def available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def stats(self, now: float) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "throttled": self.throttled,
+            "server_errors": self.server_errors,
+            "transport_errors": self.transport_errors,
+            "latency_ewma": round(self.latency_ewma, 6),
+            "ejected": not self.available(now),
+            "ejected_for": round(max(0.0, self.ejected_until - now), 3),
+            "ejections": self.ejections,
+        }
+
+
+class BackendPool:
+    def __init__(
+        self,
+        backends: Sequence[Backend],
+        strategy: str = LEAST_OUTSTANDING,
+        eject_after: int = 3,
+        eject_seconds: float = 10.0,
+        max_eject_seconds: float = 300.0,
+    ) -> None:
+        if not backends:
+            raise ValueError("at least one backend is required")
+        if strategy not in (LEAST_OUTSTANDING, ROUND_ROBIN):
+            raise ValueError(f"unknown balancing strategy: {strategy}")
+        self.backends = list(backends)
+        self.strategy = strategy
+        # 0 disables ejection
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self._next = 0
+
+    def select(self, exclude: Sequence[Backend] = ()) -> Optional[Backend]:
+        """
+        Pick a backend for the next call, skipping `exclude` (already tried). Ejected
+        backends are only used when every candidate is ejected, starting with the one
+        whose ejection ends first. Returns None when every backend has been tried.
+        """
+        candidates = [b for b in self.backends if b not in exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        healthy = [b for b in candidates if b.available(now)]
+        if not healthy:
+            return min(candidates, key=lambda b: b.ejected_until)
+
+        if self.strategy == ROUND_ROBIN:
+            total = sum(b.weight for b in healthy)
+            for b in healthy:
+                b._current_weight += b.weight
+            chosen = max(healthy, key=lambda b: b._current_weight)
+            chosen._current_weight -= total
+            return chosen
+
+        # Least outstanding relative to weight; rotate the starting point so ties spread out
+        self._next = (self._next + 1) % len(healthy)
+        rotated = healthy[self._next:] + healthy[: self._next]
+        return min(rotated, key=lambda b: b.outstanding / b.weight)
+
+    def has_alternative(self, exclude: Sequence[Backend]) -> bool:
+        return any(b not in exclude for b in self.backends)
+
+    def start(self, backend: Backend) -> None:
+        backend.outstanding += 1
+        backend.requests += 1
+
+    def release(self, backend: Backend) -> None:
+        """Record a call that ended without an outcome (e.g. cancelled by the client)."""
+        backend.outstanding -= 1
+
+    def finish(self, backend: Backend, status: Optional[int], latency: float) -> None:
+        """
+        Record a finished call. `status` is the HTTP status, or None for a transport
+        error; 429, 5xx and transport errors count as failures.
+        """
+        backend.outstanding -= 1
+        backend.latency_ewma += 0.2 * (latency - backend.latency_ewma)
+        if status is None:
+            backend.transport_errors += 1
+        elif status == 429:
+            backend.throttled += 1
+        elif status >= 500:
+            backend.server_errors += 1
+        else:
+            backend.consecutive_failures = 0
+            backend._ejection_level = 0
+            return
+
+        backend.failures += 1
+        backend.consecutive_failures += 1
+        if self.eject_after and backend.consecutive_failures >= self.eject_after:
+            backoff = min(self.max_eject_seconds, self.eject_seconds * 2 ** backend._ejection_level)
+            backend.ejected_until = time.monotonic() + backoff
+            backend.consecutive_failures = 0
+            backend._ejection_level += 1
+            backend.ejections += 1
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "strategy": self.strategy,
+            "eject_after": self.eject_after,
+            "eject_seconds": self.eject_seconds,
+            "backends": [b.stats(now) for b in self.backends],
+        }
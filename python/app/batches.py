@@ -0,0 +1,694 @@
+"""
+OpenAI-style Batch API: uploaded files and a checkpointed background executor.
+
+Everything lives under one directory:
+
+    files/<file id>           file contents (JSONL)
+    files/<file id>.json      file metadata
+    batches/<batch id>.json   batch object plus its checkpoint
+
+A batch's input is read one line at a time and each request runs as a task once
+one of the runner's worker slots (shared by all batches) is free, so memory stays
+flat whatever the input size. Results are appended to the output or error file as
+they complete. Every `checkpoint_seconds` the checkpoint records the sizes of those
+files and which input lines they cover. After a restart both files are truncated
+back to the checkpoint and the batch resumes from there: requests finished after
+the last checkpoint run again, but no result appears twice.
+
+When several worker processes share the directory, the one holding an exclusive
+lock on `batches/.owner` runs the batches; the others serve reads from the saved
+state and leave new batches and cancellations (`<batch id>.cancel` markers) for
+the owner to pick up. If the owner exits, another worker takes the lock over and
+resumes its batches.
+"""
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, List, Optional, Sequence, Set
+
+from .fastjson import dumps, loads
+from .resilience import backoff_delay
+
+if sys.platform != "win32":
+    import fcntl
+else:
+    fcntl = None
+
+logger = logging.getLogger("asksage-openai-proxy")
+
+_TEMP_PREFIX = ".tmp-"
+# Temporary files untouched for this long are left over from a crash, not being written
+_TEMP_MAX_AGE = 600
+
+# Batch statuses, as in the OpenAI API
+VALIDATING = "validating"
+IN_PROGRESS = "in_progress"
+FINALIZING = "finalizing"
+COMPLETED = "completed"
+FAILED = "failed"
+EXPIRED = "expired"
+CANCELLING = "cancelling"
+CANCELLED = "cancelled"
+_ACTIVE = (VALIDATING, IN_PROGRESS, FINALIZING, CANCELLING)
+
+COMPLETION_WINDOWS = {"24h": 24 * 3600}
+
+# Upstream statuses that pause the workers and retry the request instead of failing it
+THROTTLED_STATUS = (429, 503)
+
+
+class BatchRequestError(Exception):
+    """A request of a batch failed with an HTTP `status` (recorded in the error file)."""
+
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None) -> None:
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+def parse_request_line(line: bytes, endpoints: Sequence[str]) -> Dict[str, Any]:
+    """Decode one input line; raises ValueError describing what is wrong with it."""
+    try:
+        request = loads(line)
+    except ValueError:
+        raise ValueError("not valid JSON")
+    if not isinstance(request, dict):
+        raise ValueError("not a JSON object")
+    if not isinstance(request.get("custom_id"), str) or not request["custom_id"]:
+        raise ValueError("missing custom_id")
+    if str(request.get("method", "POST")).upper() != "POST":
+        raise ValueError("method must be POST")
+    if request.get("url") not in endpoints:
+        raise ValueError(f"url must be one of: {', '.join(endpoints)}")
+    if not isinstance(request.get("body"), dict):
+        raise ValueError("body must be a JSON object")
+    return request
+
+
+def _write_json(path: str, obj: Any) -> None:
+    """Replace `path` atomically (and durably) with `obj` as JSON."""
+    fd, temp_path = tempfile.mkstemp(prefix=_TEMP_PREFIX, dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(dumps(obj))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def _read_json(path: str) -> Optional[Any]:
+    try:
+        with open(path, "rb") as f:
+            return loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def _remove_temp_files(directory: str) -> None:
+    cutoff = time.time() - _TEMP_MAX_AGE
+    for entry in os.scandir(directory):
+        if entry.name.startswith(_TEMP_PREFIX) and entry.stat().st_mtime < cutoff:
+            # Left over from a crash mid-write (recent ones may belong to another worker)
+            _unlink(entry.path)
+
+
+class FileStore:
+    def __init__(self, directory: str) -> None:
+        self.directory = os.path.join(directory, "files")
+        os.makedirs(self.directory, exist_ok=True)
+        _remove_temp_files(self.directory)
+
+    def path(self, file_id: str) -> str:
+        return os.path.join(self.directory, os.path.basename(file_id))
+
+    def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        meta = _read_json(self.path(file_id) + ".json")
+        return meta["file"] if meta is not None else None
+
+    def requests(self, file_id: str) -> int:
+        """Number of request lines counted when the file was uploaded."""
+        meta = _read_json(self.path(file_id) + ".json")
+        return meta.get("requests", 0) if meta is not None else 0
+
+    def list(self, purpose: Optional[str] = None) -> List[Dict[str, Any]]:
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json") and not name.startswith(_TEMP_PREFIX):
+                meta = _read_json(os.path.join(self.directory, name))
+                if meta is not None and (purpose is None or meta["file"]["purpose"] == purpose):
+                    files.append(meta["file"])
+        return sorted(files, key=lambda f: f["created_at"], reverse=True)
+
+    async def create(
+        self,
+        source: BinaryIO,
+        filename: str,
+        purpose: str,
+        endpoints: Sequence[str],
+        chunk_size: int = 256 * 1024,
+    ) -> Dict[str, Any]:
+        """
+        Copy an upload into the store line by line, checking each request line. Raises
+        ValueError naming the first invalid line; nothing is stored in that case.
+        """
+        file_id = new_id("file-")
+
+        def copy() -> Dict[str, Any]:
+            fd, temp_path = tempfile.mkstemp(prefix=_TEMP_PREFIX, dir=self.directory)
+            try:
+                requests = 0
+                with os.fdopen(fd, "wb", buffering=chunk_size) as out:
+                    source.seek(0)
+                    for number, line in enumerate(source, 1):
+                        if line.strip():
+                            try:
+                                parse_request_line(line, endpoints)
+                            except ValueError as e:
+                                raise ValueError(f"line {number}: {e}")
+                            requests += 1
+                        out.write(line)
+                    size = out.tell()
+                    out.flush()
+                    os.fsync(out.fileno())
+                if not requests:
+                    raise ValueError("file contains no requests")
+                os.replace(temp_path, self.path(file_id))
+            except BaseException:
+                _unlink(temp_path)
+                raise
+            return self._save_meta(file_id, filename, purpose, size, requests)
+
+        return await asyncio.to_thread(copy)
+
+    def reserve(self) -> str:
+        """Allocate an id for a file written in place (a batch's output)."""
+        return new_id("file-")
+
+    def finish(self, file_id: str, filename: str, purpose: str) -> Dict[str, Any]:
+        """Store the metadata of a file written in place under a `reserve()`d id."""
+        return self._save_meta(file_id, filename, purpose, os.path.getsize(self.path(file_id)), 0)
+
+    def delete(self, file_id: str) -> bool:
+        path = self.path(file_id)
+        if not os.path.exists(path + ".json"):
+            return False
+        _unlink(path + ".json")
+        _unlink(path)
+        return True
+
+    def _save_meta(self, file_id: str, filename: str, purpose: str, size: int, requests: int) -> Dict[str, Any]:
+        file = {
+            "id": file_id,
+            "object": "file",
+            "bytes": size,
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+        }
+        _write_json(self.path(file_id) + ".json", {"file": file, "requests": requests})
+        return file
+
+
+def new_id(prefix: str) -> str:
+    return prefix + uuid.uuid4().hex
+
+
+def _touch(path: str) -> None:
+    with open(path, "wb"):
+        pass
+
+
+def _unlink(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class _Job:
+    """Progress of one batch run: open files and which input lines are done."""
+
+    def __init__(self, batch: Dict[str, Any], checkpoint: Dict[str, Any]) -> None:
+        self.batch = batch
+        # Input lines before `line` (ending at byte `offset`) are all done
+        self.line = checkpoint.get("line", 0)
+        self.offset = checkpoint.get("offset", 0)
+        # Lines at or after `line` that are done too
+        self.done: Set[int] = set(checkpoint.get("done", ()))
+        self.output_id: str = checkpoint["output_file_id"]
+        self.error_id: str = checkpoint["error_file_id"]
+        self.output_bytes = checkpoint.get("output_bytes", 0)
+        self.error_bytes = checkpoint.get("error_bytes", 0)
+        # Counts of the results kept in the output files
+        batch["request_counts"].update(checkpoint.get("request_counts", {}))
+        # Lines read but not yet covered by `line`, with the offset where each ends
+        self.started: "OrderedDict[int, int]" = OrderedDict()
+        self.tasks: Set["asyncio.Task[None]"] = set()
+        self.cancel_requested = False
+        self.expired = False
+        self.input: Optional[BinaryIO] = None
+        self.output: Optional[BinaryIO] = None
+        self.errors: Optional[BinaryIO] = None
+        self.checkpointed_at = time.monotonic()
+        self.checkpointing: Optional["asyncio.Task[None]"] = None
+
+    def complete(self, line: int) -> None:
+        self.done.add(line)
+        while self.started and next(iter(self.started)) in self.done:
+            number, end = self.started.popitem(last=False)
+            self.done.discard(number)
+            self.line, self.offset = number + 1, end
+
+    def checkpoint(self) -> Dict[str, Any]:
+        """
+        Snapshot of the progress, taken on the event loop. The output files are flushed
+        so their sizes match it; results written later only extend them.
+        """
+        for f in (self.output, self.errors):
+            if f is not None and not f.closed:
+                f.flush()
+        if self.output is not None and not self.output.closed:
+            self.output_bytes = self.output.tell()
+        if self.errors is not None and not self.errors.closed:
+            self.error_bytes = self.errors.tell()
+        return {
+            "line": self.line,
+            "offset": self.offset,
+            "done": sorted(self.done),
+            "output_file_id": self.output_id,
+            "error_file_id": self.error_id,
+            "output_bytes": self.output_bytes,
+            "error_bytes": self.error_bytes,
+            "request_counts": {k: self.batch["request_counts"][k] for k in ("completed", "failed")},
+        }
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        directory: str,
+        files: FileStore,
+        execute: Callable[[str, Dict[str, Any]], Awaitable[Dict[str, Any]]],
+        endpoints: Sequence[str] = ("/v1/chat/completions",),
+        workers: int = 4,
+        checkpoint_seconds: float = 5.0,
+        max_attempts: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        poll_seconds: float = 1.0,
+    ) -> None:
+        """
+        `execute(url, body)` runs one request and returns its response body, or raises
+        BatchRequestError. Throttled requests (429/503) pause every worker for a jittered
+        backoff (at least the upstream's Retry-After) and are retried up to `max_attempts`
+        times in total before they are recorded as failed.
+        """
+        self.directory = os.path.join(directory, "batches")
+        os.makedirs(self.directory, exist_ok=True)
+        _remove_temp_files(self.directory)
+        self.files = files
+        self.execute = execute
+        self.endpoints = tuple(endpoints)
+        self.workers = max(1, workers)
+        self.checkpoint_seconds = checkpoint_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_seconds = poll_seconds
+
+        # Whether this process holds the lock that lets it run batches
+        self.owner = False
+        self._owner_lock: Optional[BinaryIO] = None
+        self._poller: Optional["asyncio.Task[None]"] = None
+        self._batches: Dict[str, Dict[str, Any]] = {}
+        self._checkpoints: Dict[str, Dict[str, Any]] = {}
+        self._jobs: Dict[str, _Job] = {}
+        self._tasks: Dict[str, "asyncio.Task[None]"] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._paused_until = 0.0
+        self._load()
+
+        self.requests_completed = 0
+        self.requests_failed = 0
+        self.retries = 0
+        self.resumed = 0
+
+    def _load(self, batch_id: Optional[str] = None) -> None:
+        """(Re)read saved batches, or just `batch_id`, except the ones this process runs."""
+        names = [batch_id + ".json"] if batch_id is not None else os.listdir(self.directory)
+        for name in names:
+            if not name.endswith(".json") or name.startswith(_TEMP_PREFIX) or name[: -len(".json")] in self._tasks:
+                continue
+            state = _read_json(os.path.join(self.directory, os.path.basename(name)))
+            if state is not None:
+                self._batches[state["batch"]["id"]] = state["batch"]
+                self._checkpoints[state["batch"]["id"]] = state["checkpoint"]
+
+    async def start(self) -> None:
+        """Take ownership if no other worker has it and resume the batches that were running."""
+        self._slots = asyncio.Semaphore(self.workers)
+        if await asyncio.to_thread(self._try_own):
+            self._resume()
+        self._poller = asyncio.create_task(self._poll())
+
+    async def stop(self) -> None:
+        """Stop running batches after checkpointing them; `start()` resumes them."""
+        if self._poller is not None:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+            self._poller = None
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._owner_lock is not None:
+            self._owner_lock.close()
+            self._owner_lock = None
+            self.owner = False
+
+    def _try_own(self) -> bool:
+        if fcntl is None:
+            # No other process can share the directory safely; run batches here
+            self.owner = True
+            return True
+        f = open(os.path.join(self.directory, ".owner"), "ab")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._owner_lock = f
+        self.owner = True
+        # Another owner may have progressed since this process last read the state
+        self._load()
+        return True
+
+    def _resume(self) -> None:
+        for batch_id, batch in list(self._batches.items()):
+            if batch["status"] in _ACTIVE and batch_id not in self._tasks:
+                self.resumed += 1
+                self._launch(batch_id)
+
+    async def _poll(self) -> None:
+        """Owner: pick up batches and cancellations from other workers. Others: wait to take over."""
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            try:
+                if not self.owner:
+                    if await asyncio.to_thread(self._try_own):
+                        logger.info("Took over running batches")
+                        self._resume()
+                    continue
+                names = await asyncio.to_thread(os.listdir, self.directory)
+                for name in names:
+                    batch_id, ext = os.path.splitext(name)
+                    if ext == ".json" and batch_id not in self._batches and not name.startswith(_TEMP_PREFIX):
+                        await asyncio.to_thread(self._load, batch_id)
+                        batch = self._batches.get(batch_id)
+                        if batch is not None and batch["status"] in _ACTIVE:
+                            self._launch(batch_id)
+                    elif ext == ".cancel":
+                        await self.cancel(batch_id)
+                        _unlink(os.path.join(self.directory, name))
+            except Exception:
+                logger.exception("Polling for batches failed")
+
+    async def create(self, input_file_id: str, endpoint: str, completion_window: str, metadata: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Create and start a batch; raises ValueError for an invalid request."""
+        if endpoint not in self.endpoints:
+            raise ValueError(f"Invalid endpoint: must be one of {', '.join(self.endpoints)}")
+        if completion_window not in COMPLETION_WINDOWS:
+            raise ValueError(f"Invalid completion_window: must be one of {', '.join(COMPLETION_WINDOWS)}")
+        file = await asyncio.to_thread(self.files.get, input_file_id)
+        if file is None or file["purpose"] != "batch":
+            raise ValueError(f"No batch input file with id {input_file_id!r}")
+
+        now = int(time.time())
+        batch_id = new_id("batch_")
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": VALIDATING,
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": now,
+            "in_progress_at": None,
+            "expires_at": now + COMPLETION_WINDOWS[completion_window],
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": await asyncio.to_thread(self.files.requests, input_file_id), "completed": 0, "failed": 0},
+            "metadata": metadata,
+        }
+        self._batches[batch_id] = batch
+        self._checkpoints[batch_id] = {"output_file_id": self.files.reserve(), "error_file_id": self.files.reserve()}
+        await asyncio.to_thread(self._save, batch_id)
+        if self.owner:
+            self._launch(batch_id)
+        return batch
+
+    def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        if not self.owner:
+            self._load(batch_id)
+        return self._batches.get(batch_id)
+
+    def list(self, limit: int = 20, after: Optional[str] = None) -> List[Dict[str, Any]]:
+        if not self.owner:
+            self._load()
+        # Called from a worker thread: copy (atomic) in case the event loop adds a batch meanwhile
+        batches = sorted(self._batches.copy().values(), key=lambda b: (b["created_at"], b["id"]), reverse=True)
+        if after is not None:
+            ids = [b["id"] for b in batches]
+            batches = batches[ids.index(after) + 1:] if after in ids else []
+        return batches[:limit]
+
+    async def cancel(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        batch = await asyncio.to_thread(self.get, batch_id)
+        if batch is None or batch["status"] not in (VALIDATING, IN_PROGRESS):
+            return batch
+        if not self.owner:
+            # The owner applies it on its next poll
+            await asyncio.to_thread(_touch, os.path.join(self.directory, batch_id + ".cancel"))
+            return dict(batch, status=CANCELLING, cancelling_at=int(time.time()))
+        batch["status"] = CANCELLING
+        batch["cancelling_at"] = int(time.time())
+        job = self._jobs.get(batch_id)
+        if job is not None:
+            job.cancel_requested = True
+            for task in list(job.tasks):
+                task.cancel()
+        await asyncio.to_thread(self._save, batch_id)
+        return batch
+
+    def stats(self) -> Dict[str, Any]:
+        running = list(self._jobs.values())
+        return {
+            "owner": self.owner,
+            "workers": self.workers,
+            "batches": len(self._batches),
+            "running": len(running),
+            "in_flight": sum(len(job.tasks) for job in running),
+            "requests_completed": self.requests_completed,
+            "requests_failed": self.requests_failed,
+            "retries": self.retries,
+            "paused_for": round(max(0.0, self._paused_until - time.monotonic()), 3),
+            "resumed": self.resumed,
+        }
+
+    def _launch(self, batch_id: str) -> None:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        task = asyncio.create_task(self._run(batch_id))
+        self._tasks[batch_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(batch_id, None))
+
+    def _save(self, batch_id: str) -> None:
+        _write_json(
+            os.path.join(self.directory, batch_id + ".json"),
+            {"batch": self._batches[batch_id], "checkpoint": self._checkpoints[batch_id]},
+        )
+
+    async def _run(self, batch_id: str) -> None:
+        batch = self._batches[batch_id]
+        job = _Job(batch, self._checkpoints[batch_id])
+        job.cancel_requested = batch["status"] == CANCELLING
+        self._jobs[batch_id] = job
+        try:
+            await asyncio.to_thread(self._open, job)
+            if batch["status"] == VALIDATING:
+                batch["status"] = IN_PROGRESS
+                batch["in_progress_at"] = int(time.time())
+                await asyncio.to_thread(self._save, batch_id)
+            await self._feed(job)
+            if job.tasks:
+                await asyncio.wait(set(job.tasks))
+            await self._finalize(job)
+        except asyncio.CancelledError:
+            # Proxy shutdown: stop the requests and keep the progress for `start()`
+            for task in list(job.tasks):
+                task.cancel()
+            await asyncio.gather(*job.tasks, return_exceptions=True)
+            if job.checkpointing is not None:
+                await asyncio.gather(job.checkpointing, return_exceptions=True)
+            await asyncio.to_thread(self._persist, job, job.checkpoint())
+            raise
+        except Exception as e:
+            logger.exception("Batch %s failed", batch_id)
+            for task in list(job.tasks):
+                task.cancel()
+            batch["status"] = FAILED
+            batch["failed_at"] = int(time.time())
+            batch["errors"] = {"object": "list", "data": [{"code": "batch_failed", "message": str(e)}]}
+            await asyncio.to_thread(self._save, batch_id)
+        finally:
+            self._jobs.pop(batch_id, None)
+            await asyncio.to_thread(self._close, job)
+
+    def _open(self, job: _Job) -> None:
+        job.input = open(self.files.path(job.batch["input_file_id"]), "rb")
+        job.input.seek(job.offset)
+        job.output = self._open_output(job.output_id, job.output_bytes)
+        job.errors = self._open_output(job.error_id, job.error_bytes)
+
+    def _open_output(self, file_id: str, size: int) -> BinaryIO:
+        # Results written after the last checkpoint are dropped; their requests run again
+        f = open(self.files.path(file_id), "ab")
+        f.truncate(size)
+        f.seek(size)
+        return f
+
+    def _close(self, job: _Job) -> None:
+        for f in (job.input, job.output, job.errors):
+            if f is not None:
+                f.close()
+
+    async def _feed(self, job: _Job) -> None:
+        assert self._slots is not None and job.input is not None
+        number = job.line
+        while not job.cancel_requested:
+            if time.time() >= job.batch["expires_at"]:
+                job.expired = True
+                return
+            line = await asyncio.to_thread(job.input.readline)
+            if not line:
+                return
+            job.started[number] = job.input.tell()
+            if number in job.done or not line.strip():
+                job.complete(number)
+            else:
+                await self._slots.acquire()
+                if job.cancel_requested:
+                    self._slots.release()
+                    return
+                task = asyncio.create_task(self._process(job, number, line))
+                job.tasks.add(task)
+                task.add_done_callback(job.tasks.discard)
+            number += 1
+
+    async def _process(self, job: _Job, number: int, line: bytes) -> None:
+        assert self._slots is not None
+        try:
+            try:
+                request = parse_request_line(line, (job.batch["endpoint"],))
+            except ValueError as e:
+                self._record(job, number, None, None, {"code": "invalid_request", "message": f"line {number + 1}: {e}"})
+                return
+            response = await self._execute(request)
+            self._record(job, number, request["custom_id"], response, None)
+        finally:
+            self._slots.release()
+
+    async def _execute(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Response object ({"status_code", "request_id", "body"}) for one request."""
+        for attempt in range(1, self.max_attempts + 1):
+            while self._paused_until > time.monotonic():
+                await asyncio.sleep(self._paused_until - time.monotonic())
+            try:
+                body = await self.execute(request["url"], request["body"])
+                status = 200
+            except BatchRequestError as e:
+                if e.status in THROTTLED_STATUS and attempt < self.max_attempts:
+                    self.retries += 1
+                    delay = backoff_delay(attempt, self.backoff, self.max_backoff, e.retry_after)
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                    continue
+                status, body = e.status, {"error": {"message": e.message, "type": "upstream_error" if e.status >= 500 else "invalid_request_error"}}
+            except Exception as e:
+                logger.exception("Batch request failed")
+                status, body = 500, {"error": {"message": str(e) or e.__class__.__name__, "type": "server_error"}}
+            break
+        return {"status_code": status, "request_id": new_id("req_"), "body": body}
+
+    def _record(
+        self,
+        job: _Job,
+        number: int,
+        custom_id: Optional[str],
+        response: Optional[Dict[str, Any]],
+        error: Optional[Dict[str, Any]],
+    ) -> None:
+        assert job.output is not None and job.errors is not None
+        ok = response is not None and response["status_code"] < 400
+        record = {"id": new_id("batch_req_"), "custom_id": custom_id, "response": response, "error": error}
+        (job.output if ok else job.errors).write(dumps(record) + b"\n")
+        counts = job.batch["request_counts"]
+        if ok:
+            counts["completed"] += 1
+            self.requests_completed += 1
+        else:
+            counts["failed"] += 1
+            self.requests_failed += 1
+        job.complete(number)
+
+        if job.checkpointing is None and time.monotonic() - job.checkpointed_at >= self.checkpoint_seconds:
+            job.checkpointing = asyncio.create_task(asyncio.to_thread(self._persist, job, job.checkpoint()))
+            job.checkpointing.add_done_callback(lambda _: setattr(job, "checkpointing", None))
+
+    def _persist(self, job: _Job, checkpoint: Dict[str, Any]) -> None:
+        """Make the results covered by `checkpoint` durable, then save it (in a thread)."""
+        for f in (job.output, job.errors):
+            if f is not None and not f.closed:
+                os.fsync(f.fileno())
+        batch_id = job.batch["id"]
+        self._checkpoints[batch_id] = checkpoint
+        self._save(batch_id)
+        job.checkpointed_at = time.monotonic()
+
+    async def _finalize(self, job: _Job) -> None:
+        batch = job.batch
+        if job.checkpointing is not None:
+            await asyncio.gather(job.checkpointing, return_exceptions=True)
+        final = CANCELLED if job.cancel_requested else (EXPIRED if job.expired else COMPLETED)
+        if batch["status"] != CANCELLING:
+            batch["status"] = FINALIZING
+        batch["finalizing_at"] = batch["finalizing_at"] or int(time.time())
+        checkpoint = job.checkpoint()
+
+        def finish() -> None:
+            self._persist(job, checkpoint)
+            self._close(job)
+            batch_id = batch["id"]
+            batch["output_file_id"] = job.output_id
+            self.files.finish(job.output_id, f"{batch_id}_output.jsonl", "batch_output")
+            if job.error_bytes:
+                batch["error_file_id"] = job.error_id
+                self.files.finish(job.error_id, f"{batch_id}_error.jsonl", "batch_output")
+            else:
+                _unlink(self.files.path(job.error_id))
+            batch["status"] = final
+            batch[f"{final}_at"] = int(time.time())
+            self._save(batch_id)
+
+        await asyncio.to_thread(finish)
@@ -0,0 +1,207 @@
+"""
+Response cache for deterministic Ask Sage calls.
+
+Entries are opaque serialized bodies keyed by a canonical hash of the upstream
+payload. The memory tier is an LRU bounded by total value bytes; the optional
+disk tier is a SQLite file (so entries survive restarts) bounded the same way.
+Every entry carries its own expiry.
+
+Several worker processes can share one disk tier: the size total is kept in the
+database and updated in the same transaction as the entries.
+"""
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+def payload_key(payload: Dict[str, Any]) -> str:
+    """Canonical SHA-256 of a JSON payload (key order and whitespace independent)."""
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class _DiskTier:
+    def __init__(self, path: str, max_bytes: int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._bytes = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,"
+                " expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),))
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('bytes', (SELECT COALESCE(SUM(size), 0) FROM entries))"
+            )
+            conn.execute("COMMIT")
+            self._bytes = conn.execute("SELECT value FROM meta WHERE name = 'bytes'").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def _add_bytes(self, db: sqlite3.Connection, delta: int) -> int:
+        # Inside the caller's transaction; returns the new total over all processes
+        db.execute("UPDATE meta SET value = value + ? WHERE name = 'bytes'", (delta,))
+        self._bytes = db.execute("SELECT value FROM meta WHERE name = 'bytes'").fetchone()[0]
+        return self._bytes
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT value, size, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, size, expires_at = row
+            if expires_at <= now:
+                db.execute("BEGIN IMMEDIATE")
+                if db.execute("DELETE FROM entries WHERE key = ? AND expires_at <= ?", (key, now)).rowcount:
+                    self._add_bytes(db, -size)
+                db.execute("COMMIT")
+                return None
+            db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            return bytes(value), expires_at
+
+    def put(self, key: str, value: bytes, expires_at: float) -> int:
+        """Store an entry; returns how many entries were evicted to make room."""
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                old = db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                db.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, value, len(value), expires_at, time.time()),
+                )
+                total = self._add_bytes(db, len(value) - (old[0] if old is not None else 0))
+                evicted = 0
+                while self.max_bytes and total > self.max_bytes:
+                    row = db.execute("SELECT key, size FROM entries ORDER BY accessed_at LIMIT 1").fetchone()
+                    if row is None:
+                        break
+                    db.execute("DELETE FROM entries WHERE key = ?", (row[0],))
+                    total = self._add_bytes(db, -row[1])
+                    evicted += 1
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            return evicted
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"path": self.path, "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        max_bytes: int,
+        default_ttl: float,
+        path: Optional[str] = None,
+        max_disk_bytes: int = 0,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._entries: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self._bytes = 0
+        self._disk = _DiskTier(path, max_disk_bytes) if path else None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self.expired = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self._drop(key)
+            self.expired += 1
+
+        if self._disk is not None:
+            found = await asyncio.to_thread(self._disk.get, key)
+            if found is not None:
+                value, expires_at = found
+                self._store(key, value, expires_at)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        expires_at = time.time() + ttl
+        self._store(key, value, expires_at)
+        if self._disk is not None:
+            self.disk_evictions += await asyncio.to_thread(self._disk.put, key, value, expires_at)
+
+    def close(self) -> None:
+        if self._disk is not None:
+            self._disk.close()
+
+    def stats(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "default_ttl": self.default_ttl,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
+        if self._disk is not None:
+            out["disk"] = dict(self._disk.stats(), evictions=self.disk_evictions)
+        return out
+
+    def _store(self, key: str, value: bytes, expires_at: float) -> None:
+        self._drop(key)
+        if len(value) > self.max_bytes:
+            # Too large for the memory tier; the disk tier (if any) still holds it
+            return
+        self._entries[key] = (value, expires_at)
+        self._bytes += len(value)
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
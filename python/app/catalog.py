@@ -0,0 +1,108 @@
+"""
+In-process cache of the Ask Sage model catalog.
+
+`/v1/models` and `/v1/models/{model}` are polled by IDE clients on every window
+open / model picker refresh. The catalog keeps the normalized model list plus an
+id index in memory for `ttl` seconds, then keeps serving the stale copy for up to
+`stale_ttl` more seconds while a single background refresh runs.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .singleflight import SingleFlight
+
+ModelList = List[Dict[str, Any]]
+ModelIndex = Dict[str, Dict[str, Any]]
+
+
+class ModelCatalog:
+    def __init__(self, fetch: Callable[[], Awaitable[ModelList]], ttl: float, stale_ttl: float = 0.0) -> None:
+        self._fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._models: Optional[ModelList] = None
+        self._index: ModelIndex = {}
+        self._fetched_at = 0.0
+        self._flight = SingleFlight()
+        self._background: Optional["asyncio.Task[None]"] = None
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    async def list(self) -> ModelList:
+        models, _ = await self._snapshot()
+        return models
+
+    async def get(self, model_id: str) -> Optional[Dict[str, Any]]:
+        _, index = await self._snapshot()
+        return index.get(model_id)
+
+    async def refresh(self) -> Tuple[ModelList, ModelIndex]:
+        """Force a reload from upstream (concurrent callers share one fetch)."""
+        return await self._flight.do("models", self._load)
+
+    def invalidate(self) -> None:
+        """Drop the cached catalog; the next lookup goes upstream."""
+        self._models = None
+        self._index = {}
+        self._fetched_at = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        age = None
+        if self._models is not None:
+            age = round(time.monotonic() - self._fetched_at, 3)
+        return {
+            "ttl": self.ttl,
+            "stale_ttl": self.stale_ttl,
+            "cached_models": len(self._models) if self._models is not None else 0,
+            "age_seconds": age,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+        }
+
+    async def _snapshot(self) -> Tuple[ModelList, ModelIndex]:
+        models = self._models
+        if models is not None and self.ttl > 0:
+            age = time.monotonic() - self._fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                return models, self._index
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._refresh_in_background()
+                return models, self._index
+        self.misses += 1
+        return await self.refresh()
+
+    async def _load(self) -> Tuple[ModelList, ModelIndex]:
+        try:
+            models = await self._fetch()
+        except Exception:
+            self.refresh_errors += 1
+            raise
+        index: ModelIndex = {}
+        for m in models:
+            # First entry wins, matching the order upstream returns them in
+            index.setdefault(m["id"], m)
+        self._models, self._index, self._fetched_at = models, index, time.monotonic()
+        self.refreshes += 1
+        return models, index
+
+    def _refresh_in_background(self) -> None:
+        if self._background is not None and not self._background.done():
+            return
+        self._background = asyncio.get_running_loop().create_task(self._refresh_quietly())
+
+    async def _refresh_quietly(self) -> None:
+        try:
+            await self.refresh()
+        except Exception:
+            # Keep serving the stale copy; the failure is counted in refresh_errors
+            pass
@@ -0,0 +1,318 @@
+"""
+Response compression negotiated from `Accept-Encoding`, and compressed request bodies.
+
+gzip is always available; brotli (`br`) and zstd are used when the `brotli` and
+`zstandard` packages are installed (they are in `requirements.txt`). The codec is
+the one the client prefers (q-values), ties going to the server's order.
+
+Responses are compressed when their type is text-like (JSON, JSONL, SSE, text)
+and they are at least `minimum_size` bytes; a streamed body without a
+Content-Length is judged by its first chunk. Partial content (206, or any
+response with a Content-Range) is left as is: the range is of the identity body. Server-sent events are flushed after
+every chunk the app sends, so each event reaches the client as soon as it is
+produced. Large chunks are compressed in a worker thread (all three libraries
+release the GIL) so they don't stall the event loop.
+
+Request bodies sent with `Content-Encoding: gzip` or `zstd` are decompressed as
+they arrive. Output is capped at `max_decompressed_bytes` (413 past it), so a
+small "decompression bomb" can't blow up memory.
+"""
+import asyncio
+import zlib
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from starlette.responses import JSONResponse
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - exercised only without brotli installed
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - exercised only without zstandard installed
+    zstandard = None
+
+Scope = Dict[str, Any]
+Message = Dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+# Levels that favour speed: the proxy compresses on the request path
+DEFAULT_LEVELS = {"gzip": 5, "br": 4, "zstd": 3}
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/jsonl",
+    "application/x-ndjson",
+    "application/problem+json",
+    "application/javascript",
+    "application/xml",
+)
+# Chunks at least this big are compressed off the event loop
+OFFLOAD_BYTES = 128 * 1024
+_DECOMPRESS_ERRORS = (zlib.error,) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def available_codecs() -> List[str]:
+    codecs = ["gzip"]
+    if brotli is not None:
+        codecs.append("br")
+    if zstandard is not None:
+        codecs.append("zstd")
+    return codecs
+
+
+class Compressor:
+    """Streaming compressor: `compress()` chunks, `flush()` to emit what's buffered, `finish()` once."""
+
+    def __init__(self, codec: str, level: Optional[int] = None) -> None:
+        self.codec = codec
+        level = DEFAULT_LEVELS[codec] if level is None else level
+        if codec == "gzip":
+            self._obj: Any = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif codec == "br":
+            self._obj = brotli.Compressor(quality=level)
+        elif codec == "zstd":
+            self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            raise ValueError(f"unsupported codec: {codec}")
+
+    def compress(self, data: bytes) -> bytes:
+        if self.codec == "br":
+            return self._obj.process(data)
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        if self.codec == "gzip":
+            return self._obj.flush(zlib.Z_SYNC_FLUSH)
+        if self.codec == "br":
+            return self._obj.flush()
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        if self.codec == "gzip":
+            return self._obj.flush(zlib.Z_FINISH)
+        if self.codec == "br":
+            return self._obj.finish()
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+def negotiate(accept_encoding: str, codecs: Sequence[str]) -> Optional[str]:
+    """The codec of `codecs` (in server preference order) the client accepts with the highest q, if any."""
+    if not accept_encoding:
+        return None
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            weights[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for codec in codecs:
+        q = weights.get(codec, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = codec, q
+    return best
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class Decompressor:
+    """Incremental request body decompression with an output cap."""
+
+    def __init__(self, codec: str, max_bytes: int) -> None:
+        self.codec = codec
+        self.max_bytes = max_bytes
+        self.total = 0
+        if codec == "gzip":
+            self._obj: Any = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif codec == "zstd":
+            self._out: List[bytes] = []
+            # A push-style writer: output is handed to write() in bounded pieces, so the
+            # cap is enforced while decompressing rather than after
+            self._obj = zstandard.ZstdDecompressor().stream_writer(self, write_size=64 * 1024, write_return_read=True)
+        else:
+            raise ValueError(f"unsupported codec: {codec}")
+
+    def decompress(self, data: bytes, final: bool = False) -> bytes:
+        """Raises BodyTooLarge past the cap and ValueError for corrupt input."""
+        try:
+            if self.codec == "gzip":
+                return self._gzip(data, final)
+            self._obj.write(data)
+            if final:
+                self._obj.flush()
+            out, self._out = b"".join(self._out), []
+            return out
+        except _DECOMPRESS_ERRORS as e:
+            raise ValueError(str(e)) from None
+
+    def write(self, data: bytes) -> int:
+        # Called by the zstd stream writer with decompressed output
+        self._count(len(data))
+        self._out.append(bytes(data))
+        return len(data)
+
+    def _gzip(self, data: bytes, final: bool) -> bytes:
+        out = []
+        while data:
+            chunk = self._obj.decompress(data, 64 * 1024)
+            self._count(len(chunk))
+            out.append(chunk)
+            data = self._obj.unconsumed_tail
+        if final:
+            if not self._obj.eof:
+                raise ValueError("truncated gzip body")
+            rest = self._obj.flush()
+            self._count(len(rest))
+            out.append(rest)
+        return b"".join(out)
+
+    def _count(self, n: int) -> None:
+        self.total += n
+        if self.total > self.max_bytes:
+            raise BodyTooLarge()
+
+
+def _header(headers: Sequence[Tuple[bytes, bytes]], name: bytes) -> Optional[bytes]:
+    for key, value in headers:
+        if key == name:
+            return value
+    return None
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, settings: Callable[[], Dict[str, Any]]) -> None:
+        self.app = app
+        # Resolved per request so settings can be changed at runtime (and in tests):
+        # enabled, minimum_size, codecs (preference order), levels, max_decompressed_bytes
+        self.settings = settings
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        settings = self.settings()
+        headers = scope.get("headers") or []
+
+        encoding = _header(headers, b"content-encoding")
+        if encoding is not None and encoding.strip().lower() != b"identity":
+            codec = encoding.strip().lower().decode("latin-1")
+            if codec not in ("gzip", "zstd") or codec not in available_codecs():
+                response = JSONResponse({"detail": f"Unsupported Content-Encoding: {codec}"}, status_code=415)
+                await response(scope, receive, send)
+                return
+            scope = dict(scope, headers=[(k, v) for k, v in headers if k not in (b"content-encoding", b"content-length")])
+            receive = self._decompressing(receive, Decompressor(codec, settings["max_decompressed_bytes"]))
+
+        codec = None
+        if settings["enabled"]:
+            accept = _header(headers, b"accept-encoding")
+            codec = negotiate(accept.decode("latin-1"), settings["codecs"]) if accept else None
+        if codec is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _CompressingSend(send, codec, settings["levels"].get(codec), settings["minimum_size"]))
+
+    @staticmethod
+    def _decompressing(receive: Receive, decompressor: Decompressor) -> Receive:
+        async def decompressing_receive() -> Message:
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+            final = not message.get("more_body", False)
+            try:
+                body = decompressor.decompress(message.get("body", b""), final)
+            except BodyTooLarge:
+                # Raised inside the endpoint's body parsing, so it becomes a normal error response
+                raise HTTPException(
+                    status_code=413, detail=f"Decompressed request body exceeds the {decompressor.max_bytes} byte limit"
+                )
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Request body is not valid {decompressor.codec} data")
+            return dict(message, body=body)
+
+        return decompressing_receive
+
+
+class _CompressingSend:
+    def __init__(self, send: Send, codec: str, level: Optional[int], minimum_size: int) -> None:
+        self.send = send
+        self.codec = codec
+        self.level = level
+        self.minimum_size = minimum_size
+        self.start: Optional[Message] = None
+        self.compressor: Optional[Compressor] = None
+        self.flush_each = False
+        self.passthrough = False
+
+    async def __call__(self, message: Message) -> None:
+        if self.passthrough:
+            await self.send(message)
+            return
+        if message["type"] == "http.response.start":
+            headers = message.get("headers") or []
+            content_type = (_header(headers, b"content-type") or b"").decode("latin-1").lower()
+            length = _header(headers, b"content-length")
+            if (
+                message["status"] < 200
+                or message["status"] in (204, 206, 304)
+                or _header(headers, b"content-encoding") is not None
+                or _header(headers, b"content-range") is not None
+                or not content_type.startswith(COMPRESSIBLE_TYPES)
+                or (length is not None and length.isdigit() and int(length) < self.minimum_size)
+            ):
+                self.passthrough = True
+                await self.send(message)
+                return
+            self.flush_each = content_type.startswith("text/event-stream")
+            # Held until the first body chunk shows whether the body is worth compressing
+            self.start = message
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more = message.get("more_body", False)
+        if self.compressor is None:
+            if not more and len(body) < self.minimum_size and not self.flush_each:
+                self.passthrough = True
+                await self.send(self.start)
+                await self.send(message)
+                return
+            self.compressor = Compressor(self.codec, self.level)
+            headers = [
+                (k, v) for k, v in self.start.get("headers") or [] if k not in (b"content-length", b"vary")
+            ]
+            vary = _header(self.start.get("headers") or [], b"vary")
+            vary = vary + b", Accept-Encoding" if vary and b"accept-encoding" not in vary.lower() else (vary or b"Accept-Encoding")
+            headers += [(b"content-encoding", self.codec.encode("latin-1")), (b"vary", vary)]
+            await self.send(dict(self.start, headers=headers))
+
+        if len(body) >= OFFLOAD_BYTES:
+            out = await asyncio.to_thread(self._compress, body, more)
+        else:
+            out = self._compress(body, more)
+        if out or not more:
+            await self.send({"type": "http.response.body", "body": out, "more_body": more})
+
+    def _compress(self, body: bytes, more: bool) -> bytes:
+        out = self.compressor.compress(body)
+        if not more:
+            return out + self.compressor.finish()
+        if self.flush_each:
+            return out + self.compressor.flush()
+        return out
@@ -0,0 +1,38 @@
+"""
+JSON encoding/decoding on bytes, backed by orjson when it is installed.
+
+orjson parses straight from bytes and serializes straight to bytes, several times
+faster than the stdlib; without it the stdlib is used with the same compact
+output Starlette's JSONResponse produces.
+"""
+import json
+from typing import Any, Union
+
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - exercised only without orjson installed
+    orjson = None
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers beyond 64 bits or unknown types: let the stdlib decide
+            pass
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    """Parse JSON; raises ValueError (json.JSONDecodeError or orjson.JSONDecodeError) when invalid."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
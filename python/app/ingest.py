@@ -0,0 +1,138 @@
+"""
+Bounded-memory ingestion of JSON request bodies.
+
+`read_body()` collects a body into one growing buffer (no list of chunks joined
+at the end, and no copy cached on the request for its lifetime). An optional
+`MessageScanner` sees each chunk first and checks a chat completion's `messages`
+array as it arrives: the number of messages and the size of each one (in bytes
+of JSON). A request over a limit is rejected with 413 as soon as the offending
+part has been received, without waiting for the rest of the body or parsing it.
+The overall body size is capped by `BodySizeLimitMiddleware`.
+
+The scanner tracks just enough of the JSON structure to find the top-level
+`messages` key. Escaped quotes and backslashes are first blanked out with
+`bytes.replace()`, so string contents are skipped with one `bytes.find()` for the
+closing quote: the per-byte work runs in C. It doesn't validate the JSON (the parser does that
+afterwards) and matches the key as written, without decoding escapes.
+"""
+import re
+from typing import AsyncIterator, Optional
+
+from fastapi import HTTPException
+
+_STRUCTURAL = re.compile(rb'["{}\[\],]')
+_MESSAGES_KEY = b"messages"
+_MAX_KEY = 64
+
+
+class MessageScanner:
+    def __init__(self, max_messages: int = 0, max_message_bytes: int = 0) -> None:
+        # 0 disables a limit
+        self.max_messages = max_messages
+        self.max_message_bytes = max_message_bytes
+        self.messages = 0
+        self._offset = 0
+        self._depth = 0
+        self._object = False
+        self._in_string = False
+        self._escape = False
+        self._expect_key = False
+        self._key: Optional[bytearray] = None
+        self._last_key = b""
+        self._in_messages = False
+        self._message_start: Optional[int] = None
+
+    def feed(self, chunk: bytes) -> None:
+        """Scan the next chunk of the body; raises HTTPException(413) past a limit."""
+        if not chunk:
+            return
+        if self._escape:
+            # The previous chunk ended in the middle of an escape sequence
+            chunk = b"_" + chunk[1:]
+            self._escape = False
+        if b"\\" in chunk:
+            # Same-length stand-ins for escaped backslashes and quotes (pairs are replaced
+            # left to right, as JSON reads them), so every quote left ends or starts a string
+            chunk = chunk.replace(b"\\\\", b"__").replace(b'\\"', b"__")
+            self._escape = chunk.endswith(b"\\")
+        pos, end = 0, len(chunk)
+        while pos < end:
+            if self._in_string:
+                pos = self._skip_string(chunk, pos)
+                continue
+
+            found = _STRUCTURAL.search(chunk, pos)
+            if found is None:
+                break
+            pos = found.end()
+            char = chunk[found.start()]
+            if char == 0x22:  # "
+                self._in_string = True
+                if self._depth == 1 and self._expect_key:
+                    self._key = bytearray()
+                pos = self._skip_string(chunk, pos)
+            elif char in (0x7B, 0x5B):  # { [
+                if self._depth == 0:
+                    self._object = char == 0x7B
+                elif self._depth == 1 and char == 0x5B and self._object and self._last_key == _MESSAGES_KEY:
+                    self._in_messages = True
+                elif self._depth == 2 and self._in_messages and char == 0x7B:
+                    self._start_message(self._offset + found.start())
+                self._depth += 1
+                if self._depth == 1 and self._object:
+                    self._expect_key = True
+            elif char in (0x7D, 0x5D):  # } ]
+                self._depth -= 1
+                if self._depth == 2 and self._message_start is not None:
+                    self._check_message(self._offset + pos)
+                    self._message_start = None
+                elif self._depth == 1:
+                    self._in_messages = False
+            elif self._depth == 1 and self._object:  # ,
+                self._expect_key = True
+
+        self._offset += end
+        if self._message_start is not None:
+            # Inside a message: reject a huge one before the rest of it arrives
+            self._check_message(self._offset)
+
+    def _skip_string(self, chunk: bytes, pos: int) -> int:
+        """Position after the closing quote of the string being scanned, or the chunk's end."""
+        quote = chunk.find(b'"', pos)
+        if quote == -1:
+            self._capture(chunk, pos, len(chunk))
+            return len(chunk)
+        self._capture(chunk, pos, quote)
+        self._in_string = False
+        if self._key is not None:
+            self._last_key, self._key = bytes(self._key), None
+            self._expect_key = False
+        return quote + 1
+
+    def _capture(self, chunk: bytes, start: int, stop: int) -> None:
+        # Keys are matched as written; longer ones can't be "messages" anyway
+        if self._key is not None and len(self._key) < _MAX_KEY:
+            self._key += chunk[start:min(stop, start + _MAX_KEY)]
+
+    def _start_message(self, offset: int) -> None:
+        self.messages += 1
+        if self.max_messages and self.messages > self.max_messages:
+            raise HTTPException(status_code=413, detail=f"Request has more than {self.max_messages} messages")
+        self._message_start = offset
+
+    def _check_message(self, offset: int) -> None:
+        if self.max_message_bytes and offset - self._message_start > self.max_message_bytes:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Message {self.messages - 1} exceeds the {self.max_message_bytes} byte limit",
+            )
+
+
+async def read_body(chunks: AsyncIterator[bytes], scanner: Optional[MessageScanner] = None) -> bytearray:
+    """The whole body, checked by `scanner` as it arrives."""
+    body = bytearray()
+    async for chunk in chunks:
+        if scanner is not None:
+            scanner.feed(chunk)
+        body += chunk
+    return body
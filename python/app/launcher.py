@@ -0,0 +1,110 @@
+"""
+Production launcher (`python -m app`).
+
+Runs the proxy under uvicorn with:
+
+- one worker process per CPU of the container's quota (cgroup v2 `cpu.max` or the
+  v1 CFS quota), or per usable CPU when there is no quota;
+- uvloop and httptools when they are installed;
+- a graceful drain on SIGTERM: workers stop accepting connections and in-flight
+  requests, streams included, get up to ASKSAGE_DRAIN_SECONDS to finish.
+
+Workers share state through ASKSAGE_SHARED_DIR (a temporary directory created for
+the run unless set); see `app.shared`.
+"""
+import argparse
+import importlib.util
+import logging
+import math
+import os
+import shutil
+import tempfile
+from typing import List, Optional
+
+import uvicorn
+
+APP = "app.main:app"
+
+logger = logging.getLogger("asksage-openai-proxy")
+
+
+def cpu_quota(cgroup_root: str = "/sys/fs/cgroup") -> Optional[float]:
+    """CPUs allowed by the cgroup CPU quota, or None when there is no quota."""
+    try:
+        with open(os.path.join(cgroup_root, "cpu.max")) as f:
+            quota, period = f.read().split()[:2]
+        return int(quota) / int(period) if quota != "max" else None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(cgroup_root, "cpu", "cpu.cfs_quota_us")) as f:
+            quota_us = int(f.read())
+        with open(os.path.join(cgroup_root, "cpu", "cpu.cfs_period_us")) as f:
+            period_us = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return quota_us / period_us if quota_us > 0 and period_us > 0 else None
+
+
+def usable_cpus() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def default_workers(quota: Optional[float], cpus: int) -> int:
+    """One worker per CPU of the quota (rounded up), never more than the usable CPUs."""
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+def _installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app", description="Run the Ask Sage OpenAI-compatible proxy.")
+    parser.add_argument("--host", default=os.getenv("ASKSAGE_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("ASKSAGE_PORT", "8000")))
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("ASKSAGE_WORKERS", "0") or "0"),
+        help="worker processes (default: sized to the CPU quota)",
+    )
+    parser.add_argument(
+        "--drain-seconds",
+        type=int,
+        default=int(os.getenv("ASKSAGE_DRAIN_SECONDS", "30")),
+        help="how long in-flight requests may run after SIGTERM",
+    )
+    args = parser.parse_args(argv)
+
+    workers = args.workers or default_workers(cpu_quota(), usable_cpus())
+    loop = "uvloop" if _installed("uvloop") else "asyncio"
+    http = "httptools" if _installed("httptools") else "h11"
+
+    # Inherited by the workers: limits are split between them and they share state
+    os.environ["ASKSAGE_WORKERS"] = str(workers)
+    created = None
+    if workers > 1 and not os.getenv("ASKSAGE_SHARED_DIR"):
+        created = tempfile.mkdtemp(prefix="asksage-proxy-")
+        os.environ["ASKSAGE_SHARED_DIR"] = created
+
+    # Same format as uvicorn's own messages, which follow
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:     %(message)s")
+    logger.info("Starting %d worker(s) on %s:%d (loop=%s, http=%s)", workers, args.host, args.port, loop, http)
+    try:
+        uvicorn.run(
+            APP,
+            host=args.host,
+            port=args.port,
+            workers=workers if workers > 1 else None,
+            loop=loop,
+            http=http,
+            timeout_graceful_shutdown=args.drain_seconds,
+        )
+    finally:
+        if created is not None:
+            shutil.rmtree(created, ignore_errors=True)
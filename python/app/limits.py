@@ -0,0 +1,63 @@
+"""
+Request body size limits enforced while the body is being received.
+
+Starlette parses (and spools) a multipart upload before the endpoint runs, so a
+size check inside the endpoint comes too late. This middleware rejects requests
+whose declared Content-Length is over the limit up front, and counts the bytes
+of bodies as they arrive so chunked uploads are cut off as soon as they exceed it.
+"""
+from typing import Any, Awaitable, Callable, Dict
+
+from fastapi import HTTPException
+from starlette.responses import JSONResponse
+
+Scope = Dict[str, Any]
+Message = Dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+
+def _too_large(limit: int) -> Dict[str, Any]:
+    return {"detail": f"Request body exceeds the {limit} byte limit"}
+
+
+class BodySizeLimitMiddleware:
+    def __init__(self, app: ASGIApp, limits: Callable[[], Dict[str, int]]) -> None:
+        self.app = app
+        # Resolved per request so limits can be changed at runtime (and in tests)
+        self.limits = limits
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        limit = self.limits().get(scope["path"].rstrip("/"), 0)
+        if not limit:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope.get("headers") or []:
+            if name == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    break
+                if declared > limit:
+                    await JSONResponse(_too_large(limit), status_code=413)(scope, receive, send)
+                    return
+                break
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Raised inside the endpoint's body parsing, so it becomes a normal 413 response
+                    raise HTTPException(status_code=413, detail=_too_large(limit)["detail"])
+            return message
+
+        await self.app(scope, limited_receive, send)
@@ -1,12 +1,46 @@
 import os
+import asyncio
+import hmac
+import importlib.util
+import logging
+import math
 import time
-import json
-from typing import Any, Dict, List, Optional, Union, AsyncGenerator
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union, AsyncGenerator
 from contextlib import asynccontextmanager
 
 import httpx
 from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
-from fastapi.responses import JSONResponse, StreamingResponse, Response
+from fastapi.responses import FileResponse, StreamingResponse, Response
+from starlette.background import BackgroundTask
+
+from .accesslog import (
+    AccessLog,
+    AccessLogMiddleware,
+    add as access_add,
+    add_sizes as access_sizes,
+    annotate as access_annotate,
+    open_sink,
+    request_id,
+)
+from .audiocache import AudioCache, AudioFileResponse, AudioWriter
+from .backends import Backend, BackendPool, parse_backends
+from .batches import BatchRequestError, BatchRunner, FileStore
+from .cache import ResponseCache, payload_key
+from .catalog import ModelCatalog
+from .compression import CompressionMiddleware, available_codecs
+from .fastjson import FastJSONResponse, dumps, loads
+from .ingest import MessageScanner, read_body
+from .limits import BodySizeLimitMiddleware
+from .metrics import SIZE_BUCKETS, Counter, Gauge, MetricsMiddleware, Registry, merge_snapshots, render_metrics
+from .multipart import MultipartStream, upload_sha256
+from .profiling import ProfileStore, RequestProfilerMiddleware, SamplingProfiler
+from .prompt import PromptBuilder, PromptResult, estimate_tokens
+from .ratelimit import STATE_KEY as RATELIMIT_STATE_KEY, ClientRateLimiter, RateLimitHeadersMiddleware, client_id
+from .resilience import CircuitBreaker, CircuitOpen, RetryBudget, backoff_delay
+from .scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, AdmissionController, AdmissionRejected
+from .shared import SharedState
+from .singleflight import SingleFlight
+from .timing import ServerTimingMiddleware, UpstreamTrace, current as current_timing, phase, record
 
 APP_NAME = "asksage-openai-proxy"
 
@@ -16,6 +50,15 @@ def _env_bool(name: str, default: bool) -> bool:
         return default
     return v.strip().lower() in ("1", "true", "yes", "y", "on")
 
+def _env_int_map(name: str) -> Dict[str, int]:
+    """Parse `key=int,key=int` (e.g. per-model limits)."""
+    out: Dict[str, int] = {}
+    for item in os.getenv(name, "").split(","):
+        key, sep, value = item.strip().rpartition("=")
+        if sep and key.strip():
+            out[key.strip()] = int(value)
+    return out
+
 ASKSAGE_SERVER_BASE = os.getenv("ASKSAGE_SERVER_BASE", "https://api.genai.army.mil/server/").rstrip("/") + "/"
 ASKSAGE_API_KEY = os.getenv("ASKSAGE_API_KEY", "")
 ASKSAGE_DEFAULT_MODEL = os.getenv("ASKSAGE_DEFAULT_MODEL", "gpt-4o-mini")
@@ -25,28 +68,542 @@ ASKSAGE_DEFAULT_LIVE = int(os.getenv("ASKSAGE_DEFAULT_LIVE", "0"))
 ASKSAGE_DEFAULT_LIMIT_REFERENCES = int(os.getenv("ASKSAGE_DEFAULT_LIMIT_REFERENCES", "0"))
 ASKSAGE_INCLUDE_USAGE = _env_bool("ASKSAGE_INCLUDE_USAGE", False)
 
+# Worker processes (set by `python -m app`). Proxy-wide limits (admission control, retry
+# budget floor) are split between them; the shared directory holds the state they share
+# (worker heartbeats and metrics, and by default the disk tiers of the caches).
+ASKSAGE_WORKERS = max(1, int(os.getenv("ASKSAGE_WORKERS", "1") or "1"))
+ASKSAGE_SHARED_DIR = os.getenv("ASKSAGE_SHARED_DIR")
+ASKSAGE_SHARED_HEARTBEAT_SECONDS = float(os.getenv("ASKSAGE_SHARED_HEARTBEAT_SECONDS", "2"))
+
+
+def _shared_path(name: str) -> Optional[str]:
+    return os.path.join(ASKSAGE_SHARED_DIR, name) if ASKSAGE_SHARED_DIR else None
+
+
+def _per_worker(limit: int) -> int:
+    """Each worker's share of a proxy-wide limit (0, no limit, stays 0)."""
+    return -(-limit // ASKSAGE_WORKERS) if limit > 0 else limit
+
+# Upstream backends: `base_url|api_key|weight` entries (key and weight optional), e.g. one
+# server with several keys. Defaults to ASKSAGE_SERVER_BASE with ASKSAGE_API_KEY.
+ASKSAGE_BACKENDS = os.getenv("ASKSAGE_BACKENDS", "")
+ASKSAGE_BALANCING = os.getenv("ASKSAGE_BALANCING", "least_outstanding")
+# Consecutive failures (429/5xx/connection errors) before a backend is ejected, and the
+# initial ejection time (doubles on each ejection in a row, up to 5 minutes). 0 disables.
+ASKSAGE_EJECT_AFTER = int(os.getenv("ASKSAGE_EJECT_AFTER", "3"))
+ASKSAGE_EJECT_SECONDS = float(os.getenv("ASKSAGE_EJECT_SECONDS", "10"))
+
+# Per-endpoint circuit breaker: opens after consecutive failures (5xx/connection errors),
+# fails fast while open, then lets probe calls through. 0 disables it.
+ASKSAGE_BREAKER_FAILURES = int(os.getenv("ASKSAGE_BREAKER_FAILURES", "5"))
+ASKSAGE_BREAKER_OPEN_SECONDS = float(os.getenv("ASKSAGE_BREAKER_OPEN_SECONDS", "30"))
+ASKSAGE_BREAKER_HALF_OPEN_CALLS = int(os.getenv("ASKSAGE_BREAKER_HALF_OPEN_CALLS", "1"))
+
+# Retries of connection errors, 429 and 503, with full-jitter exponential backoff. Retries
+# (including failover to another backend) are limited to ASKSAGE_RETRY_BUDGET of recent
+# requests plus ASKSAGE_RETRY_MIN_PER_SECOND.
+ASKSAGE_RETRY_MAX = int(os.getenv("ASKSAGE_RETRY_MAX", "2"))
+ASKSAGE_RETRY_BACKOFF = float(os.getenv("ASKSAGE_RETRY_BACKOFF", "0.5"))
+ASKSAGE_RETRY_MAX_BACKOFF = float(os.getenv("ASKSAGE_RETRY_MAX_BACKOFF", "10"))
+ASKSAGE_RETRY_BUDGET = float(os.getenv("ASKSAGE_RETRY_BUDGET", "0.1"))
+ASKSAGE_RETRY_MIN_PER_SECOND = float(os.getenv("ASKSAGE_RETRY_MIN_PER_SECOND", "1"))
+
 # TLS / CA bundle handling
 ASKSAGE_VERIFY_TLS = _env_bool("ASKSAGE_VERIFY_TLS", True)
 ASKSAGE_CA_BUNDLE_PATH = os.getenv("ASKSAGE_CA_BUNDLE_PATH")  # optional path to PEM bundle
 
-# HTTP timeouts (seconds)
+# HTTP timeouts (seconds). HTTP_TIMEOUT is the default for each of the finer-grained phases.
 HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "120"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", str(HTTP_TIMEOUT)))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", str(HTTP_TIMEOUT)))
+HTTP_WRITE_TIMEOUT = float(os.getenv("HTTP_WRITE_TIMEOUT", str(HTTP_TIMEOUT)))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", str(HTTP_TIMEOUT)))
+
+# Upper bound for client-supplied deadlines (X-Request-Timeout header or body `timeout`)
+ASKSAGE_MAX_REQUEST_TIMEOUT = float(os.getenv("ASKSAGE_MAX_REQUEST_TIMEOUT", "600"))
+
+# Upstream connection pool
+ASKSAGE_POOL_MAX_CONNECTIONS = int(os.getenv("ASKSAGE_POOL_MAX_CONNECTIONS", "100"))
+ASKSAGE_POOL_MAX_KEEPALIVE = int(os.getenv("ASKSAGE_POOL_MAX_KEEPALIVE", "20"))
+ASKSAGE_POOL_KEEPALIVE_EXPIRY = float(os.getenv("ASKSAGE_POOL_KEEPALIVE_EXPIRY", "60"))
+ASKSAGE_HTTP2 = _env_bool("ASKSAGE_HTTP2", False)
+# Connections opened to ASKSAGE_SERVER_BASE at startup, before the proxy starts serving
+ASKSAGE_WARMUP_CONNECTIONS = int(os.getenv("ASKSAGE_WARMUP_CONNECTIONS", "0"))
+
+# Max chunk size when relaying binary upstream bodies (e.g. TTS audio) to the client
+ASKSAGE_STREAM_CHUNK_BYTES = int(os.getenv("ASKSAGE_STREAM_CHUNK_BYTES", str(64 * 1024)))
+
+# Content-addressed cache of /v1/audio/speech audio, enabled by setting a directory
+ASKSAGE_TTS_CACHE_DIR = os.getenv("ASKSAGE_TTS_CACHE_DIR")
+ASKSAGE_TTS_CACHE_MAX_BYTES = int(os.getenv("ASKSAGE_TTS_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Audio uploads (/v1/audio/transcriptions): maximum request body size (0 = unlimited),
+# enforced while the body is received, and the chunk size used to stream it upstream
+ASKSAGE_MAX_UPLOAD_BYTES = int(os.getenv("ASKSAGE_MAX_UPLOAD_BYTES", str(512 * 1024 * 1024)))
+ASKSAGE_UPLOAD_CHUNK_BYTES = int(os.getenv("ASKSAGE_UPLOAD_CHUNK_BYTES", str(256 * 1024)))
+
+# JSON bodies: maximum sizes (0 = unlimited), checked while the body is received so
+# oversized requests get a 413 before they are buffered and parsed in full
+ASKSAGE_MAX_CHAT_BODY_BYTES = int(os.getenv("ASKSAGE_MAX_CHAT_BODY_BYTES", str(32 * 1024 * 1024)))
+ASKSAGE_MAX_CHAT_MESSAGES = int(os.getenv("ASKSAGE_MAX_CHAT_MESSAGES", "10000"))
+# Per message, in bytes of JSON (role, content and any other fields)
+ASKSAGE_MAX_MESSAGE_BYTES = int(os.getenv("ASKSAGE_MAX_MESSAGE_BYTES", str(16 * 1024 * 1024)))
+ASKSAGE_MAX_SPEECH_BODY_BYTES = int(os.getenv("ASKSAGE_MAX_SPEECH_BODY_BYTES", str(1024 * 1024)))
+
+# Cache of /v1/audio/transcriptions results keyed by the upload's SHA-256 and the model.
+# Memory tier bounded by bytes; setting a path adds a SQLite tier that survives restarts.
+ASKSAGE_TRANSCRIPTION_CACHE = _env_bool("ASKSAGE_TRANSCRIPTION_CACHE", False)
+ASKSAGE_TRANSCRIPTION_CACHE_MAX_BYTES = int(os.getenv("ASKSAGE_TRANSCRIPTION_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+ASKSAGE_TRANSCRIPTION_CACHE_TTL = float(os.getenv("ASKSAGE_TRANSCRIPTION_CACHE_TTL", str(7 * 24 * 3600)))
+ASKSAGE_TRANSCRIPTION_CACHE_PATH = os.getenv("ASKSAGE_TRANSCRIPTION_CACHE_PATH") or _shared_path("transcription-cache.sqlite")
+ASKSAGE_TRANSCRIPTION_CACHE_DISK_MAX_BYTES = int(
+    os.getenv("ASKSAGE_TRANSCRIPTION_CACHE_DISK_MAX_BYTES", str(256 * 1024 * 1024))
+)
+
+# Streaming chat completions: keepalive comment interval while Ask Sage is generating,
+# and the approximate size (characters) of each content delta
+ASKSAGE_SSE_HEARTBEAT_SECONDS = float(os.getenv("ASKSAGE_SSE_HEARTBEAT_SECONDS", "10"))
+ASKSAGE_SSE_CHUNK_CHARS = int(os.getenv("ASKSAGE_SSE_CHUNK_CHARS", "256"))
+
+# Prompt building: per-model context budgets in estimated tokens (0 = no limit) and the
+# truncation policy applied when a conversation exceeds its budget
+ASKSAGE_DEFAULT_CONTEXT_TOKENS = int(os.getenv("ASKSAGE_DEFAULT_CONTEXT_TOKENS", "0"))
+ASKSAGE_MODEL_CONTEXT_TOKENS = _env_int_map("ASKSAGE_MODEL_CONTEXT_TOKENS")
+ASKSAGE_PROMPT_KEEP_SYSTEM = _env_bool("ASKSAGE_PROMPT_KEEP_SYSTEM", True)
+ASKSAGE_PROMPT_KEEP_FIRST_USER = _env_bool("ASKSAGE_PROMPT_KEEP_FIRST_USER", True)
+ASKSAGE_PROMPT_KEEP_RECENT_TURNS = int(os.getenv("ASKSAGE_PROMPT_KEEP_RECENT_TURNS", "0"))
+# Memory for flattened conversation prefixes (characters)
+ASKSAGE_PROMPT_MEMO_BYTES = int(os.getenv("ASKSAGE_PROMPT_MEMO_BYTES", str(32 * 1024 * 1024)))
+
+# OpenAI `n` (several choices per chat completion): the maximum accepted, how many of a
+# request's Ask Sage calls run at once, and what a failed choice does: "partial" returns
+# the choices that succeeded, "fail" fails the whole request
+ASKSAGE_MAX_N = int(os.getenv("ASKSAGE_MAX_N", "16"))
+ASKSAGE_N_CONCURRENCY = int(os.getenv("ASKSAGE_N_CONCURRENCY", "4"))
+ASKSAGE_N_FAILURE_POLICY = os.getenv("ASKSAGE_N_FAILURE_POLICY", "partial")
+
+# Model catalog cache (seconds). TTL 0 disables caching; the stale window is how long
+# an expired catalog keeps being served while a background refresh runs.
+ASKSAGE_MODELS_CACHE_TTL = float(os.getenv("ASKSAGE_MODELS_CACHE_TTL", "300"))
+ASKSAGE_MODELS_CACHE_STALE = float(os.getenv("ASKSAGE_MODELS_CACHE_STALE", "600"))
+
+# Opt-in cache of deterministic /query responses (temperature 0, no live search).
+# Memory tier is bounded by bytes; setting a path adds a SQLite tier that survives restarts.
+ASKSAGE_RESPONSE_CACHE = _env_bool("ASKSAGE_RESPONSE_CACHE", False)
+ASKSAGE_RESPONSE_CACHE_MAX_BYTES = int(os.getenv("ASKSAGE_RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+ASKSAGE_RESPONSE_CACHE_TTL = float(os.getenv("ASKSAGE_RESPONSE_CACHE_TTL", "3600"))
+ASKSAGE_RESPONSE_CACHE_PATH = os.getenv("ASKSAGE_RESPONSE_CACHE_PATH") or _shared_path("response-cache.sqlite")
+ASKSAGE_RESPONSE_CACHE_DISK_MAX_BYTES = int(os.getenv("ASKSAGE_RESPONSE_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Identical /query payloads in flight at the same time share one upstream call
+ASKSAGE_COALESCE_REQUESTS = _env_bool("ASKSAGE_COALESCE_REQUESTS", True)
+
+# Admission control for upstream /query calls. 0 disables a limit. Calls over the limits
+# wait in a bounded queue; a full queue or a wait past ASKSAGE_MAX_QUEUE_WAIT answers 429.
+ASKSAGE_MAX_CONCURRENCY = int(os.getenv("ASKSAGE_MAX_CONCURRENCY", "0"))
+ASKSAGE_MODEL_CONCURRENCY = _env_int_map("ASKSAGE_MODEL_CONCURRENCY")
+ASKSAGE_MAX_QUEUE = int(os.getenv("ASKSAGE_MAX_QUEUE", "100"))
+ASKSAGE_MAX_QUEUE_WAIT = float(os.getenv("ASKSAGE_MAX_QUEUE_WAIT", "30"))
+ASKSAGE_PRIORITIZE_STREAMING = _env_bool("ASKSAGE_PRIORITIZE_STREAMING", True)
+
+# Per-client limits and fair queuing. Clients are identified by ASKSAGE_CLIENT_ID_HEADER
+# when set and sent, else by their bearer token (a digest of it), else by address.
+ASKSAGE_CLIENT_ID_HEADER = os.getenv("ASKSAGE_CLIENT_ID_HEADER", "").strip().lower()
+# 0 disables a limit; the burst defaults to one second's worth of requests. The buckets
+# live in each worker and are not divided between workers: a client's connection stays
+# on one worker, so splitting them would give a keep-alive client 1/N of its quota.
+ASKSAGE_CLIENT_RPS = float(os.getenv("ASKSAGE_CLIENT_RPS", "0"))
+ASKSAGE_CLIENT_BURST = int(os.getenv("ASKSAGE_CLIENT_BURST", "0"))
+ASKSAGE_CLIENT_TOKENS_PER_MINUTE = int(os.getenv("ASKSAGE_CLIENT_TOKENS_PER_MINUTE", "0"))
+ASKSAGE_CLIENT_MAX_TRACKED = int(os.getenv("ASKSAGE_CLIENT_MAX_TRACKED", "10000"))
+# Shares of saturated upstream capacity, e.g. `web-ui=4,nightly-agent=1` (default 1)
+ASKSAGE_CLIENT_WEIGHTS = _env_int_map("ASKSAGE_CLIENT_WEIGHTS")
+
+# Shared secret for /admin/* endpoints; admin endpoints are disabled when unset
+ASKSAGE_ADMIN_TOKEN = os.getenv("ASKSAGE_ADMIN_TOKEN", "")
+
+# Response compression negotiated from Accept-Encoding: gzip, plus br and zstd when the
+# brotli / zstandard packages are installed. Codecs are listed in server preference order.
+ASKSAGE_COMPRESSION = _env_bool("ASKSAGE_COMPRESSION", True)
+ASKSAGE_COMPRESSION_MIN_BYTES = int(os.getenv("ASKSAGE_COMPRESSION_MIN_BYTES", "1024"))
+ASKSAGE_COMPRESSION_CODECS = [c.strip() for c in os.getenv("ASKSAGE_COMPRESSION_CODECS", "zstd,br,gzip").split(",") if c.strip()]
+ASKSAGE_COMPRESSION_LEVELS = _env_int_map("ASKSAGE_COMPRESSION_LEVELS")
+# Largest decompressed size of a request body sent with Content-Encoding gzip or zstd
+ASKSAGE_MAX_DECOMPRESSED_BYTES = int(os.getenv("ASKSAGE_MAX_DECOMPRESSED_BYTES", str(64 * 1024 * 1024)))
+# Ask Ask Sage for compressed responses (every codec httpx can decode); false sends identity
+ASKSAGE_UPSTREAM_COMPRESSION = _env_bool("ASKSAGE_UPSTREAM_COMPRESSION", True)
+
+# JSON-lines access log: "stdout", "stderr" or a file path; empty disables it (request
+# IDs are still assigned, echoed and forwarded upstream)
+ASKSAGE_ACCESS_LOG = os.getenv("ASKSAGE_ACCESS_LOG", "")
+# Fraction of successful requests logged; errors and slow requests are always logged
+ASKSAGE_ACCESS_LOG_SAMPLE_RATE = float(os.getenv("ASKSAGE_ACCESS_LOG_SAMPLE_RATE", "1.0"))
+ASKSAGE_ACCESS_LOG_SLOW_MS = float(os.getenv("ASKSAGE_ACCESS_LOG_SLOW_MS", "1000"))
+# Records waiting for the writer; past this, records are dropped (and counted)
+ASKSAGE_ACCESS_LOG_QUEUE = int(os.getenv("ASKSAGE_ACCESS_LOG_QUEUE", "10000"))
+# Also log prompt and answer sizes (characters and tokens, never content)
+ASKSAGE_ACCESS_LOG_SIZES = _env_bool("ASKSAGE_ACCESS_LOG_SIZES", False)
+
+# Per-phase durations (parse, prompt, admission, upstream, ...) in a Server-Timing header
+ASKSAGE_SERVER_TIMING = _env_bool("ASKSAGE_SERVER_TIMING", True)
+# On-demand profiles (X-Proxy-Profile header or POST /admin/profile, admin token required)
+ASKSAGE_PROFILE_INTERVAL_MS = float(os.getenv("ASKSAGE_PROFILE_INTERVAL_MS", "5"))
+ASKSAGE_PROFILE_MAX_SECONDS = float(os.getenv("ASKSAGE_PROFILE_MAX_SECONDS", "60"))
+
+# Batch API (/v1/files, /v1/batches): enabled by setting a directory for uploads,
+# results and checkpoints (batches left running resume from it on restart)
+ASKSAGE_BATCH_DIR = os.getenv("ASKSAGE_BATCH_DIR")
+ASKSAGE_BATCH_MAX_FILE_BYTES = int(os.getenv("ASKSAGE_BATCH_MAX_FILE_BYTES", str(200 * 1024 * 1024)))
+# Requests of all batches in flight at once (each also takes an admission slot)
+ASKSAGE_BATCH_WORKERS = int(os.getenv("ASKSAGE_BATCH_WORKERS", "4"))
+ASKSAGE_BATCH_CHECKPOINT_SECONDS = float(os.getenv("ASKSAGE_BATCH_CHECKPOINT_SECONDS", "5"))
+# Attempts per request when Ask Sage (or admission control) answers 429/503
+ASKSAGE_BATCH_MAX_ATTEMPTS = int(os.getenv("ASKSAGE_BATCH_MAX_ATTEMPTS", "5"))
 
 if not ASKSAGE_API_KEY:
     # Allow container to start but fail requests with a clean error
     pass
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+logger = logging.getLogger(APP_NAME)
+
+access_log = (
+    AccessLog(
+        open_sink(ASKSAGE_ACCESS_LOG),
+        sample_rate=ASKSAGE_ACCESS_LOG_SAMPLE_RATE,
+        slow_seconds=ASKSAGE_ACCESS_LOG_SLOW_MS / 1000,
+        sizes=ASKSAGE_ACCESS_LOG_SIZES,
+        max_queue=ASKSAGE_ACCESS_LOG_QUEUE,
+    )
+    if ASKSAGE_ACCESS_LOG
+    else None
+)
+
+
+def _build_http_client() -> httpx.AsyncClient:
     verify: Union[bool, str] = ASKSAGE_VERIFY_TLS
     if ASKSAGE_CA_BUNDLE_PATH:
         verify = ASKSAGE_CA_BUNDLE_PATH
 
-    app.state.http_client = httpx.AsyncClient(timeout=HTTP_TIMEOUT, verify=verify)
+    http2 = ASKSAGE_HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("ASKSAGE_HTTP2 is set but the h2 package is not installed; using HTTP/1.1")
+        http2 = False
+
+    return httpx.AsyncClient(
+        verify=verify,
+        http2=http2,
+        # httpx's default Accept-Encoding already lists every codec it can decode
+        headers=None if ASKSAGE_UPSTREAM_COMPRESSION else {"Accept-Encoding": "identity"},
+        timeout=httpx.Timeout(
+            HTTP_TIMEOUT,
+            connect=HTTP_CONNECT_TIMEOUT,
+            read=HTTP_READ_TIMEOUT,
+            write=HTTP_WRITE_TIMEOUT,
+            pool=HTTP_POOL_TIMEOUT,
+        ),
+        limits=httpx.Limits(
+            max_connections=ASKSAGE_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=ASKSAGE_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=ASKSAGE_POOL_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+async def _warm_up_pool(client: httpx.AsyncClient, connections: int) -> Dict[str, Any]:
+    """
+    Pre-open `connections` keep-alive (TLS) connections to each Ask Sage server by issuing
+    that many concurrent HEAD requests. Any response status counts; failures are only logged.
+    """
+    if connections <= 0:
+        return {"connections": 0, "ok": 0, "seconds": 0.0}
+
+    async def probe(base_url: str) -> bool:
+        try:
+            await client.head(base_url)
+            return True
+        except httpx.HTTPError as e:
+            logger.warning("Connection warm-up to %s failed: %r", base_url, e)
+            return False
+
+    base_urls = dict.fromkeys(b.base_url for b in upstream_pool.backends)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(probe(url) for url in base_urls for _ in range(connections)))
+    return {"connections": connections, "ok": sum(results), "seconds": round(time.perf_counter() - started, 3)}
+
+
+def _pool_stats(client: Optional[httpx.AsyncClient]) -> Dict[str, Any]:
+    """
+    Utilization of the upstream connection pool (reads httpcore's pool state).
+    """
+    out: Dict[str, Any] = {
+        "max_connections": ASKSAGE_POOL_MAX_CONNECTIONS,
+        "max_keepalive_connections": ASKSAGE_POOL_MAX_KEEPALIVE,
+        "keepalive_expiry": ASKSAGE_POOL_KEEPALIVE_EXPIRY,
+        "http2": ASKSAGE_HTTP2,
+    }
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    if pool is None:
+        return out
+    connections = list(getattr(pool, "connections", []))
+    idle = sum(1 for c in connections if c.is_idle())
+    requests = len(getattr(pool, "_requests", []))
+    out.update(
+        connections=len(connections),
+        idle=idle,
+        busy=len(connections) - idle,
+        http2_connections=sum(1 for c in connections if "HTTP/2" in c.info()),
+        requests=requests,
+    )
+    return out
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.http_client = _build_http_client()
+    # Runs before the server accepts connections, so /healthz only answers once it's done
+    app.state.warmup = await _warm_up_pool(app.state.http_client, ASKSAGE_WARMUP_CONNECTIONS)
+    if batch_runner is not None:
+        await batch_runner.start()
+    heartbeat = asyncio.create_task(_publish_worker_state()) if shared_state is not None else None
     yield
+    if batch_runner is not None:
+        # Checkpoints running batches; they resume on the next start (or in another worker)
+        await batch_runner.stop()
+    if heartbeat is not None:
+        heartbeat.cancel()
+        await asyncio.gather(heartbeat, return_exceptions=True)
+        await asyncio.to_thread(shared_state.remove)
     await app.state.http_client.aclose()
+    # Later calls (e.g. after a test's lifespan exits) fall back to a one-off client
+    del app.state.http_client
+    for cache in (response_cache, transcription_cache, tts_cache, shared_state):
+        if cache is not None:
+            cache.close()
+    if access_log is not None:
+        await asyncio.to_thread(access_log.close)
+
+app = FastAPI(title=APP_NAME, version="HEAD", lifespan=lifespan, default_response_class=FastJSONResponse)
+
+
+def _body_limits() -> Dict[str, int]:
+    return {
+        "/v1/audio/transcriptions": ASKSAGE_MAX_UPLOAD_BYTES,
+        "/v1/files": ASKSAGE_BATCH_MAX_FILE_BYTES,
+        "/v1/chat/completions": ASKSAGE_MAX_CHAT_BODY_BYTES,
+        "/v1/audio/speech": ASKSAGE_MAX_SPEECH_BODY_BYTES,
+    }
+
+
+app.add_middleware(BodySizeLimitMiddleware, limits=_body_limits)
+app.add_middleware(RateLimitHeadersMiddleware)
 
-app = FastAPI(title=APP_NAME, version="HEAD", lifespan=lifespan)
+
+def _admin_denied(headers: Any) -> Optional[int]:
+    """None when `headers` carry the admin token, else the status to answer with."""
+    if not ASKSAGE_ADMIN_TOKEN:
+        return 404
+    token = headers.get("x-admin-token", "")
+    if not hmac.compare_digest(token.encode("utf-8"), ASKSAGE_ADMIN_TOKEN.encode("utf-8")):
+        return 403
+    return None
+
+
+profiles = ProfileStore()
+app.add_middleware(ServerTimingMiddleware, enabled=lambda: ASKSAGE_SERVER_TIMING)
+app.add_middleware(
+    RequestProfilerMiddleware,
+    store=profiles,
+    authorize=lambda headers: _admin_denied(headers),
+    interval=lambda: ASKSAGE_PROFILE_INTERVAL_MS / 1000,
+)
+
+
+def _compression_settings() -> Dict[str, Any]:
+    available = available_codecs()
+    return {
+        "enabled": ASKSAGE_COMPRESSION,
+        "minimum_size": ASKSAGE_COMPRESSION_MIN_BYTES,
+        "codecs": [c for c in ASKSAGE_COMPRESSION_CODECS if c in available],
+        "levels": ASKSAGE_COMPRESSION_LEVELS,
+        "max_decompressed_bytes": ASKSAGE_MAX_DECOMPRESSED_BYTES,
+    }
+
+
+app.add_middleware(CompressionMiddleware, settings=_compression_settings)
+
+metrics = Registry()
+app.add_middleware(MetricsMiddleware, registry=metrics)
+# Outermost, so the logged duration and sizes cover everything else
+app.add_middleware(AccessLogMiddleware, log=lambda: access_log)
+
+UPSTREAM_REQUESTS = metrics.counter(
+    "asksage_proxy_upstream_requests_total", "Ask Sage calls by path and status", ("path", "status")
+)
+UPSTREAM_DURATION = metrics.histogram(
+    "asksage_proxy_upstream_duration_seconds", "Ask Sage call latency (until response headers)", ("path",)
+)
+UPSTREAM_IN_FLIGHT = metrics.gauge("asksage_proxy_upstream_in_flight", "Ask Sage calls in flight", ("path",))
+PROMPT_CHARS = metrics.histogram(
+    "asksage_proxy_prompt_chars", "Size of flattened chat prompts (characters)", buckets=SIZE_BUCKETS
+)
+ABANDONED = metrics.counter(
+    "asksage_proxy_abandoned_requests_total",
+    "Chat completions whose upstream wait was cut short",
+    ("reason",),
+)
+TOKENS = metrics.counter("asksage_proxy_tokens_total", "Token usage reported by Ask Sage", ("type",))
+
+
+def _collect_component_metrics() -> List[Any]:
+    """Expose component counters kept elsewhere (caches, admission) at scrape time."""
+    out = []
+    g = Gauge("asksage_proxy_admission_queue_depth", "Upstream calls waiting for an admission slot")
+    g.set(admission.stats()["queue_depth"])
+    out.append(g)
+    g = Gauge("asksage_proxy_admission_active", "Upstream calls holding an admission slot")
+    g.set(admission.active)
+    out.append(g)
+    c = Counter("asksage_proxy_admission_rejected_total", "Calls rejected by admission control", ("reason",))
+    c.inc(admission.rejected_full, ("queue_full",))
+    c.inc(admission.rejected_timeout, ("queue_timeout",))
+    out.append(c)
+    c = Counter("asksage_proxy_rate_limited_total", "Requests rejected by per-client rate limits", ("limit",))
+    c.inc(rate_limiter.limited_requests, ("requests",))
+    c.inc(rate_limiter.limited_tokens, ("tokens",))
+    out.append(c)
+    g = Gauge("asksage_proxy_rate_limit_clients", "Clients with rate-limit state")
+    g.set(rate_limiter.stats()["clients"])
+    out.append(g)
+    g = Gauge("asksage_proxy_backend_ejected", "Whether an Ask Sage backend is currently ejected", ("backend",))
+    c = Counter("asksage_proxy_backend_failures_total", "Failed calls per Ask Sage backend", ("backend", "reason"))
+    for b in upstream_pool.stats()["backends"]:
+        g.set(float(b["ejected"]), (b["name"],))
+        c.inc(b["throttled"], (b["name"], "throttled"))
+        c.inc(b["server_errors"], (b["name"], "server_error"))
+        c.inc(b["transport_errors"], (b["name"], "transport_error"))
+    out.extend((g, c))
+    g = Gauge("asksage_proxy_circuit_open", "Whether an Ask Sage endpoint's circuit breaker is open", ("path",))
+    c = Counter("asksage_proxy_circuit_rejected_total", "Calls failed fast by an open circuit breaker", ("path",))
+    for path, breaker in upstream_breakers.items():
+        g.set(float(breaker.state == "open"), (path,))
+        c.inc(breaker.rejected, (path,))
+    out.extend((g, c))
+    c = Counter("asksage_proxy_upstream_retries_total", "Ask Sage calls retried", ("result",))
+    c.inc(retry_budget.retries, ("retried",))
+    c.inc(retry_budget.exhausted, ("budget_exhausted",))
+    out.append(c)
+    c = Counter("asksage_proxy_models_cache_total", "Model catalog lookups", ("result",))
+    c.inc(model_catalog.hits, ("hit",))
+    c.inc(model_catalog.stale_hits, ("stale",))
+    c.inc(model_catalog.misses, ("miss",))
+    out.append(c)
+    c = Counter("asksage_proxy_query_coalesced_total", "Chat completions served by joining an in-flight call")
+    c.inc(query_flight.shared)
+    out.append(c)
+    if transcription_cache is not None:
+        c = Counter("asksage_proxy_transcription_cache_total", "Transcription cache lookups", ("result",))
+        c.inc(transcription_cache.hits, ("hit",))
+        c.inc(transcription_cache.misses, ("miss",))
+        c.inc(transcription_flight.shared, ("coalesced",))
+        out.append(c)
+    if tts_cache is not None:
+        c = Counter("asksage_proxy_tts_cache_total", "Speech audio cache lookups", ("result",))
+        c.inc(tts_cache.hits, ("hit",))
+        c.inc(tts_cache.misses, ("miss",))
+        out.append(c)
+    if response_cache is not None:
+        c = Counter("asksage_proxy_response_cache_total", "Response cache lookups", ("result",))
+        c.inc(response_cache.hits, ("hit",))
+        c.inc(response_cache.misses, ("miss",))
+        c.inc(response_cache.bypassed, ("bypass",))
+        out.append(c)
+        c = Counter("asksage_proxy_response_cache_evictions_total", "Response cache evictions")
+        c.inc(response_cache.evictions)
+        out.append(c)
+    if access_log is not None:
+        c = Counter("asksage_proxy_access_log_records_total", "Access log records", ("result",))
+        c.inc(access_log.written, ("written",))
+        c.inc(access_log.dropped, ("dropped",))
+        c.inc(access_log.sampled_out, ("sampled_out",))
+        out.append(c)
+    if batch_runner is not None:
+        c = Counter("asksage_proxy_batch_requests_total", "Batch API requests finished", ("result",))
+        c.inc(batch_runner.requests_completed, ("completed",))
+        c.inc(batch_runner.requests_failed, ("failed",))
+        out.append(c)
+        g = Gauge("asksage_proxy_batch_requests_in_flight", "Batch API requests being executed")
+        g.set(batch_runner.stats()["in_flight"])
+        out.append(g)
+    return out
+
+
+metrics.add_collector(_collect_component_metrics)
+
+
+shared_state: Optional[SharedState] = None
+if ASKSAGE_SHARED_DIR:
+    os.makedirs(ASKSAGE_SHARED_DIR, exist_ok=True)
+    shared_state = SharedState(
+        os.path.join(ASKSAGE_SHARED_DIR, "workers.sqlite"),
+        worker_id=f"{os.getpid()}",
+        stale_after=5 * ASKSAGE_SHARED_HEARTBEAT_SECONDS,
+    )
+
+
+def _worker_health() -> Dict[str, Any]:
+    """Compact state of this worker, published for the `workers` list of /healthz."""
+    in_flight = metrics.find("asksage_proxy_requests_in_flight")
+    admission_stats = admission.stats()
+    return {
+        "requests_in_flight": int(in_flight.values.get((), 0)) if in_flight is not None else 0,
+        "upstream_in_flight": int(sum(UPSTREAM_IN_FLIGHT.values.values())),
+        "admission_active": admission_stats["active"],
+        "admission_queue_depth": admission_stats["queue_depth"],
+        "batch_owner": batch_runner.owner if batch_runner is not None else False,
+    }
+
+
+async def _publish_worker_state() -> None:
+    while True:
+        try:
+            await asyncio.to_thread(shared_state.publish, _worker_health(), metrics.snapshot())
+        except Exception:
+            logger.exception("Publishing worker state failed")
+        await asyncio.sleep(ASKSAGE_SHARED_HEARTBEAT_SECONDS)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics() -> Response:
+    """Metrics of this process, or of every worker (added up) when they share state."""
+    if shared_state is None:
+        body = await asyncio.to_thread(metrics.render)
+    else:
+        # Publish a fresh snapshot of this worker first; the others are at most a heartbeat old
+        await asyncio.to_thread(shared_state.publish, _worker_health(), metrics.snapshot())
+        workers = await asyncio.to_thread(shared_state.workers)
+        body = render_metrics(merge_snapshots(w["metrics"] for w in workers))
+    return Response(body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _workers_summary() -> Optional[List[Dict[str, Any]]]:
+    if shared_state is None:
+        return None
+    return [
+        dict(w["health"], id=w["id"], pid=w["pid"], started_at=int(w["started_at"]), age=w["age"])
+        for w in shared_state.workers()
+    ]
+
+
+def _transcription_cache_stats() -> Optional[Dict[str, Any]]:
+    if transcription_cache is None:
+        return None
+    stats = transcription_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    return dict(
+        stats,
+        hit_ratio=round(stats["hits"] / lookups, 4) if lookups else 0.0,
+        coalesced=transcription_flight.shared,
+        bytes_not_uploaded=int(TRANSCRIPTION_BYTES_SAVED.values.get((), 0)),
+    )
 
 
 @app.get("/healthz")
@@ -55,88 +612,280 @@ def healthz() -> Dict[str, Any]:
         "status": "ok",
         "service": APP_NAME,
         "time": int(time.time()),
+        "worker": {"pid": os.getpid(), "workers": ASKSAGE_WORKERS},
+        "workers": _workers_summary(),
         "asksage_server_base": ASKSAGE_SERVER_BASE,
         "tls_verify": ASKSAGE_VERIFY_TLS,
+        "http_pool": _pool_stats(getattr(app.state, "http_client", None)),
+        "warmup": getattr(app.state, "warmup", None),
+        "models_cache": model_catalog.stats(),
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "tts_cache": tts_cache.stats() if tts_cache is not None else None,
+        "transcription_cache": _transcription_cache_stats(),
+        "upstream": upstream_pool.stats(),
+        "circuit_breakers": {path: b.stats() for path, b in upstream_breakers.items()},
+        "retries": retry_budget.stats(),
+        "admission": admission.stats(),
+        "rate_limits": rate_limiter.stats() if rate_limiter.enabled else None,
+        "access_log": access_log.stats() if access_log is not None else None,
+        "prompt_builder": prompt_builder.stats(),
+        "batches": batch_runner.stats() if batch_runner is not None else None,
+        "query_coalescing": {
+            "enabled": ASKSAGE_COALESCE_REQUESTS,
+            "in_flight": query_flight.in_flight(),
+            "upstream_calls": query_flight.started,
+            "coalesced": query_flight.shared,
+        },
     }
 
 
+async def _read_json_body(req: Request, scanner: Optional[MessageScanner] = None) -> Dict[str, Any]:
+    """
+    Decode a JSON object request body straight from bytes (parsed once). The raw body
+    is only referenced here, so it is freed as soon as it has been parsed.
+    """
+    try:
+        with phase("parse"):
+            body = loads(await read_body(req.stream(), scanner))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body is not valid JSON")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+    return body
+
+
+def _require_admin(req: Request) -> None:
+    denied = _admin_denied(req.headers)
+    if denied == 404:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if denied is not None:
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+prompt_builder = PromptBuilder(
+    memo_max_bytes=ASKSAGE_PROMPT_MEMO_BYTES,
+    keep_system=ASKSAGE_PROMPT_KEEP_SYSTEM,
+    keep_first_user=ASKSAGE_PROMPT_KEEP_FIRST_USER,
+    keep_recent_turns=ASKSAGE_PROMPT_KEEP_RECENT_TURNS,
+)
+
+
 def openai_messages_to_prompt(messages: List[Dict[str, Any]]) -> str:
     """
     Ask Sage /query supports either a simple string or a very limited conversation array.
     To maximize compatibility with OpenAI clients, we translate the message list into a
     single prompt string with clear role markers.
     """
-    system_parts: List[str] = []
-    convo_parts: List[str] = []
-    for m in messages:
-        role = (m.get("role") or "").lower()
-        content = m.get("content")
-        # OpenAI allows content to be str OR a list of parts (text/images)
-        if isinstance(content, list):
-            # keep only text parts
-            text_chunks = []
-            for part in content:
-                if isinstance(part, dict) and part.get("type") == "text" and "text" in part:
-                    text_chunks.append(str(part["text"]))
-            content_str = "\n".join(text_chunks).strip()
-        else:
-            content_str = "" if content is None else str(content)
-
-        if role == "system":
-            if content_str:
-                system_parts.append(content_str)
-        elif role == "user":
-            convo_parts.append(f"User: {content_str}".strip())
-        elif role == "assistant":
-            convo_parts.append(f"Assistant: {content_str}".strip())
+    return prompt_builder.build(messages).prompt
+
+
+def _prompt_budget(model: str, body: Dict[str, Any]) -> int:
+    """Estimated tokens available to the prompt: the model's context minus the requested completion."""
+    context = ASKSAGE_MODEL_CONTEXT_TOKENS.get(model, ASKSAGE_DEFAULT_CONTEXT_TOKENS)
+    if not context:
+        return 0
+    completion = body.get("max_completion_tokens") or body.get("max_tokens") or 0
+    try:
+        completion = int(completion)
+    except (TypeError, ValueError):
+        completion = 0
+    return max(1, context - max(0, completion))
+
+upstream_pool = BackendPool(
+    parse_backends(ASKSAGE_BACKENDS, ASKSAGE_API_KEY) or [Backend(ASKSAGE_SERVER_BASE, ASKSAGE_API_KEY)],
+    strategy=ASKSAGE_BALANCING,
+    eject_after=ASKSAGE_EJECT_AFTER,
+    eject_seconds=ASKSAGE_EJECT_SECONDS,
+)
+
+upstream_breakers: Dict[str, CircuitBreaker] = {}
+retry_budget = RetryBudget(ratio=ASKSAGE_RETRY_BUDGET, min_per_second=ASKSAGE_RETRY_MIN_PER_SECOND / ASKSAGE_WORKERS)
+
+# Failures where Ask Sage did not process the request, so it is safe to send it again
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+RETRYABLE_STATUS = (429, 503)
+
+
+def _breaker(path: str) -> CircuitBreaker:
+    breaker = upstream_breakers.get(path)
+    if breaker is None:
+        breaker = upstream_breakers[path] = CircuitBreaker(
+            ASKSAGE_BREAKER_FAILURES, ASKSAGE_BREAKER_OPEN_SECONDS, ASKSAGE_BREAKER_HALF_OPEN_CALLS
+        )
+    return breaker
+
+
+def _retry_after_seconds(resp: httpx.Response) -> Optional[float]:
+    try:
+        return float(resp.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+async def _send_to_backend(
+    client: httpx.AsyncClient, backend: Backend, path: str, headers: Dict[str, str], stream: bool, request_kwargs: Dict[str, Any]
+) -> httpx.Response:
+    """One attempt against one backend, recorded in the upstream metrics and the pool."""
+    if not backend.api_key:
+        raise HTTPException(status_code=500, detail="ASKSAGE_API_KEY is not set")
+
+    labels = (path,)
+    started = time.perf_counter()
+    status = "error"
+    code: Optional[int] = None
+    failed = False
+    UPSTREAM_IN_FLIGHT.inc(1.0, labels)
+    upstream_pool.start(backend)
+    timing = current_timing()
+    rid = request_id()
+    if rid is not None:
+        headers = {**headers, "x-request-id": rid}
+    try:
+        request = client.build_request(
+            "POST",
+            backend.base_url + path.lstrip("/"),
+            headers={**headers, "x-access-tokens": backend.api_key},
+            extensions={"trace": UpstreamTrace(timing)} if timing is not None else None,
+            **request_kwargs,
+        )
+        resp = await client.send(request, stream=stream)
+        status = str(resp.status_code)
+        code = resp.status_code
+        return resp
+    except httpx.TransportError as e:
+        failed = True
+        if isinstance(e, httpx.TimeoutException):
+            status = "timeout"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        if timing is not None:
+            timing.add("upstream", elapsed)
+        UPSTREAM_IN_FLIGHT.dec(1.0, labels)
+        UPSTREAM_DURATION.observe(elapsed, labels)
+        access_add(upstream_calls=1, upstream_ms=round(elapsed * 1000, 3))
+        access_annotate(upstream_status=status, backend=backend.name)
+        UPSTREAM_REQUESTS.inc(1.0, (path, status))
+        if code is not None or failed:
+            upstream_pool.finish(backend, code, elapsed)
         else:
-            # unknown role -> treat as user
-            convo_parts.append(f"User: {content_str}".strip())
+            # Cancelled (client went away) or failed locally: says nothing about the backend
+            upstream_pool.release(backend)
 
-    prompt = ""
-    if system_parts:
-        prompt += "System:\n" + "\n\n".join(system_parts).strip() + "\n\n"
-    prompt += "\n".join(convo_parts).strip()
 
-    # Nudge toward next assistant turn
-    if prompt and not prompt.endswith("\n"):
-        prompt += "\n"
-    prompt += "Assistant:"
-    return prompt
+async def _upstream_send(
+    path: str,
+    headers: Dict[str, str],
+    stream: bool = False,
+    read_timeout: Optional[float] = None,
+    **request_kwargs: Any,
+) -> Tuple[httpx.Response, Optional[httpx.AsyncClient]]:
+    """
+    Send one POST to Ask Sage, on a backend picked by `upstream_pool`, and record upstream
+    metrics. The API key header is added per backend.
+
+    Connection failures and 429/503 answers (Ask Sage didn't process the request) are
+    retried on each other backend, then up to ASKSAGE_RETRY_MAX more rounds with jittered
+    backoff, as long as the retry budget allows. While the endpoint's circuit breaker is
+    open, calls fail fast with 503. `read_timeout` replaces HTTP_READ_TIMEOUT for
+    this call (client-supplied deadlines). Timeouts are mapped to 504 and other transport
+    errors to 502.
+
+    Uses the persistent client from app state, or a one-off client if the lifespan
+    hasn't run. For `stream=True` the body is left unread and the one-off client (if
+    any) is returned so the caller can close it with the response; otherwise it is
+    closed here and None is returned.
+    """
+    breaker = _breaker(path)
+    try:
+        probe = breaker.before_call()
+    except CircuitOpen as e:
+        raise HTTPException(
+            status_code=503,
+            detail=f"AskSage {path} is failing; circuit breaker open",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    retry_budget.record_request()
 
+    owned_client: Optional[httpx.AsyncClient] = None
+    if hasattr(app.state, "http_client"):
+        client = app.state.http_client
+    else:
+        client = owned_client = _build_http_client()
 
-async def asksage_post(path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    if read_timeout is not None:
+        request_kwargs["timeout"] = client.timeout.as_dict() | {"read": read_timeout}
+    tried: List[Backend] = []
+    retries = 0
+    try:
+        while True:
+            backend = upstream_pool.select(exclude=tried)
+            tried.append(backend)
+            error: Optional[Exception] = None
+            try:
+                resp = await _send_to_backend(client, backend, path, headers, stream, request_kwargs)
+            except RETRYABLE_ERRORS as e:
+                error = e
+            else:
+                if resp.status_code not in RETRYABLE_STATUS:
+                    break
+
+            # Another backend is tried right away; once all have been, back off and start over
+            failover = upstream_pool.has_alternative(tried)
+            if (not failover and retries >= ASKSAGE_RETRY_MAX) or not retry_budget.try_withdraw():
+                if error is not None:
+                    raise error
+                break
+            reason = repr(error) if error is not None else f"HTTP {resp.status_code}"
+            retry_after = None
+            if error is None:
+                retry_after = _retry_after_seconds(resp)
+                await resp.aclose()
+            if failover:
+                logger.warning("Ask Sage backend %s failed (%s); retrying on another backend", backend.name, reason)
+                continue
+            retries += 1
+            delay = backoff_delay(retries, ASKSAGE_RETRY_BACKOFF, ASKSAGE_RETRY_MAX_BACKOFF, retry_after)
+            logger.warning("Ask Sage %s failed (%s); retry %d in %.2fs", path, reason, retries, delay)
+            with phase("backoff"):
+                await asyncio.sleep(delay)
+            tried = []
+    except BaseException as e:
+        if owned_client is not None:
+            await owned_client.aclose()
+        if isinstance(e, httpx.TransportError):
+            breaker.record(False, probe)
+        else:
+            breaker.release(probe)
+        if isinstance(e, httpx.TimeoutException):
+            raise HTTPException(status_code=504, detail=f"AskSage request timed out: {type(e).__name__}")
+        if isinstance(e, httpx.TransportError):
+            raise HTTPException(status_code=502, detail=f"AskSage request failed: {type(e).__name__}")
+        raise
+
+    breaker.record(resp.status_code < 500, probe)
+    if owned_client is not None and not stream:
+        await owned_client.aclose()
+        owned_client = None
+    return resp, owned_client
+
+
+async def asksage_post(path: str, payload: Dict[str, Any], read_timeout: Optional[float] = None) -> Dict[str, Any]:
     """
     POST to Ask Sage Server API.
 
     Authentication: Ask Sage uses `x-access-tokens` header carrying either a static API key
     or a 24-hour access token. See Ask Sage Server API docs.  citeturn3view0
     """
-    if not ASKSAGE_API_KEY:
-        raise HTTPException(status_code=500, detail="ASKSAGE_API_KEY is not set")
-
-    url = ASKSAGE_SERVER_BASE + path.lstrip("/")
     headers = {
-        "x-access-tokens": ASKSAGE_API_KEY,
         "Content-Type": "application/json",
         "Accept": "application/json",
     }
-
-    # Use the persistent client from app state
-    if hasattr(app.state, "http_client"):
-        client = app.state.http_client
-        resp = await client.post(url, headers=headers, json=payload)
-    else:
-        # Fallback if lifespan not run
-        verify: Union[bool, str] = ASKSAGE_VERIFY_TLS
-        if ASKSAGE_CA_BUNDLE_PATH:
-            verify = ASKSAGE_CA_BUNDLE_PATH
-        async with httpx.AsyncClient(timeout=HTTP_TIMEOUT, verify=verify) as client:
-            resp = await client.post(url, headers=headers, json=payload)
+    resp, _ = await _upstream_send(path, headers, read_timeout=read_timeout, json=payload)
 
     # Ask Sage errors are typically JSON with message + status
     try:
-        data = resp.json()
+        data = loads(resp.content)
     except Exception:
         data = {"raw": resp.text}
     if resp.status_code >= 400:
@@ -153,60 +902,68 @@ async def asksage_post(path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
     return {"data": data}
 
 
-async def asksage_post_bytes(path: str, payload: Dict[str, Any]) -> bytes:
+class UpstreamStream:
     """
-    POST to Ask Sage Server API and return binary content.
+    An open Ask Sage response whose body hasn't been read yet.
+
+    Iterating relays the body in chunks of at most `chunk_size` bytes; `aclose()` releases
+    the upstream connection (and the fallback client, if one had to be created).
     """
-    if not ASKSAGE_API_KEY:
-        raise HTTPException(status_code=500, detail="ASKSAGE_API_KEY is not set")
 
-    url = ASKSAGE_SERVER_BASE + path.lstrip("/")
+    def __init__(self, response: httpx.Response, owned_client: Optional[httpx.AsyncClient] = None) -> None:
+        self.response = response
+        self._owned_client = owned_client
+
+    async def iter_bytes(self, chunk_size: int) -> AsyncGenerator[bytes, None]:
+        try:
+            async for chunk in self.response.aiter_bytes(chunk_size=chunk_size):
+                yield chunk
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        await self.response.aclose()
+        if self._owned_client is not None:
+            await self._owned_client.aclose()
+            self._owned_client = None
+
+
+async def asksage_post_stream(path: str, payload: Dict[str, Any]) -> UpstreamStream:
+    """
+    POST to Ask Sage Server API and return the response with its body still unread.
+
+    Upstream errors are mapped to HTTPException here, before any byte reaches the client.
+    """
     headers = {
-        "x-access-tokens": ASKSAGE_API_KEY,
         "Content-Type": "application/json",
     }
-
-    if hasattr(app.state, "http_client"):
-        client = app.state.http_client
-        resp = await client.post(url, headers=headers, json=payload)
-    else:
-        verify: Union[bool, str] = ASKSAGE_VERIFY_TLS
-        if ASKSAGE_CA_BUNDLE_PATH:
-            verify = ASKSAGE_CA_BUNDLE_PATH
-        async with httpx.AsyncClient(timeout=HTTP_TIMEOUT, verify=verify) as client:
-            resp = await client.post(url, headers=headers, json=payload)
+    resp, owned_client = await _upstream_send(path, headers, stream=True, json=payload)
+    stream = UpstreamStream(resp, owned_client)
 
     if resp.status_code >= 400:
-        raise HTTPException(status_code=502, detail=f"AskSage request failed: {resp.status_code} {resp.text}")
+        try:
+            await resp.aread()
+            text = resp.text
+        finally:
+            await stream.aclose()
+        raise HTTPException(status_code=502, detail=f"AskSage request failed: {resp.status_code} {text}")
 
-    return resp.content
+    return stream
 
 
-async def asksage_post_multipart(path: str, files: Dict[str, Any], data: Dict[str, Any] = None) -> Dict[str, Any]:
+async def asksage_post_multipart(path: str, files: Dict[str, UploadFile], data: Dict[str, Any] = None) -> Dict[str, Any]:
     """
     POST to Ask Sage Server API with multipart/form-data.
-    """
-    if not ASKSAGE_API_KEY:
-        raise HTTPException(status_code=500, detail="ASKSAGE_API_KEY is not set")
 
-    url = ASKSAGE_SERVER_BASE + path.lstrip("/")
-    headers = {
-        "x-access-tokens": ASKSAGE_API_KEY,
-        # Content-Type is set by httpx when using files
-    }
-
-    if hasattr(app.state, "http_client"):
-        client = app.state.http_client
-        resp = await client.post(url, headers=headers, files=files, data=data)
-    else:
-        verify: Union[bool, str] = ASKSAGE_VERIFY_TLS
-        if ASKSAGE_CA_BUNDLE_PATH:
-            verify = ASKSAGE_CA_BUNDLE_PATH
-        async with httpx.AsyncClient(timeout=HTTP_TIMEOUT, verify=verify) as client:
-            resp = await client.post(url, headers=headers, files=files, data=data)
+    The body is streamed from the spooled uploads in ASKSAGE_UPLOAD_CHUNK_BYTES chunks,
+    so the files are never held in memory in full.
+    """
+    body = MultipartStream(files, data, chunk_size=ASKSAGE_UPLOAD_CHUNK_BYTES, max_file_bytes=ASKSAGE_MAX_UPLOAD_BYTES)
+    headers = body.headers()
+    resp, _ = await _upstream_send(path, headers, content=body)
 
     try:
-        response_data = resp.json()
+        response_data = loads(resp.content)
     except Exception:
         response_data = {"raw": resp.text}
 
@@ -222,13 +979,9 @@ async def asksage_post_multipart(path: str, files: Dict[str, Any], data: Dict[st
     return response_data
 
 
-@app.get("/v1/models")
-@app.get("/v1/models/")
-async def v1_models() -> JSONResponse:
+async def _fetch_models() -> List[Dict[str, Any]]:
     """
-    OpenAI-compatible models listing.
-
-    Backed by Ask Sage /get-models.  citeturn1view1
+    Load and normalize the model list from Ask Sage /get-models.  citeturn1view1
     """
     data = await asksage_post("get-models", payload={})
     # Expected format: {object: "list", data: [{id,name,...}, ...]}
@@ -236,35 +989,135 @@ async def v1_models() -> JSONResponse:
     for m in (data.get("data") or []):
         mid = m.get("id") or m.get("name") or "unknown"
         models.append({"id": mid, "object": "model", "owned_by": m.get("owned_by", "asksage")})
+    return models
+
+
+model_catalog = ModelCatalog(_fetch_models, ttl=ASKSAGE_MODELS_CACHE_TTL, stale_ttl=ASKSAGE_MODELS_CACHE_STALE)
 
+
+@app.get("/v1/models")
+@app.get("/v1/models/")
+async def v1_models() -> FastJSONResponse:
+    """
+    OpenAI-compatible models listing, served from the cached model catalog.
+    """
+    models = await model_catalog.list()
     out = {"object": "list", "data": models}
-    return JSONResponse(out)
+    return FastJSONResponse(out)
 
 
 @app.get("/v1/models/{model}")
-async def v1_model_retrieve(model: str) -> JSONResponse:
+async def v1_model_retrieve(model: str) -> FastJSONResponse:
     """
     Retrieve a specific model.
     """
-    data = await asksage_post("get-models", payload={})
-    for m in (data.get("data") or []):
-        mid = m.get("id") or m.get("name") or "unknown"
-        if mid == model:
-             return JSONResponse({"id": mid, "object": "model", "owned_by": m.get("owned_by", "asksage")})
+    m = await model_catalog.get(model)
+    if m is None:
+        raise HTTPException(status_code=404, detail="Model not found")
+    return FastJSONResponse(m)
+
 
-    raise HTTPException(status_code=404, detail="Model not found")
+@app.post("/admin/models/refresh")
+async def admin_models_refresh(req: Request, invalidate_only: bool = False) -> Dict[str, Any]:
+    """
+    Drop the cached model catalog and (unless `invalidate_only`) reload it right away.
+    """
+    _require_admin(req)
+    model_catalog.invalidate()
+    if not invalidate_only:
+        await model_catalog.refresh()
+    return model_catalog.stats()
+
+
+def _folded_response(folded: str, name: str) -> Response:
+    return Response(
+        folded,
+        media_type="text/plain; charset=utf-8",
+        headers={"content-disposition": f'attachment; filename="{name}.folded"'},
+    )
+
+
+@app.post("/admin/profile")
+async def admin_profile(req: Request, seconds: float = 10.0) -> Response:
+    """
+    Sample the event loop for `seconds` and return the stacks in folded format
+    (flamegraph.pl, speedscope).
+    """
+    _require_admin(req)
+    if not 0 < seconds <= ASKSAGE_PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {ASKSAGE_PROFILE_MAX_SECONDS:g}]")
+    profiler = SamplingProfiler(interval=ASKSAGE_PROFILE_INTERVAL_MS / 1000)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        folded = profiler.stop()
+    return _folded_response(folded, f"asksage-proxy-{int(time.time())}")
+
+
+@app.get("/admin/profiles/{profile_id}")
+async def admin_request_profile(req: Request, profile_id: str) -> Response:
+    """Profile of a request sent with `X-Proxy-Profile` (the id is in its `x-proxy-profile` header)."""
+    _require_admin(req)
+    folded = profiles.get(profile_id)
+    if folded is None:
+        raise HTTPException(status_code=404, detail=f"No such profile: {profile_id}")
+    return _folded_response(folded, profile_id)
+
+
+tts_cache: Optional[AudioCache] = None
+if ASKSAGE_TTS_CACHE_DIR:
+    tts_cache = AudioCache(ASKSAGE_TTS_CACHE_DIR, ASKSAGE_TTS_CACHE_MAX_BYTES)
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+async def _tee_to_cache(
+    body: AsyncGenerator[bytes, None], cache: AudioCache, key: str, media_type: str, expected_size: Optional[int]
+) -> AsyncGenerator[bytes, None]:
+    """
+    Relay `body` while writing it to a cache entry; only complete bodies are committed.
+    The entry's temporary file is created with the first chunk, so a response whose
+    body is never iterated (client gone before it started) leaves nothing behind.
+    """
+    writer: Optional[AudioWriter] = None
+    complete = False
+    try:
+        async for chunk in body:
+            if writer is None:
+                writer = await asyncio.to_thread(cache.writer, key, media_type)
+            await writer.write(chunk)
+            yield chunk
+        complete = writer is not None and (expected_size is None or writer.size == expected_size)
+    finally:
+        if writer is not None:
+            if complete:
+                await writer.commit()
+            else:
+                await writer.abort()
 
 
 @app.post("/v1/audio/speech")
 async def v1_audio_speech(req: Request) -> Response:
     """
     OpenAI-compatible Text-to-Speech -> Ask Sage /get-text-to-speech
+
+    Audio is relayed to the client as it arrives rather than buffered in full. With
+    ASKSAGE_TTS_CACHE_DIR set, audio is also written to the content-addressed cache and
+    repeated requests are served from disk (with ETag/If-None-Match and Range support).
     """
-    body = await req.json()
+    body = await _read_json_body(req)
 
     input_text = body.get("input")
     if not input_text:
         raise HTTPException(status_code=400, detail="Missing required field: input")
+    _rate_limit(req, estimate_tokens(str(input_text)))
+    access_sizes(prompt_chars=len(str(input_text)))
 
     voice = body.get("voice", "alloy")
     model = body.get("model", "tts-1")
@@ -287,33 +1140,312 @@ async def v1_audio_speech(req: Request) -> Response:
         "model": asksage_model
     }
 
-    audio_content = await asksage_post_bytes("get-text-to-speech", payload=payload)
+    headers: Dict[str, str] = {}
+    if tts_cache is not None:
+        key = payload_key(payload)
+        etag = f'"{key}"'
+        entry = await tts_cache.get(key)
+        if entry is not None:
+            if _etag_matches(req.headers.get("if-none-match"), etag):
+                return Response(status_code=304, headers={"etag": etag})
+            return AudioFileResponse(entry, etag, headers={"x-asksage-cache": "hit"})
+        headers.update({"etag": etag, "x-asksage-cache": "miss"})
+
+    upstream = await asksage_post_stream("get-text-to-speech", payload=payload)
+
+    media_type = upstream.response.headers.get("content-type", "")
+    if not media_type.startswith("audio/"):
+        media_type = "audio/mpeg"
+    content_length = upstream.response.headers.get("content-length")
+    if content_length and "content-encoding" not in upstream.response.headers:
+        headers["content-length"] = content_length
+
+    body = upstream.iter_bytes(ASKSAGE_STREAM_CHUNK_BYTES)
+    if tts_cache is not None:
+        expected = int(headers["content-length"]) if "content-length" in headers else None
+        body = _tee_to_cache(body, tts_cache, key, media_type, expected)
+
+    # The background task also runs when the client disconnects before the body is
+    # iterated, so the upstream connection is always released.
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers=headers,
+        background=BackgroundTask(upstream.aclose),
+    )
+
+
+transcription_cache: Optional[ResponseCache] = None
+if ASKSAGE_TRANSCRIPTION_CACHE:
+    transcription_cache = ResponseCache(
+        max_bytes=ASKSAGE_TRANSCRIPTION_CACHE_MAX_BYTES,
+        default_ttl=ASKSAGE_TRANSCRIPTION_CACHE_TTL,
+        path=ASKSAGE_TRANSCRIPTION_CACHE_PATH,
+        max_disk_bytes=ASKSAGE_TRANSCRIPTION_CACHE_DISK_MAX_BYTES,
+    )
+
+transcription_flight = SingleFlight()
+# Upload bytes answered from the cache or by joining an identical in-flight upload
+TRANSCRIPTION_BYTES_SAVED = metrics.counter(
+    "asksage_proxy_transcription_bytes_saved_total", "Upload bytes not sent to Ask Sage thanks to the transcription cache"
+)
+
+
+async def _transcribe(file: UploadFile) -> str:
+    # Ask Sage /server/file endpoint
+    # Response: { "ret": "extracted text", "status": 200, "response": "OK" }
+    data = await asksage_post_multipart("file", files={"file": file})
 
-    return Response(content=audio_content, media_type="audio/mpeg")
+    text = data.get("ret")
+    if text is None:
+         # Fallback
+         text = data.get("response") or ""
+    return text
 
 
 @app.post("/v1/audio/transcriptions")
 async def v1_audio_transcriptions(
+    req: Request,
     file: UploadFile = File(...),
     model: str = Form("whisper-1")
-) -> Dict[str, Any]:
+) -> Any:
     """
     OpenAI-compatible Speech-to-Text -> Ask Sage /file
+
+    The upload is streamed from its spooled file to Ask Sage; request bodies larger than
+    ASKSAGE_MAX_UPLOAD_BYTES are rejected with 413 while they are being received.
+
+    With ASKSAGE_TRANSCRIPTION_CACHE on, results are cached by the upload's SHA-256 and
+    the model, and concurrent uploads of the same file share one Ask Sage call.
     """
-    # Read file content to pass to httpx
-    content = await file.read()
-    files = {"file": (file.filename, content, file.content_type)}
+    _rate_limit(req)
+    if transcription_cache is None:
+        return {"text": await _transcribe(file)}
+
+    digest, size = await upload_sha256(file, ASKSAGE_UPLOAD_CHUNK_BYTES)
+    key = payload_key({"sha256": digest, "model": model})
+    cached = await transcription_cache.get(key)
+    if cached is not None:
+        TRANSCRIPTION_BYTES_SAVED.inc(size)
+        return FastJSONResponse({"text": loads(cached)["text"]}, headers={"x-asksage-cache": "hit"})
+
+    uploaded = False
+
+    async def fetch() -> str:
+        nonlocal uploaded
+        uploaded = True
+        text = await _transcribe(file)
+        await transcription_cache.put(key, dumps({"text": text}))
+        return text
+
+    text = await transcription_flight.do(key, fetch)
+    if not uploaded:
+        TRANSCRIPTION_BYTES_SAVED.inc(size)
+    return FastJSONResponse({"text": text}, headers={"x-asksage-cache": "miss"})
+
+
+response_cache: Optional[ResponseCache] = None
+if ASKSAGE_RESPONSE_CACHE:
+    response_cache = ResponseCache(
+        max_bytes=ASKSAGE_RESPONSE_CACHE_MAX_BYTES,
+        default_ttl=ASKSAGE_RESPONSE_CACHE_TTL,
+        path=ASKSAGE_RESPONSE_CACHE_PATH,
+        max_disk_bytes=ASKSAGE_RESPONSE_CACHE_DISK_MAX_BYTES,
+    )
+
+
+query_flight = SingleFlight()
+
+admission = AdmissionController(
+    max_concurrency=_per_worker(ASKSAGE_MAX_CONCURRENCY),
+    model_limits={model: _per_worker(limit) for model, limit in ASKSAGE_MODEL_CONCURRENCY.items()},
+    max_queue=_per_worker(ASKSAGE_MAX_QUEUE),
+    max_wait=ASKSAGE_MAX_QUEUE_WAIT,
+    weights=ASKSAGE_CLIENT_WEIGHTS,
+)
+
+rate_limiter = ClientRateLimiter(
+    requests_per_second=ASKSAGE_CLIENT_RPS,
+    burst=ASKSAGE_CLIENT_BURST,
+    tokens_per_minute=ASKSAGE_CLIENT_TOKENS_PER_MINUTE,
+    max_clients=ASKSAGE_CLIENT_MAX_TRACKED,
+)
+
+
+def _rate_limit(req: Request, tokens: int = 0) -> str:
+    """
+    Charge one request and `tokens` prompt tokens to the caller; returns its client id
+    (also used for fair queuing). Over a limit answers 429 with Retry-After; either way
+    the response carries the caller's `x-ratelimit-*` headers.
+    """
+    client = client_id(req.headers, ASKSAGE_CLIENT_ID_HEADER, req.client.host if req.client else None)
+    if not rate_limiter.enabled:
+        return client
+    decision = rate_limiter.check(client, tokens)
+    setattr(req.state, RATELIMIT_STATE_KEY, decision.headers)
+    if not decision.allowed:
+        raise HTTPException(
+            status_code=429,
+            detail={"error": "Rate limit exceeded", "limit": decision.limit},
+            headers={"Retry-After": str(max(1, math.ceil(decision.retry_after)))},
+        )
+    return client
 
-    # Ask Sage /server/file endpoint
-    # Response: { "ret": "extracted text", "status": 200, "response": "OK" }
-    data = await asksage_post_multipart("file", files=files)
 
-    text = data.get("ret")
-    if text is None:
-         # Fallback
-         text = data.get("response") or ""
+def _admission_error(e: AdmissionRejected) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail={"error": "Proxy is at capacity", "reason": e.reason},
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+@asynccontextmanager
+async def _upstream_slot(model: str, priority: int, client: str = "") -> AsyncGenerator[None, None]:
+    """Hold an admission slot for one upstream call; rejection becomes a 429."""
+    started = time.perf_counter()
+    try:
+        async with admission.slot(model, priority, client):
+            record("admission", started)
+            yield
+    except AdmissionRejected as e:
+        raise _admission_error(e)
 
-    return {"text": text}
+
+def _cache_bypass_requested(req: Request, asksage_cfg: Dict[str, Any]) -> bool:
+    """
+    Clients opt out of cached/shared responses with `Cache-Control: no-cache`/`no-store`
+    or `"asksage": {"cache": false}`.
+    """
+    cache_control = req.headers.get("cache-control", "").lower()
+    return asksage_cfg.get("cache") is False or "no-cache" in cache_control or "no-store" in cache_control
+
+
+def _is_deterministic(payload: Dict[str, Any]) -> bool:
+    """
+    Temperature 0 (the Ask Sage default) and no live search: identical payloads are
+    expected to produce the same answer, so they may be cached and coalesced.
+    """
+    return payload.get("temperature", 0.0) == 0.0 and not payload.get("live")
+
+
+def _response_cache_key(payload: Dict[str, Any]) -> Optional[str]:
+    """
+    Cache key for a /query payload, or None when the response must not be cached.
+    """
+    if response_cache is None or not _is_deterministic(payload):
+        return None
+    return payload_key(payload)
+
+
+async def _query_cache_lookup(payload: Dict[str, Any], use_cache: bool = True) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Response cache lookup for a /query payload. Returns (cache key, cached data); the key
+    is None when the payload isn't cacheable.
+    """
+    cache_key = _response_cache_key(payload) if use_cache else None
+    if cache_key is not None:
+        with phase("cache"):
+            cached = await response_cache.get(cache_key)
+        if cached is not None:
+            return cache_key, loads(cached)
+    return cache_key, None
+
+
+async def _query_upstream(
+    payload: Dict[str, Any],
+    cache_key: Optional[str] = None,
+    coalesce: bool = True,
+    cache_ttl: Optional[float] = None,
+    priority: int = PRIORITY_BATCH,
+    read_timeout: Optional[float] = None,
+    client: str = "",
+) -> Dict[str, Any]:
+    """
+    Ask Sage /query with admission control (queued fairly per `client`) and in-flight
+    coalescing; stores the result under `cache_key` if given.
+
+    Only deterministic payloads are coalesced, so concurrent sampling requests
+    (temperature > 0) still get independent completions. Joiners wait on the first
+    caller's call, so calls with a deadline (`read_timeout`) are never coalesced and
+    calls only join others of the same priority.
+    """
+    async def fetch() -> Dict[str, Any]:
+        async with _upstream_slot(str(payload.get("model")), priority, client):
+            data = await asksage_post("query", payload=payload, read_timeout=read_timeout)
+        if cache_key is not None:
+            await response_cache.put(cache_key, dumps(data), ttl=cache_ttl)
+        return data
+
+    if coalesce and ASKSAGE_COALESCE_REQUESTS and read_timeout is None and _is_deterministic(payload):
+        return await query_flight.do(f"{priority}:{cache_key or payload_key(payload)}", fetch)
+    return await fetch()
+
+
+def _query_content(data: Dict[str, Any]) -> str:
+    # Ask Sage response: message contains the generated response text.  citeturn3view0
+    content = data.get("message")
+    if content is None:
+        # Some tenants may use `response` or other keys; fall back to stringified response
+        content = data.get("response") or dumps(data).decode("utf-8")
+    return str(content)
+
+
+def _request_deadline(req: Request, body: Dict[str, Any]) -> Optional[float]:
+    """
+    Client-supplied deadline in seconds, from `X-Request-Timeout` or the body's `timeout`,
+    capped at ASKSAGE_MAX_REQUEST_TIMEOUT. None when the client didn't set one.
+    """
+    raw = req.headers.get("x-request-timeout")
+    if raw is None:
+        raw = body.get("timeout")
+    if raw is None:
+        return None
+    try:
+        deadline = float(raw)
+    except (TypeError, ValueError):
+        deadline = math.nan
+    if not math.isfinite(deadline) or deadline <= 0:
+        raise HTTPException(status_code=400, detail="Invalid request timeout: must be a positive number of seconds")
+    return min(deadline, ASKSAGE_MAX_REQUEST_TIMEOUT)
+
+
+async def _wait_for_disconnect(req: Request) -> None:
+    # The body has been read, so the next ASGI message is the disconnect
+    while (await req.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _await_while_connected(req: Request, pending: Awaitable[Any], deadline: Optional[float]) -> Any:
+    """
+    Await `pending` unless the client disconnects or the deadline passes first; either
+    way the upstream wait is cancelled so its admission slot and connection are freed.
+    """
+    task = asyncio.ensure_future(pending)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(req))
+    try:
+        done, _ = await asyncio.wait({task, watcher}, timeout=deadline, return_when=asyncio.FIRST_COMPLETED)
+        if task in done:
+            return task.result()
+        if watcher in done:
+            ABANDONED.inc(1.0, ("client_disconnect",))
+            raise HTTPException(status_code=499, detail="Client closed request")
+        ABANDONED.inc(1.0, ("deadline",))
+        raise HTTPException(status_code=504, detail="Request deadline exceeded")
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+
+
+def _record_token_usage(usage: Any) -> None:
+    if not isinstance(usage, dict):
+        return
+    for kind in ("prompt_tokens", "completion_tokens", "total_tokens"):
+        value = usage.get(kind)
+        if isinstance(value, (int, float)):
+            TOKENS.inc(value, (kind[: -len("_tokens")],))
+            access_sizes(**{kind: value})
 
 
 def _now_epoch() -> int:
@@ -322,10 +1454,12 @@ def _now_epoch() -> int:
 
 def _make_openai_chat_response(
     model: str,
-    content: str,
+    content: Union[str, Dict[int, str]],
     usage: Optional[Dict[str, Any]] = None,
     finish_reason: str = "stop",
 ) -> Dict[str, Any]:
+    """`content` is the answer, or answers by choice index when `n` > 1."""
+    contents = {0: content} if isinstance(content, str) else content
     out: Dict[str, Any] = {
         "id": f"chatcmpl-{_now_epoch()}",
         "object": "chat.completion",
@@ -333,10 +1467,11 @@ def _make_openai_chat_response(
         "model": model,
         "choices": [
             {
-                "index": 0,
-                "message": {"role": "assistant", "content": content},
+                "index": index,
+                "message": {"role": "assistant", "content": text},
                 "finish_reason": finish_reason,
             }
+            for index, text in sorted(contents.items())
         ],
     }
     if usage:
@@ -344,49 +1479,182 @@ def _make_openai_chat_response(
     return out
 
 
-async def _stream_single_chunk(model: str, content: str) -> AsyncGenerator[bytes, None]:
+def _sum_usage(usages: List[Any]) -> Optional[Dict[str, Any]]:
+    """Add up the numeric usage fields of several Ask Sage calls."""
+    total: Dict[str, Any] = {}
+    for usage in usages:
+        if not isinstance(usage, dict):
+            continue
+        for key, value in usage.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                total[key] = total.get(key, 0) + value
+    return total or None
+
+
+def _choice_fetches(n: int, fetch: Callable[[], Awaitable[Dict[str, Any]]], shared: bool) -> List[Callable[[], Awaitable[Dict[str, Any]]]]:
     """
-    Minimal SSE streaming compatible with many OpenAI clients:
-    - send one delta chunk with full content
-    - send [DONE]
+    `n` callables producing one choice each, at most ASKSAGE_N_CONCURRENCY running at once.
+    With `shared` (deterministic payloads, where every choice would be identical) they
+    all wait for a single call.
     """
-    created = _now_epoch()
-    chunk = {
-        "id": f"chatcmpl-{created}",
-        "object": "chat.completion.chunk",
-        "created": created,
-        "model": model,
-        "choices": [{"index": 0, "delta": {"role": "assistant", "content": content}, "finish_reason": None}],
-    }
-    yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
-    done = {
-        "id": f"chatcmpl-{created}",
-        "object": "chat.completion.chunk",
-        "created": created,
-        "model": model,
-        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
-    }
-    yield f"data: {json.dumps(done)}\n\n".encode("utf-8")
-    yield b"data: [DONE]\n\n"
+    if n == 1:
+        return [fetch]
+    if shared:
+        flight = SingleFlight()
+        return [lambda: flight.do("choice", fetch)] * n
 
+    limit = asyncio.Semaphore(max(1, ASKSAGE_N_CONCURRENCY))
 
-@app.post("/v1/chat/completions")
-@app.post("/v1/chat/completions/")
-async def v1_chat_completions(req: Request) -> Any:
-    """
-    OpenAI-compatible Chat Completions -> Ask Sage /query.
+    async def bounded() -> Dict[str, Any]:
+        async with limit:
+            return await fetch()
 
-    Ask Sage /query accepts:
-      - message (string or conversation array)
-      - persona (int), dataset, model, temperature, limit_references, live, system_prompt, usage, tools
-    citeturn3view0
+    return [bounded] * n
+
+
+async def _gather_choices(
+    fetches: List[Callable[[], Awaitable[Dict[str, Any]]]]
+) -> Tuple[Dict[int, Dict[str, Any]], List[HTTPException]]:
     """
-    body = await req.json()
+    Run the choice fetches concurrently. Returns results by index and the failures;
+    with ASKSAGE_N_FAILURE_POLICY=fail (or a single choice) the first failure is raised.
+    """
+    tasks = [asyncio.ensure_future(f()) for f in fetches]
+    try:
+        if len(tasks) == 1 or ASKSAGE_N_FAILURE_POLICY == "fail":
+            await asyncio.gather(*tasks)
+        else:
+            await asyncio.wait(tasks)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    results: Dict[int, Dict[str, Any]] = {}
+    failures: List[HTTPException] = []
+    for index, task in enumerate(tasks):
+        error = task.exception()
+        if error is None:
+            results[index] = task.result()
+        elif isinstance(error, HTTPException):
+            failures.append(error)
+        else:
+            raise error
+    if not results:
+        raise failures[0]
+    return results, failures
+
 
+def _split_content(content: str, size: int) -> List[str]:
+    """
+    Split text into pieces of roughly `size` characters, preferring to break after whitespace.
+    """
+    pieces = []
+    start = 0
+    while len(content) - start > size:
+        end = start + size
+        brk = max(content.rfind(" ", start, end), content.rfind("\n", start, end))
+        if brk > start + size // 2:
+            end = brk + 1
+        pieces.append(content[start:end])
+        start = end
+    if start < len(content) or not pieces:
+        pieces.append(content[start:])
+    return pieces
+
+
+def _sse_frame(obj: Dict[str, Any]) -> bytes:
+    return b"data: " + dumps(obj) + b"\n\n"
+
+
+async def _stream_chat_completion(
+    model: str, fetches: List[Callable[[], Awaitable[Dict[str, Any]]]], deadline: Optional[float] = None
+) -> AsyncGenerator[bytes, None]:
+    """
+    SSE streaming compatible with OpenAI clients.
+
+    The role delta is sent right away and a keepalive comment every
+    ASKSAGE_SSE_HEARTBEAT_SECONDS while Ask Sage is generating, so idle-timeout
+    proxies and clients don't drop the connection. Each answer is then delivered as
+    a series of content deltas followed by its finish chunk; with several choices
+    (`n` > 1) each is sent, tagged with its `index`, as soon as it completes. Upstream
+    errors that happen after the response has started (including a passed `deadline`)
+    are sent as an `error` event. If the client disconnects, the generator is closed
+    and the pending upstream calls are cancelled.
+    """
+    created = _now_epoch()
+    base = {"id": f"chatcmpl-{created}", "object": "chat.completion.chunk", "created": created, "model": model}
+    several = len(fetches) > 1
+
+    def chunk(index: int, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> bytes:
+        return _sse_frame(dict(base, choices=[{"index": index, "delta": delta, "finish_reason": finish_reason}]))
+
+    def error_event(e: HTTPException, index: int) -> bytes:
+        detail = e.detail
+        error = {
+            "message": detail if isinstance(detail, str) else dumps(detail).decode("utf-8"),
+            "type": "upstream_error",
+            "code": e.status_code,
+        }
+        if several:
+            error["index"] = index
+        return _sse_frame({"error": error})
+
+    tasks = {asyncio.ensure_future(fetch()): index for index, fetch in enumerate(fetches)}
+    pending = set(tasks)
+    expires = time.monotonic() + deadline if deadline is not None else None
+    expired = False
+    try:
+        for index in range(len(fetches)):
+            yield chunk(index, {"role": "assistant", "content": ""})
+        while pending:
+            wait = ASKSAGE_SSE_HEARTBEAT_SECONDS
+            if expires is not None:
+                wait = min(wait, max(0.0, expires - time.monotonic()))
+            done, pending = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if expires is not None and time.monotonic() >= expires:
+                    expired = True
+                    for task in pending:
+                        task.cancel()
+                    ABANDONED.inc(1.0, ("deadline",))
+                    yield error_event(HTTPException(status_code=504, detail="Request deadline exceeded"), min(tasks[t] for t in pending))
+                    break
+                yield b": keepalive\n\n"
+                continue
+
+            for task in sorted(done, key=tasks.__getitem__):
+                index = tasks[task]
+                try:
+                    data = task.result()
+                except HTTPException as e:
+                    yield error_event(e, index)
+                    if not several or ASKSAGE_N_FAILURE_POLICY == "fail":
+                        yield b"data: [DONE]\n\n"
+                        return
+                    continue
+                _record_token_usage(data.get("usage"))
+                content = _query_content(data)
+                access_sizes(completion_chars=len(content))
+                for piece in _split_content(content, ASKSAGE_SSE_CHUNK_CHARS):
+                    yield chunk(index, {"content": piece})
+                yield chunk(index, {}, finish_reason="stop")
+        yield b"data: [DONE]\n\n"
+    finally:
+        unfinished = [task for task in tasks if not task.done()]
+        for task in unfinished:
+            task.cancel()
+        if unfinished and not expired:
+            # Closed before the answers arrived: the client went away (or a choice
+            # failed under the "fail" policy)
+            ABANDONED.inc(1.0, ("client_disconnect",))
+
+
+def _build_query_payload(body: Dict[str, Any]) -> Tuple[str, Dict[str, Any], PromptResult]:
+    """(model, Ask Sage /query payload, flattened prompt) for a chat completion request body."""
     model = body.get("model") or ASKSAGE_DEFAULT_MODEL
     messages = body.get("messages") or []
     temperature = body.get("temperature", None)
-    stream = bool(body.get("stream", False))
 
     # Optional Ask Sage knobs via "asksage": {...}
     asksage_cfg = body.get("asksage") or {}
@@ -400,10 +1668,12 @@ async def v1_chat_completions(req: Request) -> Any:
     if not isinstance(messages, list) or not messages:
         raise HTTPException(status_code=400, detail="Missing required field: messages[]")
 
-    prompt = openai_messages_to_prompt(messages)
+    with phase("prompt"):
+        built = prompt_builder.build(messages, budget_tokens=_prompt_budget(str(model), body))
+    PROMPT_CHARS.observe(len(built.prompt))
 
     payload: Dict[str, Any] = {
-        "message": prompt,
+        "message": built.prompt,
         "model": model,
         "persona": int(persona) if persona is not None else ASKSAGE_DEFAULT_PERSONA,
         "dataset": dataset,
@@ -421,23 +1691,264 @@ async def v1_chat_completions(req: Request) -> Any:
 
     # NOTE: Tools/function calling isn’t mapped here; Ask Sage has a "tools" param
     # but OpenAI tool formats vary by provider. If you need tool use, extend here.
-    data = await asksage_post("query", payload=payload)
+    return str(model), payload, built
+
+
+def _choice_count(body: Dict[str, Any]) -> int:
+    n = body.get("n")
+    if n is None:
+        return 1
+    if not isinstance(n, int) or isinstance(n, bool) or not 1 <= n <= ASKSAGE_MAX_N:
+        raise HTTPException(status_code=400, detail=f"Invalid field: n must be an integer from 1 to {ASKSAGE_MAX_N}")
+    return n
 
-    # Ask Sage response: message contains the generated response text.  citeturn3view0
-    content = data.get("message")
-    if content is None:
-        # Some tenants may use `response` or other keys; fall back to stringified response
-        content = data.get("response") or json.dumps(data)
 
+def _chat_completion_result(model: str, results: Dict[int, Dict[str, Any]]) -> Dict[str, Any]:
+    """OpenAI chat.completion object for the Ask Sage answers of each choice."""
     # Usage mapping (best-effort). Ask Sage usage format can vary by tenant/model.
-    usage = None
-    if isinstance(data, dict) and ("usage" in data):
-        usage = data.get("usage")
+    # Choices served by one shared call are the same object; count their usage once
+    calls = {id(data): data for data in results.values()}.values()
+    usages = [data.get("usage") for data in calls if isinstance(data, dict) and "usage" in data]
+    for usage in usages:
+        _record_token_usage(usage)
+    usage = usages[0] if len(usages) == 1 else _sum_usage(usages)
+    contents = {i: _query_content(data) for i, data in results.items()}
+    access_sizes(completion_chars=sum(len(text) for text in contents.values()))
+    return _make_openai_chat_response(model=model, content=contents, usage=usage)
+
+
+@app.post("/v1/chat/completions")
+@app.post("/v1/chat/completions/")
+async def v1_chat_completions(req: Request) -> Any:
+    """
+    OpenAI-compatible Chat Completions -> Ask Sage /query.
+
+    Ask Sage /query accepts:
+      - message (string or conversation array)
+      - persona (int), dataset, model, temperature, limit_references, live, system_prompt, usage, tools
+    citeturn3view0
+    """
+    scanner = None
+    if ASKSAGE_MAX_CHAT_MESSAGES or ASKSAGE_MAX_MESSAGE_BYTES:
+        scanner = MessageScanner(ASKSAGE_MAX_CHAT_MESSAGES, ASKSAGE_MAX_MESSAGE_BYTES)
+    body = await _read_json_body(req, scanner)
+    stream = bool(body.get("stream", False))
+    asksage_cfg = body.get("asksage") or {}
+    model, payload, built = _build_query_payload(body)
+    n = _choice_count(body)
+    # Every choice sends the prompt again
+    client = _rate_limit(req, built.tokens * n)
+    access_annotate(model=model, client=client, stream=stream, n=n)
+    access_sizes(prompt_chars=len(built.prompt), prompt_estimated_tokens=built.tokens)
+
+    bypass = _cache_bypass_requested(req, asksage_cfg)
+    if bypass and response_cache is not None:
+        response_cache.bypassed += 1
+    cache_ttl = asksage_cfg.get("cache_ttl")
+    if cache_ttl is not None:
+        try:
+            cache_ttl = float(cache_ttl)
+        except (TypeError, ValueError):
+            cache_ttl = math.nan
+        if not math.isfinite(cache_ttl):
+            raise HTTPException(status_code=400, detail="Invalid field: asksage.cache_ttl must be a number")
+    cache_key, cached = await _query_cache_lookup(payload, use_cache=not bypass)
+    cache_status = "hit" if cached is not None else ("miss" if cache_key is not None else "bypass")
+    headers = {"x-asksage-cache": cache_status} if response_cache is not None else {}
+    if response_cache is not None:
+        access_annotate(cache=cache_status)
+    if built.dropped:
+        headers["x-asksage-prompt-dropped-messages"] = str(built.dropped)
+
+    priority = PRIORITY_INTERACTIVE if stream and ASKSAGE_PRIORITIZE_STREAMING else PRIORITY_BATCH
+    if cached is None:
+        # Reject with a real 429 status while we still can (before a stream has started)
+        try:
+            admission.check(model)
+        except AdmissionRejected as e:
+            raise _admission_error(e)
+
+    deadline = _request_deadline(req, body)
+
+    async def fetch() -> Dict[str, Any]:
+        if cached is not None:
+            return cached
+        return await _query_upstream(
+            payload, cache_key=cache_key, coalesce=not bypass, cache_ttl=cache_ttl, priority=priority,
+            read_timeout=deadline, client=client,
+        )
 
+    # Deterministic payloads would give n identical choices: one call serves them all
+    fetches = _choice_fetches(n, fetch, shared=cached is not None or _is_deterministic(payload))
     if stream:
         return StreamingResponse(
-            _stream_single_chunk(model=str(model), content=str(content)),
+            _stream_chat_completion(model=model, fetches=fetches, deadline=deadline),
             media_type="text/event-stream",
+            headers=headers,
         )
 
-    return JSONResponse(_make_openai_chat_response(model=str(model), content=str(content), usage=usage))
+    results, failures = await _await_while_connected(req, _gather_choices(fetches), deadline)
+    if failures:
+        headers["x-asksage-failed-choices"] = str(len(failures))
+    result = _chat_completion_result(model, results)
+    timing = current_timing()
+    if asksage_cfg.get("timing") and timing is not None:
+        result["x-proxy-timing"] = timing.as_dict()
+    with phase("serialize"):
+        return FastJSONResponse(result, headers=headers)
+
+
+# Request lines of a batch input file may target these endpoints
+BATCH_ENDPOINTS = ("/v1/chat/completions",)
+
+
+async def _execute_batch_request(url: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    One chat completion of a batch: same mapping, response cache and admission control
+    as /v1/chat/completions, queued behind interactive requests.
+    """
+    try:
+        model, payload, _ = _build_query_payload(body)
+        n = _choice_count(body)
+        cache_key, cached = await _query_cache_lookup(payload)
+
+        async def fetch() -> Dict[str, Any]:
+            if cached is not None:
+                return cached
+            return await _query_upstream(payload, cache_key=cache_key, priority=PRIORITY_BATCH)
+
+        results, _ = await _gather_choices(
+            _choice_fetches(n, fetch, shared=cached is not None or _is_deterministic(payload))
+        )
+    except HTTPException as e:
+        retry_after = (e.headers or {}).get("Retry-After")
+        message = e.detail if isinstance(e.detail, str) else dumps(e.detail).decode("utf-8")
+        raise BatchRequestError(e.status_code, message, float(retry_after) if retry_after else None)
+    return _chat_completion_result(model, results)
+
+
+batch_files: Optional[FileStore] = None
+batch_runner: Optional[BatchRunner] = None
+if ASKSAGE_BATCH_DIR:
+    batch_files = FileStore(ASKSAGE_BATCH_DIR)
+    batch_runner = BatchRunner(
+        ASKSAGE_BATCH_DIR,
+        batch_files,
+        _execute_batch_request,
+        endpoints=BATCH_ENDPOINTS,
+        workers=ASKSAGE_BATCH_WORKERS,
+        checkpoint_seconds=ASKSAGE_BATCH_CHECKPOINT_SECONDS,
+        max_attempts=ASKSAGE_BATCH_MAX_ATTEMPTS,
+        backoff=ASKSAGE_RETRY_BACKOFF,
+        max_backoff=ASKSAGE_RETRY_MAX_BACKOFF,
+    )
+
+
+def _batch_api() -> Tuple[FileStore, BatchRunner]:
+    if batch_files is None or batch_runner is None:
+        raise HTTPException(status_code=404, detail="The Batch API is disabled; set ASKSAGE_BATCH_DIR to enable it")
+    return batch_files, batch_runner
+
+
+@app.post("/v1/files")
+async def v1_files_create(file: UploadFile = File(...), purpose: str = Form(...)) -> Any:
+    """
+    Upload a JSONL file of batch requests. The upload is spooled to disk while it is
+    received, then copied into the store line by line (each line is checked).
+    """
+    files, _ = _batch_api()
+    if purpose != "batch":
+        raise HTTPException(status_code=400, detail="Invalid purpose: only 'batch' files are supported")
+    try:
+        return await files.create(
+            file.file, file.filename or "upload.jsonl", purpose, BATCH_ENDPOINTS, ASKSAGE_UPLOAD_CHUNK_BYTES
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch file: {e}")
+
+
+@app.get("/v1/files")
+async def v1_files_list(purpose: Optional[str] = None) -> Any:
+    files, _ = _batch_api()
+    return {"object": "list", "data": await asyncio.to_thread(files.list, purpose)}
+
+
+async def _get_file(file_id: str) -> Dict[str, Any]:
+    files, _ = _batch_api()
+    file = await asyncio.to_thread(files.get, file_id)
+    if file is None:
+        raise HTTPException(status_code=404, detail=f"No such file: {file_id}")
+    return file
+
+
+@app.get("/v1/files/{file_id}")
+async def v1_files_retrieve(file_id: str) -> Any:
+    return await _get_file(file_id)
+
+
+@app.get("/v1/files/{file_id}/content")
+async def v1_files_content(file_id: str) -> Response:
+    """File contents, streamed from disk."""
+    file = await _get_file(file_id)
+    return FileResponse(batch_files.path(file_id), media_type="application/jsonl", filename=file["filename"])
+
+
+@app.delete("/v1/files/{file_id}")
+async def v1_files_delete(file_id: str) -> Any:
+    files, _ = _batch_api()
+    if not await asyncio.to_thread(files.delete, file_id):
+        raise HTTPException(status_code=404, detail=f"No such file: {file_id}")
+    return {"id": file_id, "object": "file", "deleted": True}
+
+
+@app.post("/v1/batches")
+async def v1_batches_create(req: Request) -> Any:
+    """Start running the requests of an uploaded file in the background."""
+    _, runner = _batch_api()
+    body = await _read_json_body(req)
+    metadata = body.get("metadata")
+    if metadata is not None and not isinstance(metadata, dict):
+        raise HTTPException(status_code=400, detail="Invalid field: metadata must be an object")
+    try:
+        return await runner.create(
+            str(body.get("input_file_id") or ""),
+            str(body.get("endpoint") or ""),
+            str(body.get("completion_window") or "24h"),
+            metadata,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/v1/batches")
+async def v1_batches_list(limit: int = 20, after: Optional[str] = None) -> Any:
+    _, runner = _batch_api()
+    limit = max(1, min(limit, 100))
+    batches = await asyncio.to_thread(runner.list, limit + 1, after)
+    data = batches[:limit]
+    return {
+        "object": "list",
+        "data": data,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+        "has_more": len(batches) > len(data),
+    }
+
+
+@app.get("/v1/batches/{batch_id}")
+async def v1_batches_retrieve(batch_id: str) -> Any:
+    _, runner = _batch_api()
+    batch = await asyncio.to_thread(runner.get, batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"No such batch: {batch_id}")
+    return batch
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def v1_batches_cancel(batch_id: str) -> Any:
+    """Stop a batch; results finished so far are kept in its output file."""
+    _, runner = _batch_api()
+    batch = await runner.cancel(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"No such batch: {batch_id}")
+    return batch
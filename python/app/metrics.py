@@ -0,0 +1,255 @@
+"""
+Minimal Prometheus metrics.
+
+Metrics are only updated from the event loop thread, so recording is a plain
+dict lookup plus an addition (no locks). Rendering produces the Prometheus
+text exposition format (version 0.0.4).
+
+With several worker processes, each publishes a `snapshot()` (plain data) and
+`merge_snapshots()` adds them up by name and labels, so any worker can render the
+metrics of the whole proxy. Gauges are summed too (e.g. in-flight requests).
+"""
+import bisect
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+Labels = Tuple[str, ...]
+
+# Latency buckets (seconds): sub-millisecond local work up to multi-minute generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Size buckets (bytes/characters): powers of 4 from 256 to 64M
+SIZE_BUCKETS = tuple(float(4 ** i) for i in range(4, 14))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1.0, labels: Labels = ()) -> None:
+        values = self.values
+        values[labels] = values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, labels: Labels = ()) -> None:
+        self.inc(-amount, labels)
+
+    def set(self, value: float, labels: Labels = ()) -> None:
+        self.values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self.values: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [0.0] * (len(self.buckets) + 2)
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for labels, state in self.values.items():
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {_format_value(cumulative)}")
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {_format_value(state[-1])}")
+            lines.append(f"{self.name}_count{label_str} {_format_value(cumulative)}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[_Metric]]] = []
+
+    def register(self, metric: Any) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collect: Callable[[], Iterable[_Metric]]) -> None:
+        """Register a callback producing metrics computed at scrape time (e.g. from stats())."""
+        self._collectors.append(collect)
+
+    def find(self, name: str) -> Optional[_Metric]:
+        for metric in self._metrics:
+            if metric.name == name:
+                return metric
+        return None
+
+    def collect(self) -> List[_Metric]:
+        out = list(self._metrics)
+        for collect in self._collectors:
+            out.extend(collect())
+        return out
+
+    def render(self) -> str:
+        return render_metrics(self.collect())
+
+    def snapshot(self) -> List[List[Any]]:
+        """Every metric as plain data (JSON-serializable), for `merge_snapshots()`."""
+        return [
+            [
+                metric.kind,
+                metric.name,
+                metric.help,
+                list(metric.labelnames),
+                list(getattr(metric, "buckets", ())),
+                [[list(labels), value] for labels, value in metric.values.items()],  # type: ignore[attr-defined]
+            ]
+            for metric in self.collect()
+        ]
+
+
+_KINDS = {"counter": Counter, "gauge": Gauge}
+
+
+def merge_snapshots(snapshots: Iterable[List[List[Any]]]) -> List[_Metric]:
+    """Add up snapshots from several processes (same name and labels -> one series)."""
+    merged: Dict[str, Any] = {}
+    for snapshot in snapshots:
+        for kind, name, help, labelnames, buckets, values in snapshot:
+            metric = merged.get(name)
+            if metric is None:
+                if kind == "histogram":
+                    metric = Histogram(name, help, labelnames, buckets)
+                else:
+                    metric = _KINDS[kind](name, help, labelnames)
+                merged[name] = metric
+            for labels, value in values:
+                labels = tuple(labels)
+                if kind == "histogram":
+                    state = metric.values.get(labels)
+                    metric.values[labels] = [a + b for a, b in zip(state, value)] if state is not None else list(value)
+                else:
+                    metric.values[labels] = metric.values.get(labels, 0.0) + value
+    return list(merged.values())
+
+
+def render_metrics(metrics: Iterable[_Metric]) -> str:
+    lines: List[str] = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    Per-route request count, latency, in-flight and byte counters.
+
+    The route label is the matched route template (e.g. `/v1/models/{model}`), so
+    metrics stay bounded no matter which paths clients request.
+    """
+
+    def __init__(self, app: Callable[..., Awaitable[None]], registry: Registry) -> None:
+        self.app = app
+        self.requests = registry.counter(
+            "asksage_proxy_requests_total", "HTTP requests handled", ("method", "route", "status")
+        )
+        self.duration = registry.histogram(
+            "asksage_proxy_request_duration_seconds", "HTTP request latency", ("method", "route", "status")
+        )
+        self.in_flight = registry.gauge("asksage_proxy_requests_in_flight", "HTTP requests being handled")
+        self.request_bytes = registry.counter("asksage_proxy_request_bytes_total", "Request body bytes", ("route",))
+        self.response_bytes = registry.counter("asksage_proxy_response_bytes_total", "Response body bytes", ("route",))
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable[[], Awaitable[Dict[str, Any]]], send: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+        received = 0
+        sent = 0
+
+        async def counting_receive() -> Dict[str, Any]:
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message: Dict[str, Any]) -> None:
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        self.in_flight.inc()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            self.in_flight.dec()
+            route = scope.get("route")
+            route_label = getattr(route, "path", None) or "unmatched"
+            labels = (scope["method"], route_label, str(status))
+            self.requests.inc(1.0, labels)
+            self.duration.observe(time.perf_counter() - started, labels)
+            self.request_bytes.inc(received, (route_label,))
+            self.response_bytes.inc(sent, (route_label,))
@@ -0,0 +1,110 @@
+"""
+Streaming multipart/form-data request bodies.
+
+Uploaded files are already spooled by Starlette (to disk past 1MB). Instead of
+reading them into memory and letting httpx build a second copy of the encoded
+body, `MultipartStream` yields the encoded body in fixed-size chunks straight
+from the spooled files, so peak memory per request is one chunk.
+"""
+import asyncio
+import hashlib
+import os
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+
+from fastapi import HTTPException
+from starlette.datastructures import UploadFile
+
+
+def _quote(value: str) -> str:
+    # Same escaping browsers (and httpx) apply to field names and filenames
+    return value.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+async def upload_sha256(upload: UploadFile, chunk_size: int = 256 * 1024) -> Tuple[str, int]:
+    """
+    SHA-256 hex digest and size of a spooled upload, hashed in `chunk_size` reads off the
+    event loop. The file is rewound afterwards.
+    """
+
+    def digest() -> Tuple[str, int]:
+        h = hashlib.sha256()
+        size = 0
+        upload.file.seek(0)
+        while True:
+            chunk = upload.file.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+            size += len(chunk)
+        upload.file.seek(0)
+        return h.hexdigest(), size
+
+    return await asyncio.to_thread(digest)
+
+
+class MultipartStream:
+    def __init__(
+        self,
+        files: Dict[str, UploadFile],
+        data: Optional[Dict[str, str]] = None,
+        chunk_size: int = 64 * 1024,
+        max_file_bytes: int = 0,
+    ) -> None:
+        self.boundary = os.urandom(16).hex()
+        self.chunk_size = chunk_size
+        self.max_file_bytes = max_file_bytes
+        self._files = files
+        self._parts: List[Tuple[bytes, Union[bytes, UploadFile]]] = []
+        for name, value in (data or {}).items():
+            head = f'--{self.boundary}\r\nContent-Disposition: form-data; name="{_quote(name)}"\r\n\r\n'
+            self._parts.append((head.encode("utf-8"), str(value).encode("utf-8")))
+        for name, upload in files.items():
+            head = (
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{_quote(name)}"; filename="{_quote(upload.filename or name)}"\r\n'
+                f"Content-Type: {upload.content_type or 'application/octet-stream'}\r\n\r\n"
+            )
+            self._parts.append((head.encode("utf-8"), upload))
+        self._tail = f"--{self.boundary}--\r\n".encode("utf-8")
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    @property
+    def content_length(self) -> Optional[int]:
+        """Exact encoded size, or None if an upload's size isn't known (sent chunked)."""
+        total = len(self._tail)
+        for head, body in self._parts:
+            size = body.size if isinstance(body, UploadFile) else len(body)
+            if size is None:
+                return None
+            total += len(head) + size + 2
+        return total
+
+    def headers(self) -> Dict[str, str]:
+        headers = {"Content-Type": self.content_type}
+        length = self.content_length
+        if length is not None:
+            headers["Content-Length"] = str(length)
+        return headers
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for head, body in self._parts:
+            yield head
+            if isinstance(body, UploadFile):
+                # Rewind so the body can be re-sent (e.g. on retry)
+                await body.seek(0)
+                sent = 0
+                while True:
+                    chunk = await body.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    sent += len(chunk)
+                    if self.max_file_bytes and sent > self.max_file_bytes:
+                        raise HTTPException(status_code=413, detail="Uploaded file is too large")
+                    yield chunk
+            else:
+                yield body
+            yield b"\r\n"
+        yield self._tail
@@ -0,0 +1,140 @@
+"""
+On-demand sampling profiler for the event loop thread.
+
+A daemon thread wakes up every `interval` seconds, reads the loop thread's current
+stack (`sys._current_frames()`) and counts it. The result is in the "folded" format
+(`outer;inner;leaf count` per line) read by flamegraph.pl, speedscope and inferno.
+Nothing runs unless a profile has been requested; while one runs, each sample
+costs the loop a few microseconds of GIL time.
+
+The loop serves every request, so a profile taken during one request also
+contains whatever else ran on the loop at the time; time the loop spent waiting
+for I/O shows up under the selector's frames.
+
+`RequestProfilerMiddleware` profiles single requests sent with `X-Proxy-Profile: 1`
+by an authorized caller and keeps the last few results for download.
+"""
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from starlette.responses import JSONResponse
+
+Scope = Dict[str, Any]
+Message = Dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+
+def _label(frame: Any) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    def __init__(self, thread_id: Optional[int] = None, interval: float = 0.005) -> None:
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.counts: Dict[str, int] = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="asksage-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        """Stop sampling and return the folded stacks."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.folded()
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.counts.items()))
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                stack.append(_label(frame))
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+
+class ProfileStore:
+    """The last `max_profiles` request profiles, by id."""
+
+    def __init__(self, max_profiles: int = 20) -> None:
+        self.max_profiles = max_profiles
+        self._profiles: "OrderedDict[str, str]" = OrderedDict()
+        self._ids = itertools.count(1)
+
+    def new_id(self) -> str:
+        return f"prof-{int(time.time())}-{next(self._ids)}"
+
+    def put(self, profile_id: str, folded: str) -> None:
+        self._profiles[profile_id] = folded
+        while len(self._profiles) > self.max_profiles:
+            self._profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> Optional[str]:
+        return self._profiles.get(profile_id)
+
+
+class RequestProfilerMiddleware:
+    """
+    Profiles requests carrying `X-Proxy-Profile`. `authorize(headers)` returns None
+    when the caller may profile, else the status to reject the request with. The
+    response gets an `x-proxy-profile` header with the id of the stored profile.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        store: ProfileStore,
+        authorize: Callable[[Dict[str, str]], Optional[int]],
+        interval: Callable[[], float],
+    ) -> None:
+        self.app = app
+        self.store = store
+        self.authorize = authorize
+        self.interval = interval
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not any(name == b"x-proxy-profile" for name, _ in scope.get("headers") or ()):
+            await self.app(scope, receive, send)
+            return
+        headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        denied = self.authorize(headers)
+        if denied is not None:
+            detail = "Not Found" if denied == 404 else "Invalid admin token"
+            await JSONResponse({"detail": detail}, status_code=denied)(scope, receive, send)
+            return
+
+        profile_id = self.store.new_id()
+        profiler = SamplingProfiler(interval=self.interval())
+
+        async def send_with_id(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers") or []) + [
+                    (b"x-proxy-profile", profile_id.encode("latin-1"))
+                ]
+            await send(message)
+
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            self.store.put(profile_id, profiler.stop())
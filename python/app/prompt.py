@@ -0,0 +1,266 @@
+"""
+Flattening OpenAI chat messages into the single prompt string Ask Sage /query takes.
+
+The prompt is a `System:` block with every system message followed by one
+`User: ...` / `Assistant: ...` line per turn and a trailing `Assistant:` cue.
+Lines are kept as (label, text) pieces that refer to the request's own strings and
+the prompt is produced by a single join, so a large message is copied once, into
+the prompt, rather than into a rendered line, the joined conversation and the
+final string in turn.
+
+`PromptBuilder` adds two things on top of the plain rendering:
+
+- a memo of flattened conversations: when a client sends a previously seen
+  conversation plus a few new turns (checked by comparing the messages, which is a
+  memcmp), only the new turns are rendered;
+- a token budget: when the estimated size exceeds it, turns are dropped from the
+  middle, keeping system messages, the first user turn and as many recent turns
+  as fit (optionally at most `keep_recent_turns`).
+"""
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from .fastjson import dumps
+
+# (role, content) per message; a memo entry matches only if its snapshot is equal
+Snapshot = List[Tuple[Any, Any]]
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token for English text and code)."""
+    return (len(text) + 3) // 4
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    # OpenAI allows content to be str OR a list of parts (text/images); keep only text parts
+    content = message.get("content")
+    if isinstance(content, list):
+        text_chunks = []
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "text" and "text" in part:
+                text_chunks.append(str(part["text"]))
+        return "\n".join(text_chunks).strip()
+    return "" if content is None else str(content)
+
+
+def render_message(message: Dict[str, Any]) -> Tuple[bool, str, str]:
+    """
+    (is_system, label, text): the text of a system message (no label), or the
+    conversation line `label + text` of any other role.
+    """
+    role = (message.get("role") or "").lower()
+    text = message_text(message)
+    if role == "system":
+        return True, "", text
+    # user, or unknown role -> treat as user
+    label = "Assistant:" if role == "assistant" else "User:"
+    # Same line as f"{label} {text}".strip(); rstrip() returns `text` itself when there's nothing to strip
+    text = text.rstrip()
+    return False, label + " " if text else label, text
+
+
+def _line_tokens(label: str, text: str) -> int:
+    # estimate_tokens(label + text) without building the line
+    return (len(label) + len(text) + 3) // 4
+
+
+def _add_line(convo: List[str], label: str, text: str) -> None:
+    if convo:
+        label = "\n" + label
+    # Short lines are one piece; a long text is a piece of its own, so it's only copied into the prompt
+    if len(text) <= _COPY_CHARS:
+        convo.append(label + text)
+    else:
+        convo += (label, text)
+
+
+def assemble(system: str, convo: Sequence[str]) -> str:
+    """Final prompt from the joined system parts and the conversation line pieces."""
+    pieces: List[str] = []
+    if system:
+        pieces += ("System:\n", system.strip(), "\n\n")
+    pieces += convo
+
+    # Nudge toward next assistant turn
+    last = next((piece for piece in reversed(pieces) if piece), "")
+    if last and not last.endswith("\n"):
+        pieces.append("\n")
+    pieces.append("Assistant:")
+    return "".join(pieces)
+
+
+class _Prefix(NamedTuple):
+    system: str
+    # Conversation line pieces (see `_add_line`)
+    convo: Tuple[str, ...]
+    tokens: int
+    snapshot: Snapshot
+    # Characters of message text in `convo`
+    chars: int
+
+
+class PromptResult(NamedTuple):
+    prompt: str
+    tokens: int
+    dropped: int
+
+
+# Message texts up to this long are copied into their conversation line
+_COPY_CHARS = 4096
+
+# How many of the latest positions are checked for a memoized prefix (an append-only
+# client usually adds 2 messages per request, more with tool calls)
+_PREFIX_PROBES = 8
+
+
+def _entry_key(snapshot: Snapshot, n: int) -> Tuple[Any, ...]:
+    # Cheap to compute and to hash; equality of the whole snapshot is checked on lookup
+    first, last = snapshot[0], snapshot[n - 1]
+    return (n, first[0], _hashable(first[1]), last[0], _hashable(last[1]))
+
+
+def _hashable(content: Any) -> Any:
+    return content if isinstance(content, str) or content is None else dumps(content)
+
+
+class PromptBuilder:
+    def __init__(
+        self,
+        memo_max_bytes: int = 32 * 1024 * 1024,
+        keep_system: bool = True,
+        keep_first_user: bool = True,
+        keep_recent_turns: int = 0,
+    ) -> None:
+        self.memo_max_bytes = memo_max_bytes
+        self.keep_system = keep_system
+        self.keep_first_user = keep_first_user
+        # 0 keeps as many recent turns as fit the budget
+        self.keep_recent_turns = keep_recent_turns
+        self._memo: "OrderedDict[Tuple[Any, ...], _Prefix]" = OrderedDict()
+        self._memo_bytes = 0
+
+        self.builds = 0
+        self.prefix_hits = 0
+        self.messages_rendered = 0
+        self.messages_reused = 0
+        self.truncated = 0
+        self.messages_dropped = 0
+
+    def build(self, messages: Sequence[Dict[str, Any]], budget_tokens: int = 0) -> PromptResult:
+        """
+        Flatten `messages`. With `budget_tokens` > 0, turns are dropped (see module docs)
+        until the estimated prompt size fits, or only the protected turns are left.
+        """
+        self.builds += 1
+        snapshot: Snapshot = [(m.get("role"), m.get("content")) for m in messages]
+
+        start, prefix = 0, _Prefix("", (), 0, [], 0)
+        if self.memo_max_bytes:
+            for n in range(len(messages), max(0, len(messages) - _PREFIX_PROBES), -1):
+                key = _entry_key(snapshot, n)
+                found = self._memo.get(key)
+                if found is not None and found.snapshot == snapshot[:n]:
+                    self._memo.move_to_end(key)
+                    start, prefix = n, found
+                    self.prefix_hits += 1
+                    break
+        self.messages_reused += start
+
+        system_parts = [prefix.system] if prefix.system else []
+        convo = list(prefix.convo)
+        tokens = prefix.tokens
+        chars = prefix.chars
+        for m in messages[start:]:
+            is_system, label, text = render_message(m)
+            if is_system:
+                if text:
+                    system_parts.append(text)
+                    tokens += estimate_tokens(text)
+            else:
+                _add_line(convo, label, text)
+                tokens += _line_tokens(label, text)
+                chars += len(text)
+        system = "\n\n".join(system_parts)
+        self.messages_rendered += len(messages) - start
+        if self.memo_max_bytes and start < len(messages):
+            self._remember(_entry_key(snapshot, len(messages)), _Prefix(system, tuple(convo), tokens, snapshot, chars))
+
+        if budget_tokens > 0 and tokens > budget_tokens:
+            return self._truncate(messages, budget_tokens)
+        return PromptResult(assemble(system, convo), tokens, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "builds": self.builds,
+            "prefix_hits": self.prefix_hits,
+            "messages_rendered": self.messages_rendered,
+            "messages_reused": self.messages_reused,
+            "memo_entries": len(self._memo),
+            "memo_bytes": self._memo_bytes,
+            "truncated": self.truncated,
+            "messages_dropped": self.messages_dropped,
+        }
+
+    def _truncate(self, messages: Sequence[Dict[str, Any]], budget_tokens: int) -> PromptResult:
+        rendered = [render_message(m) for m in messages]
+        cost = [_line_tokens(label, text) if (text or not is_system) else 0 for is_system, label, text in rendered]
+        keep = [False] * len(messages)
+
+        first_user: Optional[int] = None
+        for i, m in enumerate(messages):
+            if (m.get("role") or "").lower() not in ("system", "assistant"):
+                first_user = i
+                break
+        for i, (is_system, _, _) in enumerate(rendered):
+            if (is_system and self.keep_system) or (i == first_user and self.keep_first_user):
+                keep[i] = True
+        # The latest turn is what the model answers; it is never dropped
+        keep[-1] = True
+        used = sum(c for c, k in zip(cost, keep) if k)
+
+        recent = 1
+        for i in range(len(messages) - 2, -1, -1):
+            if keep[i]:
+                continue
+            if self.keep_recent_turns and recent >= self.keep_recent_turns:
+                break
+            if used + cost[i] > budget_tokens:
+                break
+            keep[i] = True
+            used += cost[i]
+            recent += 1
+
+        system_parts: List[str] = []
+        convo: List[str] = []
+        for (is_system, label, text), k in zip(rendered, keep):
+            if not k:
+                continue
+            if is_system:
+                if text:
+                    system_parts.append(text)
+            else:
+                _add_line(convo, label, text)
+        dropped = keep.count(False)
+        self.truncated += 1
+        self.messages_dropped += dropped
+        return PromptResult(assemble("\n\n".join(system_parts), convo), used, dropped)
+
+    def _remember(self, key: Tuple[Any, ...], prefix: _Prefix) -> None:
+        size = _prefix_size(prefix)
+        if size > self.memo_max_bytes:
+            return
+        # Conversations with different middles can share a key: the new one replaces the old
+        old = self._memo.pop(key, None)
+        if old is not None:
+            self._memo_bytes -= _prefix_size(old)
+        self._memo[key] = prefix
+        self._memo_bytes += size
+        while self._memo_bytes > self.memo_max_bytes:
+            _, old = self._memo.popitem(last=False)
+            self._memo_bytes -= _prefix_size(old)
+
+
+def _prefix_size(prefix: _Prefix) -> int:
+    # The line pieces share the message strings the snapshot keeps alive; count them
+    # once, plus a pointer per piece
+    return len(prefix.system) + prefix.chars + 8 * len(prefix.convo)
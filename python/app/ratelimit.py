@@ -0,0 +1,219 @@
+"""
+Per-client rate limits.
+
+Callers are told apart by a configurable header (e.g. `X-Client-Id`) or by their
+bearer token (only a digest of it is kept), falling back to the peer address. Each
+client gets two token buckets: requests per second, with a burst, and prompt tokens
+per minute. Buckets refill lazily when the client is seen, so a check is a dict
+lookup and a little arithmetic. Clients are kept in LRU order: those idle long
+enough for their buckets to be full again (no different from a new client) are
+dropped as others arrive, and `max_clients` bounds the table regardless.
+
+`RateLimitHeadersMiddleware` adds the `x-ratelimit-*` headers of the request's
+check (stored in the ASGI scope state) to whatever response the route sends.
+"""
+import hashlib
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+Scope = Dict[str, Any]
+Message = Dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+# Key of the scope state entry holding the headers of the request's rate-limit check
+STATE_KEY = "ratelimit_headers"
+
+
+def client_id(headers: Any, header: str = "", peer: Optional[str] = None) -> str:
+    """
+    Identity of the caller: the value of `header` when configured and sent, else a
+    digest of the bearer token, else the peer address.
+    """
+    if header:
+        value = headers.get(header)
+        if value:
+            return value.strip()
+    scheme, _, token = (headers.get("authorization") or "").partition(" ")
+    if scheme.lower() == "bearer" and token.strip():
+        return "key-" + hashlib.sha256(token.strip().encode("utf-8")).hexdigest()[:16]
+    return "ip-" + (peer or "unknown")
+
+
+class _Bucket:
+    __slots__ = ("capacity", "rate", "tokens")
+
+    def __init__(self, capacity: float, rate: float) -> None:
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+
+    def refill(self, elapsed: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+
+    def wait(self, cost: float) -> float:
+        """Seconds until `cost` can be taken. A cost over the capacity only needs a full bucket (and leaves a debt)."""
+        missing = min(cost, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def reset(self) -> float:
+        """Seconds until the bucket is full again."""
+        return (self.capacity - self.tokens) / self.rate
+
+
+class _Client:
+    __slots__ = ("requests", "tokens", "seen")
+
+    def __init__(self, requests: Optional[_Bucket], tokens: Optional[_Bucket], now: float) -> None:
+        self.requests = requests
+        self.tokens = tokens
+        self.seen = now
+
+    def refill(self, now: float) -> None:
+        elapsed = now - self.seen
+        self.seen = now
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.refill(elapsed)
+
+    def full(self) -> bool:
+        return all(b is None or b.tokens >= b.capacity for b in (self.requests, self.tokens))
+
+
+class RateDecision(NamedTuple):
+    allowed: bool
+    # Seconds until the request would be allowed (0 when allowed)
+    retry_after: float
+    # "requests" or "tokens" when rejected
+    limit: Optional[str]
+    headers: List[Tuple[str, str]]
+
+
+def _duration(seconds: float) -> str:
+    # Same format as OpenAI's x-ratelimit-reset-* headers: 0.5s, 12s, 1m30s
+    if seconds < 60:
+        return f"{math.ceil(seconds * 1000) / 1000:g}s"
+    minutes, rest = divmod(math.ceil(seconds), 60)
+    return f"{minutes}m{rest}s"
+
+
+class ClientRateLimiter:
+    def __init__(
+        self,
+        requests_per_second: float = 0.0,
+        burst: int = 0,
+        tokens_per_minute: int = 0,
+        max_clients: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        # 0 disables a limit; the request burst defaults to one second's worth
+        self.requests_per_second = requests_per_second
+        self.burst = burst or max(1, math.ceil(requests_per_second))
+        self.tokens_per_minute = tokens_per_minute
+        self.max_clients = max_clients
+        self._clock = clock
+        self._clients: "OrderedDict[str, _Client]" = OrderedDict()
+
+        self.allowed = 0
+        self.limited_requests = 0
+        self.limited_tokens = 0
+        self.evicted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.requests_per_second or self.tokens_per_minute)
+
+    def check(self, client: str, tokens: int = 0) -> RateDecision:
+        """Take one request and `tokens` prompt tokens from `client`'s buckets, if both have them."""
+        now = self._clock()
+        state = self._clients.get(client)
+        if state is None:
+            state = _Client(
+                _Bucket(self.burst, self.requests_per_second) if self.requests_per_second else None,
+                _Bucket(self.tokens_per_minute, self.tokens_per_minute / 60) if self.tokens_per_minute else None,
+                now,
+            )
+            self._clients[client] = state
+            self._evict(now)
+        else:
+            self._clients.move_to_end(client)
+            state.refill(now)
+
+        waits = []
+        if state.requests is not None:
+            waits.append((state.requests.wait(1), "requests"))
+        if state.tokens is not None:
+            waits.append((state.tokens.wait(tokens), "tokens"))
+        wait, limit = max(waits, default=(0.0, None))
+        if wait > 0:
+            if limit == "requests":
+                self.limited_requests += 1
+            else:
+                self.limited_tokens += 1
+            return RateDecision(False, wait, limit, self._headers(state))
+
+        if state.requests is not None:
+            state.requests.tokens -= 1
+        if state.tokens is not None:
+            state.tokens.tokens -= tokens
+        self.allowed += 1
+        return RateDecision(True, 0.0, None, self._headers(state))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests_per_second": self.requests_per_second,
+            "burst": self.burst,
+            "tokens_per_minute": self.tokens_per_minute,
+            "clients": len(self._clients),
+            "max_clients": self.max_clients,
+            "allowed": self.allowed,
+            "limited_requests": self.limited_requests,
+            "limited_tokens": self.limited_tokens,
+            "evicted": self.evicted,
+        }
+
+    def _headers(self, state: _Client) -> List[Tuple[str, str]]:
+        headers = []
+        for name, bucket in (("requests", state.requests), ("tokens", state.tokens)):
+            if bucket is not None:
+                headers += [
+                    (f"x-ratelimit-limit-{name}", str(int(bucket.capacity))),
+                    (f"x-ratelimit-remaining-{name}", str(max(0, math.floor(bucket.tokens)))),
+                    (f"x-ratelimit-reset-{name}", _duration(bucket.reset())),
+                ]
+        return headers
+
+    def _evict(self, now: float) -> None:
+        # The least recently seen clients are at the front; stop at the first one still refilling
+        while self._clients:
+            oldest_id, oldest = next(iter(self._clients.items()))
+            if len(self._clients) <= self.max_clients:
+                oldest.refill(now)
+                if not oldest.full() or len(self._clients) == 1:
+                    return
+            del self._clients[oldest_id]
+            self.evicted += 1
+
+
+class RateLimitHeadersMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = (scope.get("state") or {}).get(STATE_KEY)
+                if headers:
+                    message["headers"] = list(message.get("headers") or []) + [
+                        (name.encode("latin-1"), value.encode("latin-1")) for name, value in headers
+                    ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
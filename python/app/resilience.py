@@ -0,0 +1,154 @@
+"""
+Failure handling for Ask Sage calls: circuit breakers and budgeted retries.
+
+A `CircuitBreaker` per upstream endpoint opens after consecutive failures, so
+calls fail fast while Ask Sage is down instead of each waiting for a timeout,
+then lets a limited number of probe calls through (half-open) to detect recovery.
+
+Retries back off exponentially with full jitter and draw from a `RetryBudget`
+that allows retries up to a fraction of recent requests (plus a small floor), so
+retrying can't multiply the load on an upstream that is already struggling.
+"""
+import math
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("circuit open")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, open_seconds: float = 30.0, half_open_calls: int = 1) -> None:
+        # 0 disables the breaker
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_open_calls = max(1, half_open_calls)
+
+        self.consecutive_failures = 0
+        self.opened_until = 0.0
+        self._opened = False
+        self._probes = 0
+
+        self.opens = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if not self._opened:
+            return CLOSED
+        return OPEN if time.monotonic() < self.opened_until else HALF_OPEN
+
+    def before_call(self) -> bool:
+        """
+        Admit a call or raise CircuitOpen. Returns True if the call is a half-open probe;
+        pass that to `record()` / `release()` when it ends.
+        """
+        state = self.state
+        if state == CLOSED:
+            return False
+        if state == OPEN:
+            self.rejected += 1
+            raise CircuitOpen(max(1, math.ceil(self.opened_until - time.monotonic())))
+        if self._probes >= self.half_open_calls:
+            self.rejected += 1
+            raise CircuitOpen(1)
+        self._probes += 1
+        return True
+
+    def record(self, success: bool, probe: bool = False) -> None:
+        self.release(probe)
+        if success:
+            self.consecutive_failures = 0
+            self._opened = False
+            return
+        self.consecutive_failures += 1
+        if not self.failure_threshold:
+            return
+        if probe or self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.opens += 1
+            self._opened = True
+            self.opened_until = time.monotonic() + self.open_seconds
+
+    def release(self, probe: bool = False) -> None:
+        """End a call without an outcome (e.g. cancelled)."""
+        if probe:
+            self._probes -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        state = self.state
+        return {
+            "state": state,
+            "consecutive_failures": self.consecutive_failures,
+            "open_for": round(max(0.0, self.opened_until - time.monotonic()), 3) if state == OPEN else 0.0,
+            "opens": self.opens,
+            "rejected": self.rejected,
+        }
+
+
+class RetryBudget:
+    """
+    Allows retries up to `ratio` of the requests seen in the last `window` seconds,
+    plus `min_per_second` so low-traffic periods can still retry.
+    """
+
+    def __init__(self, ratio: float = 0.1, min_per_second: float = 1.0, window: int = 10) -> None:
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = max(1, int(window))
+        # One [second, requests, retries] bucket per second of the window
+        self._buckets: List[List[int]] = [[0, 0, 0] for _ in range(self.window)]
+
+        self.retries = 0
+        self.exhausted = 0
+
+    def record_request(self) -> None:
+        self._bucket(int(time.monotonic()))[1] += 1
+
+    def try_withdraw(self) -> bool:
+        """Take one retry from the budget; False if it is spent."""
+        now = int(time.monotonic())
+        requests = retries = 0
+        for second, reqs, rets in self._buckets:
+            if second > now - self.window:
+                requests += reqs
+                retries += rets
+        if retries >= self.ratio * requests + self.min_per_second * self.window:
+            self.exhausted += 1
+            return False
+        self._bucket(now)[2] += 1
+        self.retries += 1
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ratio": self.ratio,
+            "min_per_second": self.min_per_second,
+            "retries": self.retries,
+            "exhausted": self.exhausted,
+        }
+
+    def _bucket(self, second: int) -> List[int]:
+        bucket = self._buckets[second % self.window]
+        if bucket[0] != second:
+            bucket[:] = [second, 0, 0]
+        return bucket
+
+
+def backoff_delay(attempt: int, base: float, cap: float, retry_after: Optional[float] = None) -> float:
+    """
+    Full-jitter exponential backoff for retry number `attempt` (1-based). A server's
+    Retry-After is honoured as a lower bound, still capped at `cap`.
+    """
+    delay = random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return min(cap, delay)
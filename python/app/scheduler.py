@@ -0,0 +1,212 @@
+"""
+Admission control for upstream Ask Sage calls.
+
+A global concurrency limit and optional per-model limits cap how many calls are
+outstanding upstream. Callers over the limit wait in a bounded queue, ordered by
+priority class, then by fair share between clients; callers that can't be queued,
+or wait longer than `max_wait`, are rejected so the proxy can answer 429 right away
+instead of piling up sockets while Ask Sage is slow.
+
+Within a priority class the queue is weighted fair (self-clocked fair queuing):
+each waiter is stamped with a virtual finish time, its client's previous stamp (or
+the stamp of the call last admitted, if later) plus 1 / the client's weight, and
+slots go to the smallest stamp. A client that queues hundreds of calls therefore
+gets its weighted share of the slots as they free up, not all of them in a row,
+and calls of a single client still run in arrival order.
+"""
+import asyncio
+import bisect
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+# Priority classes: lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: int) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("sort_key", "model", "client", "future")
+
+    def __init__(self, sort_key: Any, model: str, client: str, future: "asyncio.Future[None]") -> None:
+        self.sort_key = sort_key
+        self.model = model
+        self.client = client
+        self.future = future
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return self.sort_key < other.sort_key
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_concurrency: int = 0,
+        model_limits: Optional[Dict[str, int]] = None,
+        max_queue: int = 0,
+        max_wait: float = 0.0,
+        weights: Optional[Dict[str, float]] = None,
+    ) -> None:
+        # 0 means "no limit" for max_concurrency / model limits / max_queue / max_wait
+        self.max_concurrency = max_concurrency
+        self.model_limits = dict(model_limits or {})
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        # Fair-queuing weight per client (default 1)
+        self.weights = dict(weights or {})
+
+        self.active = 0
+        self.model_active: Dict[str, int] = {}
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        # Virtual time (stamp of the call last admitted from the queue) and, for clients
+        # with queued calls only, their latest stamp and number of queued calls
+        self._virtual = 0.0
+        self._finish: Dict[str, float] = {}
+        self._client_queued: Dict[str, int] = {}
+        # Smoothed time a slot is held, used to suggest Retry-After
+        self._hold_ewma = 1.0
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_concurrency or self.model_limits)
+
+    @asynccontextmanager
+    async def slot(self, model: str, priority: int = PRIORITY_BATCH, client: str = "") -> AsyncIterator[None]:
+        await self.acquire(model, priority, client)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._hold_ewma += 0.2 * ((time.monotonic() - started) - self._hold_ewma)
+            self.release(model)
+
+    def check(self, model: str) -> None:
+        """Raise AdmissionRejected if a call for `model` would be rejected right now."""
+        if not self._can_run(model) and self.max_queue and len(self._queue) >= self.max_queue:
+            self.rejected_full += 1
+            raise AdmissionRejected("queue full", self.retry_after())
+
+    async def acquire(self, model: str, priority: int = PRIORITY_BATCH, client: str = "") -> None:
+        if self._can_run(model):
+            self._grant(model)
+            self._record_wait(0.0)
+            return
+
+        self.check(model)
+        finish = max(self._virtual, self._finish.get(client, 0.0)) + 1.0 / self.weights.get(client, 1.0)
+        self._finish[client] = finish
+        self._client_queued[client] = self._client_queued.get(client, 0) + 1
+        waiter = _Waiter((priority, finish, next(self._seq)), model, client, asyncio.get_running_loop().create_future())
+        bisect.insort(self._queue, waiter)
+        self.queued += 1
+        started = time.monotonic()
+        try:
+            done, _ = await asyncio.wait({waiter.future}, timeout=self.max_wait or None)
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        if not done:
+            self._abandon(waiter)
+            self.rejected_timeout += 1
+            raise AdmissionRejected("queue wait timed out", self.retry_after())
+        self._record_wait(time.monotonic() - started)
+
+    def release(self, model: str) -> None:
+        self.active -= 1
+        self.model_active[model] -= 1
+        self._dispatch()
+
+    def retry_after(self) -> int:
+        """Rough seconds until a queued call would start, for the Retry-After header."""
+        lanes = self.max_concurrency or max(1, self.active)
+        estimate = (len(self._queue) + 1) * self._hold_ewma / lanes
+        return int(min(60, max(1, math.ceil(estimate))))
+
+    def stats(self) -> Dict[str, Any]:
+        admitted = self.admitted or 1
+        return {
+            "max_concurrency": self.max_concurrency,
+            "model_limits": self.model_limits,
+            "max_queue": self.max_queue,
+            "max_wait": self.max_wait,
+            "active": self.active,
+            "active_by_model": {m: n for m, n in self.model_active.items() if n},
+            "queue_depth": len(self._queue),
+            "clients_queued": len(self._client_queued),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+            "wait_seconds_avg": round(self.wait_seconds_total / admitted, 6),
+            "wait_seconds_max": round(self.wait_seconds_max, 6),
+        }
+
+    def _can_run(self, model: str) -> bool:
+        if self.max_concurrency and self.active >= self.max_concurrency:
+            return False
+        limit = self.model_limits.get(model, 0)
+        return not limit or self.model_active.get(model, 0) < limit
+
+    def _grant(self, model: str) -> None:
+        self.active += 1
+        self.model_active[model] = self.model_active.get(model, 0) + 1
+        self.admitted += 1
+
+    def _dispatch(self) -> None:
+        # Waiters blocked only by their own model's limit don't hold up other models
+        i = 0
+        while i < len(self._queue):
+            if self.max_concurrency and self.active >= self.max_concurrency:
+                return
+            waiter = self._queue[i]
+            if self._can_run(waiter.model):
+                del self._queue[i]
+                self._virtual = max(self._virtual, waiter.sort_key[1])
+                self._dequeued(waiter)
+                self._grant(waiter.model)
+                waiter.future.set_result(None)
+            else:
+                i += 1
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        if waiter.future.done():
+            # Granted just as the caller gave up: hand the slot on
+            self.admitted -= 1
+            self.release(waiter.model)
+            return
+        waiter.future.cancel()
+        i = bisect.bisect_left(self._queue, waiter)
+        if i < len(self._queue) and self._queue[i] is waiter:
+            del self._queue[i]
+            self._dequeued(waiter)
+
+    def _dequeued(self, waiter: _Waiter) -> None:
+        # A client without queued calls starts again from the current virtual time
+        left = self._client_queued[waiter.client] - 1
+        if left:
+            self._client_queued[waiter.client] = left
+        else:
+            del self._client_queued[waiter.client]
+            del self._finish[waiter.client]
+
+    def _record_wait(self, seconds: float) -> None:
+        self.wait_seconds_total += seconds
+        if seconds > self.wait_seconds_max:
+            self.wait_seconds_max = seconds
@@ -0,0 +1,78 @@
+"""
+State shared by the worker processes of one proxy (see `python -m app`).
+
+Each worker keeps one row of a SQLite database (WAL mode, so readers never wait
+for writers) up to date: a heartbeat, a health summary and a snapshot of its
+metrics. Whichever worker answers `/healthz` or `/metrics` merges the rows of the
+workers that are alive; rows whose heartbeat stopped (a crashed worker) are removed.
+"""
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from .fastjson import dumps, loads
+
+
+class SharedState:
+    def __init__(self, path: str, worker_id: str, stale_after: float = 10.0) -> None:
+        self.path = path
+        self.worker_id = worker_id
+        self.stale_after = stale_after
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        # Opened on first use, in the worker process (never inherited across a fork)
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS workers ("
+                " id TEXT PRIMARY KEY, pid INTEGER NOT NULL, started_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL, health BLOB NOT NULL, metrics BLOB NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def publish(self, health: Dict[str, Any], metrics: List[Any]) -> None:
+        with self._lock:
+            self._db().execute(
+                "INSERT OR REPLACE INTO workers (id, pid, started_at, updated_at, health, metrics) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.worker_id, os.getpid(), self.started_at, time.time(), dumps(health), dumps(metrics)),
+            )
+
+    def workers(self) -> List[Dict[str, Any]]:
+        """Rows of the live workers, oldest first, with decoded health and metrics."""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM workers WHERE updated_at < ?", (now - self.stale_after,))
+            rows = db.execute(
+                "SELECT id, pid, started_at, updated_at, health, metrics FROM workers ORDER BY started_at, id"
+            ).fetchall()
+        return [
+            {
+                "id": worker_id,
+                "pid": pid,
+                "started_at": started_at,
+                "age": round(now - updated_at, 3),
+                "health": loads(health),
+                "metrics": loads(metrics),
+            }
+            for worker_id, pid, started_at, updated_at, health, metrics in rows
+        ]
+
+    def remove(self) -> None:
+        """Drop this worker's row (clean shutdown)."""
+        with self._lock:
+            self._db().execute("DELETE FROM workers WHERE id = ?", (self.worker_id,))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
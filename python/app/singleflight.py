@@ -0,0 +1,65 @@
+"""
+Single-flight call deduplication.
+
+Concurrent callers asking for the same key share one in-flight upstream call
+instead of each issuing their own. The shared call runs as its own task, so a
+waiter being cancelled (e.g. a client disconnecting) never cancels the call for
+the remaining waiters; only when the last waiter goes away is the call dropped.
+"""
+import asyncio
+import functools
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: "asyncio.Task[Any]") -> None:
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, _Call] = {}
+        # Number of calls actually started vs. callers that joined one already in flight
+        self.started = 0
+        self.shared = 0
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        loop = asyncio.get_running_loop()
+        call = self._calls.get(key)
+        # A call bound to another (e.g. already closed) event loop can't be awaited here
+        if call is None or call.task.done() or call.task.get_loop() is not loop:
+            call = _Call(loop.create_task(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(functools.partial(self._finish, key, call))
+            self.started += 1
+        else:
+            self.shared += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            # Last interested caller left: nobody will read the result
+            if call.waiters == 1 and not call.task.done():
+                call.task.cancel()
+                # Late callers must start a fresh call rather than join the cancelled one
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _finish(self, key: Hashable, call: _Call, task: "asyncio.Task[Any]") -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved; every waiter re-raises it already
+            task.exception()
@@ -0,0 +1,135 @@
+"""
+Per-request phase timings, reported in the `Server-Timing` response header.
+
+`ServerTimingMiddleware` puts a `RequestTiming` in a context variable for each
+request; code on the request path wraps its phases in `phase(name)` (or calls
+`record(name, started)`), and tasks the request spawns share the same timing.
+Durations of a phase that runs several times (retries, `n` > 1) add up. The
+header is written when the response starts, so a streamed response reports the
+phases up to its first byte.
+
+With the middleware disabled there is no timing in the context and `phase()`
+returns a shared no-op context manager: the cost is one context variable lookup.
+"""
+import contextlib
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, ContextManager, Dict, Optional
+
+Scope = Dict[str, Any]
+Message = Dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+_current: ContextVar[Optional["RequestTiming"]] = ContextVar("asksage_request_timing", default=None)
+_NOOP = contextlib.nullcontext()
+
+
+class RequestTiming:
+    __slots__ = ("started", "phases")
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        # Insertion-ordered: phases are reported in the order they first ran
+        self.phases: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def as_dict(self) -> Dict[str, float]:
+        """Milliseconds per phase, plus `total` so far."""
+        out = {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()}
+        out["total"] = round((time.perf_counter() - self.started) * 1000, 3)
+        return out
+
+    def header(self) -> str:
+        return ", ".join(f"{name};dur={ms}" for name, ms in self.as_dict().items())
+
+
+class _Phase:
+    __slots__ = ("timing", "name", "started")
+
+    def __init__(self, timing: RequestTiming, name: str) -> None:
+        self.timing = timing
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc: Any) -> None:
+        self.timing.add(self.name, time.perf_counter() - self.started)
+
+
+def current() -> Optional[RequestTiming]:
+    return _current.get()
+
+
+def phase(name: str) -> ContextManager[None]:
+    """Time the enclosed block as `name` (no-op outside a timed request)."""
+    timing = _current.get()
+    if timing is None:
+        return _NOOP
+    return _Phase(timing, name)
+
+
+def record(name: str, started: float) -> None:
+    """Add the time since `started` (a `time.perf_counter()` value) to `name`."""
+    timing = _current.get()
+    if timing is not None:
+        timing.add(name, time.perf_counter() - started)
+
+
+class UpstreamTrace:
+    """
+    httpx `trace` extension splitting an upstream call: `pool` is the wait for a
+    connection (until the first connection event), `connect` the TCP and TLS setup
+    of a new connection. Both are part of the caller's `upstream` phase.
+    """
+
+    __slots__ = ("timing", "started", "connecting")
+
+    def __init__(self, timing: RequestTiming) -> None:
+        self.timing = timing
+        self.started: Optional[float] = time.perf_counter()
+        self.connecting: Optional[float] = None
+
+    async def __call__(self, event: str, info: Dict[str, Any]) -> None:
+        now = time.perf_counter()
+        if self.started is not None:
+            self.timing.add("pool", now - self.started)
+            self.started = None
+        if event == "connection.connect_tcp.started":
+            self.connecting = now
+        elif self.connecting is not None and event in ("connection.connect_tcp.failed", "connection.start_tls.failed"):
+            self.timing.add("connect", now - self.connecting)
+            self.connecting = None
+        elif self.connecting is not None and event.endswith(".send_request_headers.started"):
+            self.timing.add("connect", now - self.connecting)
+            self.connecting = None
+
+
+class ServerTimingMiddleware:
+    def __init__(self, app: ASGIApp, enabled: Callable[[], bool]) -> None:
+        self.app = app
+        # Resolved per request so timing can be switched at runtime (and in tests)
+        self.enabled = enabled
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.enabled():
+            await self.app(scope, receive, send)
+            return
+        timing = RequestTiming()
+
+        async def send_with_timing(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers") or []) + [
+                    (b"server-timing", timing.header().encode("latin-1"))
+                ]
+            await send(message)
+
+        token = _current.set(timing)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
@@ -0,0 +1,124 @@
+"""
+Bytes on the wire and CPU cost per response codec and level.
+
+Three bodies the proxy sends: a large /v1/models list, a long non-streamed chat
+completion and the same completion streamed as SSE (compressed and flushed per
+event, as the middleware does). For each codec and level the benchmark reports the
+compressed size, the ratio and the compress and decompress time per MB of input.
+
+    cd python
+    python bench/bench_compression.py --levels gzip=1,5,9 br=1,4,7 zstd=1,3,9
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.compression import DEFAULT_LEVELS, Compressor, available_codecs, brotli, zstandard  # noqa: E402
+
+
+def make_bodies(models: int, answer_chars: int, chunk_chars: int):
+    listing = {
+        "object": "list",
+        "data": [
+            {"id": f"model-{i}-{'large' if i % 3 else 'mini'}", "object": "model", "created": 1700000000 + i, "owned_by": "asksage"}
+            for i in range(models)
+        ],
+    }
+    sentence = "The proxy forwards the request, waits for the answer and renders it as an OpenAI response. "
+    answer = (sentence * (answer_chars // len(sentence) + 1))[:answer_chars]
+    completion = {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "model": "gpt-4o-mini",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+    }
+    events = [
+        b"data: " + json.dumps({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "choices": [{"index": 0, "delta": {"content": answer[i:i + chunk_chars]}}],
+        }).encode() + b"\n\n"
+        for i in range(0, len(answer), chunk_chars)
+    ] + [b"data: [DONE]\n\n"]
+    return {
+        "models": [json.dumps(listing).encode()],
+        "completion": [json.dumps(completion).encode()],
+        "sse": events,
+    }
+
+
+def compress(codec: str, level: int, chunks, flush_each: bool) -> bytes:
+    compressor = Compressor(codec, level)
+    out = []
+    for chunk in chunks:
+        out.append(compressor.compress(chunk))
+        if flush_each:
+            out.append(compressor.flush())
+    out.append(compressor.finish())
+    return b"".join(out)
+
+
+def decompress(codec: str, data: bytes) -> bytes:
+    if codec == "gzip":
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if codec == "br":
+        return brotli.decompress(data)
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+def best_of(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def parse_levels(items):
+    levels = {codec: [level] for codec, level in DEFAULT_LEVELS.items()}
+    for item in items:
+        codec, _, values = item.partition("=")
+        levels[codec] = [int(v) for v in values.split(",") if v]
+    return {codec: values for codec, values in levels.items() if codec in available_codecs()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", type=int, default=500, help="entries in the model list")
+    parser.add_argument("--answer-chars", type=int, default=20000, help="length of the completion")
+    parser.add_argument("--chunk-chars", type=int, default=40, help="characters per SSE event")
+    parser.add_argument("--levels", nargs="*", default=[], help="codec=level,level,... (default: the proxy's levels)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    results = []
+    for name, chunks in make_bodies(args.models, args.answer_chars, args.chunk_chars).items():
+        raw = sum(len(c) for c in chunks)
+        for codec, levels in parse_levels(args.levels).items():
+            for level in levels:
+                flush_each = name == "sse"
+                data = compress(codec, level, chunks, flush_each)
+                assert decompress(codec, data) == b"".join(chunks)
+                seconds = best_of(lambda: compress(codec, level, chunks, flush_each), args.repeat)
+                decode = best_of(lambda: decompress(codec, data), args.repeat)
+                results.append({
+                    "body": name,
+                    "codec": codec,
+                    "level": level,
+                    "raw_bytes": raw,
+                    "wire_bytes": len(data),
+                    "ratio": round(raw / len(data), 2),
+                    "compress_ms_per_mb": round(seconds / raw * 1e9, 2),
+                    "decompress_ms_per_mb": round(decode / raw * 1e9, 2),
+                })
+    print(json.dumps({"codecs": available_codecs(), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Peak memory and CPU of taking in a large chat completion body.
+
+The body is a short conversation whose last user message is a pasted source tree
+of the requested size. Two paths are compared, from the first body chunk to the
+flattened prompt:
+
+- buffered: what the proxy did before: the chunks are joined into one bytes object
+  kept for the whole request, parsed, and the prompt is built by rendering each
+  line, joining the lines and concatenating the blocks;
+- streaming: chunks go through the message limits scanner into one buffer that is
+  dropped after parsing, and the prompt is built with a single join.
+
+A third run feeds the body with a per-message limit well below its size and
+reports the memory and CPU spent before the 413.
+
+    cd python
+    python bench/bench_ingest.py --sizes 1 10 50
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import HTTPException  # noqa: E402
+
+from app.fastjson import loads  # noqa: E402
+from app.ingest import MessageScanner, read_body  # noqa: E402
+from app.prompt import PromptBuilder, message_text  # noqa: E402
+
+CHUNK = 64 * 1024
+SOURCE = 'def handler(request):\n    """Return the "answer".\\n"""\n    return {"status": 200, "body": request.text}\n\n'
+
+
+def make_body(megabytes: int) -> bytes:
+    messages = [{"role": "system", "content": "You are a careful code reviewer."}]
+    for i in range(10):
+        messages.append({"role": "user", "content": f"Question {i} about the design."})
+        messages.append({"role": "assistant", "content": f"Answer {i}: it depends on the call sites."})
+    size = megabytes * 1024 * 1024
+    messages.append({"role": "user", "content": "Review this repository:\n" + SOURCE * (size // len(SOURCE))})
+    return json.dumps({"model": "gpt-4o-mini", "messages": messages}).encode()
+
+
+async def chunks(body: bytes):
+    for i in range(0, len(body), CHUNK):
+        yield body[i:i + CHUNK]
+
+
+def legacy_prompt(messages) -> str:
+    system_parts, convo_parts = [], []
+    for m in messages:
+        role = (m.get("role") or "").lower()
+        text = message_text(m)
+        if role == "system":
+            if text:
+                system_parts.append(text)
+        else:
+            convo_parts.append(f"{'Assistant' if role == 'assistant' else 'User'}: {text}".strip())
+    prompt = ""
+    system = "\n\n".join(system_parts)
+    if system:
+        prompt += "System:\n" + system.strip() + "\n\n"
+    prompt += "\n".join(convo_parts).strip()
+    if prompt and not prompt.endswith("\n"):
+        prompt += "\n"
+    return prompt + "Assistant:"
+
+
+async def buffered(body: bytes) -> int:
+    parts = [chunk async for chunk in chunks(body)]
+    raw = b"".join(parts)
+    del parts
+    data = loads(raw)
+    prompt = legacy_prompt(data["messages"])
+    # The request kept its body until the response was sent
+    return len(prompt) + len(raw)
+
+
+async def streaming(body: bytes) -> int:
+    data = loads(await read_body(chunks(body), MessageScanner(10000, 0)))
+    prompt = PromptBuilder(memo_max_bytes=0).build(data["messages"]).prompt
+    return len(prompt)
+
+
+async def rejected(body: bytes) -> int:
+    try:
+        await read_body(chunks(body), MessageScanner(10000, 1024 * 1024))
+    except HTTPException:
+        return 0
+    raise AssertionError("not rejected")
+
+
+def measure(fn, body: bytes):
+    """(peak traced MB, CPU ms); CPU is timed in a separate run, without tracemalloc's overhead."""
+    gc.collect()
+    started = time.process_time()
+    asyncio.run(fn(body))
+    cpu = time.process_time() - started
+    gc.collect()
+    tracemalloc.start()
+    asyncio.run(fn(body))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(peak / 2**20, 1), round(cpu * 1000, 1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 50], help="body sizes in MB")
+    args = parser.parse_args()
+
+    results = []
+    for megabytes in args.sizes:
+        body = make_body(megabytes)
+        row = {"body_mb": round(len(body) / 2**20, 1)}
+        for name, fn in (("buffered", buffered), ("streaming", streaming), ("rejected_1mb_limit", rejected)):
+            peak, cpu = measure(fn, body)
+            row[f"{name}_peak_mb"] = peak
+            row[f"{name}_cpu_ms"] = cpu
+        results.append(row)
+    print(json.dumps({"chunk_bytes": CHUNK, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+JSON handling cost per chat completion: stdlib path vs. the orjson-backed path.
+
+For each payload size the benchmark runs what the chat route does with JSON:
+decode the request body, decode the Ask Sage response, render the JSON response
+and render one SSE frame carrying the answer.
+
+    cd python
+    python bench/bench_json.py --sizes 1024 102400 2097152
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import fastjson  # noqa: E402
+
+
+def make_payloads(size: int):
+    turn = "Please review this function and explain the edge cases. " * 4
+    messages = []
+    while sum(len(m["content"]) for m in messages) < size:
+        role = "user" if len(messages) % 2 == 0 else "assistant"
+        messages.append({"role": role, "content": turn})
+    request = json.dumps({"model": "gpt-4o-mini", "messages": messages, "temperature": 0}).encode()
+    answer = "x" * max(1, size // 4)
+    upstream = json.dumps({"message": answer, "usage": {"prompt_tokens": size // 4, "completion_tokens": 10}}).encode()
+    return request, upstream
+
+
+def stdlib_path(request: bytes, upstream: bytes) -> None:
+    body = json.loads(request)
+    data = json.loads(upstream)
+    out = {"object": "chat.completion", "model": body["model"], "choices": [{"message": {"content": data["message"]}}]}
+    json.dumps(out, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+    chunk = {"object": "chat.completion.chunk", "choices": [{"delta": {"content": data["message"]}}]}
+    f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+
+def fast_path(request: bytes, upstream: bytes) -> None:
+    body = fastjson.loads(request)
+    data = fastjson.loads(upstream)
+    out = {"object": "chat.completion", "model": body["model"], "choices": [{"message": {"content": data["message"]}}]}
+    fastjson.dumps(out)
+    chunk = {"object": "chat.completion.chunk", "choices": [{"delta": {"content": data["message"]}}]}
+    b"data: " + fastjson.dumps(chunk) + b"\n\n"
+
+
+def measure(fn, request: bytes, upstream: bytes) -> float:
+    timer = timeit.Timer(lambda: fn(request, upstream))
+    loops, _ = timer.autorange()
+    best = min(timer.repeat(repeat=5, number=loops))
+    return best / loops * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 100 * 1024, 2 * 1024 * 1024])
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        request, upstream = make_payloads(size)
+        before = measure(stdlib_path, request, upstream)
+        after = measure(fast_path, request, upstream)
+        results.append({
+            "payload_bytes": len(request),
+            "stdlib_us": round(before, 1),
+            "fast_us": round(after, 1),
+            "speedup": round(before / after, 2),
+        })
+    print(json.dumps({"orjson": fastjson.orjson is not None, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Per-request overhead of metrics recording.
+
+1. Records everything a chat completion records (request counter/histogram, in-flight,
+   byte counters, upstream counter/histogram/in-flight, prompt size, tokens) in a loop.
+2. Drives a trivial ASGI app directly (no sockets) with and without MetricsMiddleware
+   and reports the difference per request.
+
+Exits non-zero if the overhead exceeds --budget-us (default 50).
+
+    cd python
+    python bench/bench_metrics.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.metrics import SIZE_BUCKETS, MetricsMiddleware, Registry  # noqa: E402
+
+
+def bench_recording(n: int) -> float:
+    registry = Registry()
+    mw = MetricsMiddleware(None, registry)
+    upstream = registry.counter("u_total", "", ("path", "status"))
+    upstream_lat = registry.histogram("u_seconds", "", ("path",))
+    upstream_inflight = registry.gauge("u_in_flight", "", ("path",))
+    prompt = registry.histogram("p_chars", "", buckets=SIZE_BUCKETS)
+    tokens = registry.counter("t_total", "", ("type",))
+    labels = ("POST", "/v1/chat/completions", "200")
+
+    started = time.perf_counter()
+    for i in range(n):
+        mw.in_flight.inc()
+        upstream_inflight.inc(1.0, ("query",))
+        upstream_inflight.dec(1.0, ("query",))
+        upstream_lat.observe(1.234, ("query",))
+        upstream.inc(1.0, ("query", "200"))
+        prompt.observe(4096)
+        tokens.inc(100, ("prompt",))
+        tokens.inc(20, ("completion",))
+        mw.in_flight.dec()
+        mw.requests.inc(1.0, labels)
+        mw.duration.observe(1.3, labels)
+        mw.request_bytes.inc(512, ("/v1/chat/completions",))
+        mw.response_bytes.inc(2048, ("/v1/chat/completions",))
+    return (time.perf_counter() - started) / n * 1e6
+
+
+async def _endpoint(scope, receive, send):
+    scope["route"] = type("R", (), {"path": "/v1/chat/completions"})()
+    await receive()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"{}"})
+
+
+async def _drive(app, n: int) -> float:
+    scope = {"type": "http", "method": "POST", "path": "/v1/chat/completions", "headers": []}
+    message = {"type": "http.request", "body": b"x" * 512, "more_body": False}
+
+    async def receive():
+        return message
+
+    async def send(_):
+        pass
+
+    started = time.perf_counter()
+    for _ in range(n):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - started) / n * 1e6
+
+
+def bench_middleware(n: int) -> float:
+    wrapped = MetricsMiddleware(_endpoint, Registry())
+    bare = asyncio.run(_drive(_endpoint, n))
+    instrumented = asyncio.run(_drive(wrapped, n))
+    return instrumented - bare
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=200_000)
+    parser.add_argument("--budget-us", type=float, default=50.0)
+    args = parser.parse_args()
+
+    result = {
+        "recording_us_per_request": round(bench_recording(args.n), 3),
+        "middleware_us_per_request": round(bench_middleware(args.n), 3),
+        "budget_us": args.budget_us,
+    }
+    print(json.dumps(result, indent=2))
+    total = result["recording_us_per_request"] + result["middleware_us_per_request"]
+    if total > args.budget_us:
+        sys.exit(f"metrics overhead {total:.1f}us exceeds {args.budget_us}us")
+
+
+if __name__ == "__main__":
+    main()
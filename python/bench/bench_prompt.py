@@ -0,0 +1,79 @@
+"""
+Prompt building cost per chat completion for 10, 100 and 1000-turn conversations.
+
+Compares a full rebuild on every request (prefix memo disabled) with an
+append-only session where each request adds an assistant reply and a new user
+turn to the previous conversation, so the memo only renders the new turns.
+Also reports the cost of building under a token budget that forces truncation.
+
+    cd python
+    python bench/bench_prompt.py --turns 10 100 1000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.prompt import PromptBuilder  # noqa: E402
+
+TURN = "Please review this function and explain the edge cases. " * 4
+
+
+def make_conversation(turns: int):
+    messages = [{"role": "system", "content": "You are a careful code reviewer."}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"{i}: {TURN}"})
+        messages.append({"role": "assistant", "content": f"{i}: {TURN}"})
+    messages.append({"role": "user", "content": "And the last one?"})
+    return messages
+
+
+def measure(fn) -> float:
+    timer = timeit.Timer(fn)
+    loops, _ = timer.autorange()
+    best = min(timer.repeat(repeat=5, number=loops))
+    return best / loops * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    results = []
+    for turns in args.turns:
+        messages = make_conversation(turns)
+        rebuild = PromptBuilder(memo_max_bytes=0)
+        before = measure(lambda: rebuild.build(messages))
+
+        session = PromptBuilder()
+        # Each request extends the previous conversation by one exchange, as a chat client does
+        history = list(messages)
+
+        def next_request() -> None:
+            history.append({"role": "assistant", "content": TURN})
+            history.append({"role": "user", "content": TURN})
+            session.build(history)
+            del history[-2:]
+
+        session.build(history)
+        after = measure(next_request)
+
+        budgeted = PromptBuilder()
+        truncated = measure(lambda: budgeted.build(messages, budget_tokens=4000))
+        results.append({
+            "turns": turns,
+            "prompt_chars": len(rebuild.build(messages).prompt),
+            "rebuild_us": round(before, 1),
+            "memo_us": round(after, 1),
+            "speedup": round(before / after, 2),
+            "truncate_to_4k_tokens_us": round(truncated, 1),
+        })
+    print(json.dumps({"results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
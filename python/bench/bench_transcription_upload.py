@@ -0,0 +1,154 @@
+"""
+Peak proxy memory for /v1/audio/transcriptions uploads.
+
+Starts a local mock Ask Sage /file endpoint and a fresh proxy process per file size,
+uploads a file of that size, and reports the proxy's peak RSS (VmHWM). Linux only.
+
+    cd python
+    python bench/bench_transcription_upload.py --sizes 10 100 500
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PYTHON_DIR = os.path.dirname(HERE)
+CHUNK = 1024 * 1024
+
+
+async def mock_asksage(scope, receive, send):
+    """ASGI app standing in for Ask Sage: drains the upload and reports its size."""
+    if scope["type"] != "http":
+        return
+    received = 0
+    while True:
+        message = await receive()
+        received += len(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    body = json.dumps({"ret": f"received {received} bytes", "status": 200}).encode()
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url: str, timeout: float = 15.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def _peak_rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def _multipart_body(path: str, boundary: str):
+    yield (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"bench.wav\"\r\n"
+        "Content-Type: audio/wav\r\n\r\n"
+    ).encode()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK)
+            if not chunk:
+                break
+            yield chunk
+    yield f"\r\n--{boundary}\r\nContent-Disposition: form-data; name=\"model\"\r\n\r\nwhisper-1\r\n--{boundary}--\r\n".encode()
+
+
+def _make_file(size_mb: int) -> str:
+    fd, path = tempfile.mkstemp(suffix=".wav")
+    block = os.urandom(CHUNK)
+    with os.fdopen(fd, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+    return path
+
+
+def run(sizes_mb, max_upload_mb: int) -> list:
+    mock_port = _free_port()
+    mock = subprocess.Popen(
+        [sys.executable, "-c",
+         "import sys, uvicorn; sys.path.insert(0, sys.argv[1]);"
+         "from bench_transcription_upload import mock_asksage;"
+         "uvicorn.run(mock_asksage, host='127.0.0.1', port=int(sys.argv[2]), log_level='warning')",
+         HERE, str(mock_port)],
+    )
+    results = []
+    try:
+        _wait_for(f"http://127.0.0.1:{mock_port}/")
+        for size_mb in sizes_mb:
+            port = _free_port()
+            env = dict(
+                os.environ,
+                ASKSAGE_API_KEY="bench",
+                ASKSAGE_SERVER_BASE=f"http://127.0.0.1:{mock_port}/server/",
+                ASKSAGE_MAX_UPLOAD_BYTES=str(max_upload_mb * CHUNK),
+            )
+            proxy = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+                 "--log-level", "warning"],
+                cwd=PYTHON_DIR, env=env,
+            )
+            path = _make_file(size_mb)
+            try:
+                _wait_for(f"http://127.0.0.1:{port}/healthz")
+                idle_kb = _peak_rss_kb(proxy.pid)
+                started = time.perf_counter()
+                resp = httpx.post(
+                    f"http://127.0.0.1:{port}/v1/audio/transcriptions",
+                    content=_multipart_body(path, "benchboundary"),
+                    headers={"Content-Type": "multipart/form-data; boundary=benchboundary"},
+                    timeout=600.0,
+                )
+                elapsed = time.perf_counter() - started
+                resp.raise_for_status()
+                peak_kb = _peak_rss_kb(proxy.pid)
+                results.append({
+                    "file_mb": size_mb,
+                    "seconds": round(elapsed, 3),
+                    "idle_rss_mb": round(idle_kb / 1024, 1),
+                    "peak_rss_mb": round(peak_kb / 1024, 1),
+                    "upstream": resp.json()["text"],
+                })
+            finally:
+                proxy.terminate()
+                proxy.wait()
+                os.unlink(path)
+    finally:
+        mock.terminate()
+        mock.wait()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500], help="file sizes in MB")
+    parser.add_argument("--max-upload-mb", type=int, default=1024)
+    args = parser.parse_args()
+    print(json.dumps(run(args.sizes, args.max_upload_mb), indent=2))
+
+
+if __name__ == "__main__":
+    main()
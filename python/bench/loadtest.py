@@ -0,0 +1,502 @@
+"""
+Load test of the proxy's OpenAI routes against the local mock Ask Sage server.
+
+Starts `bench/mock_asksage.py` and the proxy (`python -m app`), drives a mix of
+routes at a fixed concurrency (closed loop) or a target request rate (open loop),
+and reports per route: throughput, latency p50/p95/p99, time to first byte and to
+the first content delta for `stream=true` chat completions, and the proxy's peak
+RSS (all worker processes together; Linux only). Results are JSON; with
+`--baseline`, they are compared with a stored run and the exit status is 1 when a
+metric regressed by more than `--tolerance`.
+
+    cd python
+    python bench/loadtest.py --duration 30 --concurrency 32 --output baseline.json
+    python bench/loadtest.py --duration 30 --concurrency 32 --baseline baseline.json
+    python bench/loadtest.py --rps 200 --duration 30 --workers 2 --mock-config mock.json
+    python bench/loadtest.py --compare new.json --baseline baseline.json
+
+`--url` targets an already running proxy instead (add `--pid` for its RSS). The
+request mix is drawn from `--seed`, so two runs with the same arguments send the
+same sequence of requests.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PYTHON_DIR = os.path.dirname(HERE)
+
+DEFAULT_MIX = "chat=40,chat_stream=30,models=10,model=5,speech=5,transcription=5,batch=5"
+MODEL = "gpt-4o-mini"
+
+
+class Sample(NamedTuple):
+    route: str
+    status: int  # 0 for a transport error
+    latency: float
+    ttfb: Optional[float]
+    ttft: Optional[float]
+
+
+def _messages(i: int) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": "You are a concise assistant."},
+        {"role": "user", "content": f"Request {i}: summarize the trade-offs of connection pooling in two sentences."},
+    ]
+
+
+async def _chat(client: httpx.AsyncClient, i: int) -> Tuple[int, Optional[float], Optional[float]]:
+    body = {"model": MODEL, "messages": _messages(i), "temperature": 0.7}
+    resp = await client.post("/v1/chat/completions", json=body)
+    return resp.status_code, None, None
+
+
+async def _chat_stream(client: httpx.AsyncClient, i: int) -> Tuple[int, Optional[float], Optional[float]]:
+    body = {"model": MODEL, "messages": _messages(i), "temperature": 0.7, "stream": True}
+    started = time.perf_counter()
+    ttfb = ttft = None
+    async with client.stream("POST", "/v1/chat/completions", json=body) as resp:
+        async for line in resp.aiter_lines():
+            if ttfb is None:
+                ttfb = time.perf_counter() - started
+            if ttft is None and line.startswith("data: {"):
+                choices = json.loads(line[len("data: "):]).get("choices") or [{}]
+                if choices[0].get("delta", {}).get("content"):
+                    ttft = time.perf_counter() - started
+    return resp.status_code, ttfb, ttft
+
+
+async def _models(client: httpx.AsyncClient, i: int) -> Tuple[int, Optional[float], Optional[float]]:
+    return (await client.get("/v1/models")).status_code, None, None
+
+
+async def _model(client: httpx.AsyncClient, i: int) -> Tuple[int, Optional[float], Optional[float]]:
+    return (await client.get(f"/v1/models/{MODEL}")).status_code, None, None
+
+
+async def _speech(client: httpx.AsyncClient, i: int) -> Tuple[int, Optional[float], Optional[float]]:
+    body = {"model": "tts-1", "voice": "alloy", "input": f"Sentence number {i} of the load test."}
+    started = time.perf_counter()
+    ttfb = None
+    async with client.stream("POST", "/v1/audio/speech", json=body) as resp:
+        async for _ in resp.aiter_raw():
+            if ttfb is None:
+                ttfb = time.perf_counter() - started
+    return resp.status_code, ttfb, None
+
+
+def _transcription(upload: bytes) -> Callable[[httpx.AsyncClient, int], Awaitable[Tuple[int, Optional[float], Optional[float]]]]:
+    async def run(client: httpx.AsyncClient, i: int) -> Tuple[int, Optional[float], Optional[float]]:
+        # A distinct upload per request, so the transcription cache does not answer
+        files = {"file": (f"clip-{i}.wav", str(i).encode() + upload, "audio/wav")}
+        resp = await client.post("/v1/audio/transcriptions", files=files, data={"model": "whisper-1"})
+        return resp.status_code, None, None
+
+    return run
+
+
+async def _batch(client: httpx.AsyncClient, i: int) -> Tuple[int, Optional[float], Optional[float]]:
+    line = {"custom_id": f"r{i}", "method": "POST", "url": "/v1/chat/completions", "body": {"model": MODEL, "messages": _messages(i)}}
+    files = {"file": (f"batch-{i}.jsonl", json.dumps(line).encode() + b"\n", "application/jsonl")}
+    resp = await client.post("/v1/files", files=files, data={"purpose": "batch"})
+    if resp.status_code != 200:
+        return resp.status_code, None, None
+    body = {"input_file_id": resp.json()["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h"}
+    return (await client.post("/v1/batches", json=body)).status_code, None, None
+
+
+def parse_mix(spec: str) -> Dict[str, int]:
+    mix: Dict[str, int] = {}
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = int(weight or 1)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def _process_tree(pid: int) -> List[int]:
+    parents: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces; the fields after it don't
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        parents.setdefault(ppid, []).append(int(entry))
+    tree, todo = [], [pid]
+    while todo:
+        current = todo.pop()
+        tree.append(current)
+        todo.extend(parents.get(current, ()))
+    return tree
+
+
+def rss_kb(pid: int) -> int:
+    """Resident memory of `pid` and its descendants (uvicorn workers)."""
+    total = 0
+    for member in _process_tree(pid):
+        try:
+            with open(f"/proc/{member}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """p50/p95/p99/max in milliseconds (nearest rank)."""
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def rank(q: float) -> float:
+        return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+    return {
+        "p50": round(rank(0.50) * 1000, 2),
+        "p95": round(rank(0.95) * 1000, 2),
+        "p99": round(rank(0.99) * 1000, 2),
+        "max": round(values[-1] * 1000, 2),
+    }
+
+
+def summarize(samples: List[Sample], seconds: float) -> Dict[str, Any]:
+    ok = [s for s in samples if 200 <= s.status < 300]
+    statuses: Dict[str, int] = {}
+    for s in samples:
+        if not 200 <= s.status < 300:
+            statuses[str(s.status)] = statuses.get(str(s.status), 0) + 1
+    out: Dict[str, Any] = {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "error_rate": round((len(samples) - len(ok)) / len(samples), 4) if samples else 0.0,
+        "error_statuses": statuses,
+        "throughput_rps": round(len(ok) / seconds, 2) if seconds > 0 else 0.0,
+        "latency_ms": percentiles([s.latency for s in ok]),
+    }
+    ttfb = [s.ttfb for s in ok if s.ttfb is not None]
+    if ttfb:
+        out["ttfb_ms"] = percentiles(ttfb)
+    ttft = [s.ttft for s in ok if s.ttft is not None]
+    if ttft:
+        out["ttft_ms"] = percentiles(ttft)
+    return out
+
+
+async def run_load(
+    url: str,
+    mix: Dict[str, int],
+    duration: float,
+    warmup: float = 0.0,
+    concurrency: int = 16,
+    rps: float = 0.0,
+    seed: int = 1,
+    timeout: float = 60.0,
+    upload_bytes: int = 64 * 1024,
+    pid: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Drive the proxy at `url` for `warmup` + `duration` seconds. With `rps` > 0 requests
+    start on a fixed schedule (at most `concurrency` in flight; starts beyond that are
+    counted as `dropped`), otherwise `concurrency` clients send back to back.
+    """
+    scenarios = {
+        "chat": _chat,
+        "chat_stream": _chat_stream,
+        "models": _models,
+        "model": _model,
+        "speech": _speech,
+        "transcription": _transcription(random.Random(seed).randbytes(upload_bytes)),
+        "batch": _batch,
+    }
+    unknown = set(mix) - set(scenarios)
+    if unknown:
+        raise ValueError(f"unknown routes in the mix: {', '.join(sorted(unknown))}")
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    samples: List[Sample] = []
+    counter = 0
+    dropped = 0
+    in_flight = 0
+    started = time.perf_counter()
+    measure_from = started + warmup
+    stop_at = measure_from + duration
+    peak_kb = idle_kb = rss_kb(pid) if pid else 0
+
+    async def one(client: httpx.AsyncClient) -> None:
+        nonlocal counter, in_flight
+        i = counter
+        counter += 1
+        # Drawn in request order, so the sequence of routes only depends on the seed
+        name = rng.choices(names, weights)[0]
+        in_flight += 1
+        t0 = time.perf_counter()
+        try:
+            status, ttfb, ttft = await scenarios[name](client, i)
+        except httpx.HTTPError:
+            status, ttfb, ttft = 0, None, None
+        finally:
+            in_flight -= 1
+        if t0 >= measure_from:
+            samples.append(Sample(name, status, time.perf_counter() - t0, ttfb, ttft))
+
+    async def sample_rss() -> None:
+        nonlocal peak_kb
+        while True:
+            peak_kb = max(peak_kb, await asyncio.to_thread(rss_kb, pid))
+            await asyncio.sleep(0.25)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        sampler = asyncio.create_task(sample_rss()) if pid else None
+        try:
+            if rps > 0:
+                tasks = set()
+                next_start = started
+                while next_start < stop_at:
+                    await asyncio.sleep(max(0.0, next_start - time.perf_counter()))
+                    if in_flight >= concurrency:
+                        dropped += next_start >= measure_from
+                    else:
+                        task = asyncio.create_task(one(client))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                    next_start += 1 / rps
+                if tasks:
+                    await asyncio.wait(set(tasks))
+            else:
+
+                async def worker() -> None:
+                    while time.perf_counter() < stop_at:
+                        await one(client)
+
+                await asyncio.gather(*(worker() for _ in range(concurrency)))
+        finally:
+            if sampler is not None:
+                sampler.cancel()
+    # Requests started before the end are all counted, so measure until the last one finished
+    seconds = max(time.perf_counter(), stop_at) - measure_from
+
+    by_route: Dict[str, List[Sample]] = {}
+    for s in samples:
+        by_route.setdefault(s.route, []).append(s)
+    results: Dict[str, Any] = {
+        "total": summarize(samples, seconds),
+        "routes": {name: summarize(by_route[name], seconds) for name in names if name in by_route},
+        "dropped": dropped,
+        "seconds": round(seconds, 3),
+    }
+    if pid:
+        results["idle_rss_mb"] = round(idle_kb / 1024, 1)
+        results["peak_rss_mb"] = round(peak_kb / 1024, 1)
+    return results
+
+
+# (path in the results, True when higher is better)
+COMPARED = [
+    ("throughput_rps", True),
+    ("latency_ms.p50", False),
+    ("latency_ms.p95", False),
+    ("latency_ms.p99", False),
+    ("ttfb_ms.p50", False),
+    ("ttfb_ms.p99", False),
+    ("ttft_ms.p50", False),
+    ("ttft_ms.p99", False),
+]
+# Settings that must match for a comparison to mean anything
+SAME_LOAD = ("mix", "concurrency", "rps", "workers", "mock_config", "env", "upload_bytes")
+# Error rates are compared in absolute terms: 0% -> 0.5% is not a 'relative' change
+ERROR_RATE_SLACK = 0.01
+
+
+def _lookup(data: Dict[str, Any], path: str) -> Optional[float]:
+    for key in path.split("."):
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data if isinstance(data, (int, float)) else None
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float = 0.10) -> List[Dict[str, Any]]:
+    """One row per metric present in both runs; `regressed` marks changes past `tolerance`."""
+    rows: List[Dict[str, Any]] = []
+
+    def add(name: str, metric: str, before: float, after: float, regressed: bool) -> None:
+        change = (after - before) / before if before else 0.0
+        rows.append({
+            "route": name, "metric": metric, "baseline": before, "current": after,
+            "change": round(change, 4), "regressed": regressed,
+        })
+
+    sections = [("total", baseline["results"]["total"], current["results"]["total"])]
+    for name, base in baseline["results"]["routes"].items():
+        if name in current["results"]["routes"]:
+            sections.append((name, base, current["results"]["routes"][name]))
+    for name, base, cur in sections:
+        for metric, higher_is_better in COMPARED:
+            before, after = _lookup(base, metric), _lookup(cur, metric)
+            if before is None or after is None:
+                continue
+            if higher_is_better:
+                regressed = after < before * (1 - tolerance)
+            else:
+                regressed = after > before * (1 + tolerance)
+            add(name, metric, before, after, regressed)
+        add(name, "error_rate", base["error_rate"], cur["error_rate"], cur["error_rate"] > base["error_rate"] + ERROR_RATE_SLACK)
+    before, after = _lookup(baseline["results"], "peak_rss_mb"), _lookup(current["results"], "peak_rss_mb")
+    if before is not None and after is not None:
+        add("proxy", "peak_rss_mb", before, after, after > before * (1 + tolerance))
+    return rows
+
+
+def format_comparison(rows: List[Dict[str, Any]]) -> str:
+    lines = [f"{'route':<14} {'metric':<16} {'baseline':>10} {'current':>10} {'change':>8}"]
+    for row in rows:
+        flag = "  REGRESSED" if row["regressed"] else ""
+        lines.append(
+            f"{row['route']:<14} {row['metric']:<16} {row['baseline']:>10} {row['current']:>10} {row['change']:>+8.1%}{flag}"
+        )
+    return "\n".join(lines)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PYTHON_DIR, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    mix = parse_mix(args.mix)
+    load = dict(
+        mix=mix, duration=args.duration, warmup=args.warmup, concurrency=args.concurrency, rps=args.rps,
+        seed=args.seed, timeout=args.timeout, upload_bytes=args.upload_bytes,
+    )
+    meta = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "workers": args.workers,
+        "mock_config": args.mock_config or None,
+        "env": args.env,
+        **load,
+    }
+    if args.url:
+        return {"meta": dict(meta, url=args.url), "results": asyncio.run(run_load(args.url, pid=args.pid, **load))}
+
+    mock_port, port = _free_port(), _free_port()
+    mock = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "mock_asksage.py"), "--port", str(mock_port), "--config", args.mock_config],
+    )
+    with tempfile.TemporaryDirectory(prefix="asksage-loadtest-") as tmp:
+        env = dict(
+            os.environ,
+            ASKSAGE_API_KEY="bench",
+            ASKSAGE_SERVER_BASE=f"http://127.0.0.1:{mock_port}/server/",
+            ASKSAGE_BATCH_DIR=os.path.join(tmp, "batches"),
+        )
+        env.update(item.split("=", 1) for item in args.env)
+        proxy = subprocess.Popen(
+            [sys.executable, "-m", "app", "--host", "127.0.0.1", "--port", str(port), "--workers", str(args.workers)],
+            cwd=PYTHON_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            _wait_for(f"http://127.0.0.1:{mock_port}/_mock/stats")
+            _wait_for(f"http://127.0.0.1:{port}/healthz")
+            results = asyncio.run(run_load(f"http://127.0.0.1:{port}", pid=proxy.pid, **load))
+            results["upstream"] = httpx.get(f"http://127.0.0.1:{mock_port}/_mock/stats").json()
+        finally:
+            proxy.terminate()
+            proxy.wait()
+            mock.terminate()
+            mock.wait()
+    return {"meta": meta, "results": results}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=30.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds of load before measuring")
+    parser.add_argument("--concurrency", type=int, default=16, help="clients (closed loop) or most requests in flight (--rps)")
+    parser.add_argument("--rps", type=float, default=0.0, help="target request rate; 0 runs closed loop")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"route weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=60.0, help="per-request timeout in seconds")
+    parser.add_argument("--upload-bytes", type=int, default=64 * 1024, help="size of each transcription upload")
+    parser.add_argument("--workers", type=int, default=1, help="proxy worker processes")
+    parser.add_argument("--mock-config", default="", help="JSON profile for bench/mock_asksage.py")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra proxy environment")
+    parser.add_argument("--url", default="", help="load an already running proxy instead of starting one")
+    parser.add_argument("--pid", type=int, default=None, help="with --url, the proxy's pid for RSS sampling")
+    parser.add_argument("--output", default="", help="write the results here instead of stdout")
+    parser.add_argument("--baseline", default="", help="results file to compare with")
+    parser.add_argument("--compare", default="", help="compare this results file with --baseline instead of running")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="relative change counted as a regression")
+    args = parser.parse_args()
+    if args.compare and not args.baseline:
+        parser.error("--compare needs --baseline")
+
+    if args.compare:
+        with open(args.compare) as f:
+            report = json.load(f)
+    else:
+        report = run(args)
+        text = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(text + "\n")
+        else:
+            print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        changed = [key for key in SAME_LOAD if baseline["meta"].get(key) != report["meta"].get(key)]
+        if changed:
+            print(f"warning: the runs used different {', '.join(changed)}; the comparison is not like for like", file=sys.stderr)
+        rows = compare(baseline, report, args.tolerance)
+        print(format_comparison(rows), file=sys.stderr)
+        if any(row["regressed"] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Local mock Ask Sage server for load tests.
+
+Serves `/server/query`, `/server/get-models`, `/server/get-text-to-speech` and
+`/server/file` with configurable latency, error rate and payload size per endpoint.
+Latency and errors are drawn from a seeded generator, so a run with the same
+configuration and request sequence sees the same upstream behaviour.
+
+    cd python
+    python bench/mock_asksage.py --port 9000 --config mock.json
+
+The configuration is JSON, keyed by endpoint; every key is optional:
+
+    {
+      "seed": 1,
+      "query": {"latency": {"dist": "lognormal", "median_ms": 300, "p99_ms": 2000},
+                "error_rate": 0.01, "error_status": 500, "bytes": 800},
+      "get-text-to-speech": {"latency": {"dist": "fixed", "ms": 150}, "bytes": 65536}
+    }
+
+Latency distributions: `fixed` (`ms`), `uniform` (`min_ms`, `max_ms`) and
+`lognormal` (`median_ms`, `p99_ms`). `error_status` may be a list to mix statuses,
+e.g. `[429, 500, 503]`; 429 and 503 answers carry `Retry-After: 1`.
+`GET /_mock/stats` returns the number of calls and errors per endpoint.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+from typing import Any, Dict
+
+# z-score of the 99th percentile of a standard normal distribution
+_Z99 = 2.3263
+_CHUNK = 16 * 1024
+
+DEFAULTS: Dict[str, Dict[str, Any]] = {
+    "query": {"latency": {"dist": "lognormal", "median_ms": 200, "p99_ms": 1000}, "error_rate": 0.0, "bytes": 600},
+    "get-models": {"latency": {"dist": "fixed", "ms": 20}, "error_rate": 0.0, "models": 40},
+    "get-text-to-speech": {"latency": {"dist": "lognormal", "median_ms": 150, "p99_ms": 600}, "error_rate": 0.0, "bytes": 32768},
+    "file": {"latency": {"dist": "lognormal", "median_ms": 300, "p99_ms": 1500}, "error_rate": 0.0, "bytes": 400},
+}
+
+
+def load_config(path: str = "") -> Dict[str, Any]:
+    """DEFAULTS with the endpoints of the JSON file at `path` (if any) merged over them."""
+    config: Dict[str, Any] = {"seed": 1, **{name: dict(profile) for name, profile in DEFAULTS.items()}}
+    if path:
+        with open(path) as f:
+            overrides = json.load(f)
+        for name, value in overrides.items():
+            if isinstance(value, dict) and name in config:
+                config[name].update(value)
+            else:
+                config[name] = value
+    return config
+
+
+def sample_latency(rng: random.Random, latency: Dict[str, Any]) -> float:
+    """Seconds to wait before answering."""
+    dist = latency.get("dist", "fixed")
+    if dist == "fixed":
+        ms = latency.get("ms", 0)
+    elif dist == "uniform":
+        ms = rng.uniform(latency.get("min_ms", 0), latency.get("max_ms", 0))
+    elif dist == "lognormal":
+        median = latency["median_ms"]
+        sigma = math.log(latency.get("p99_ms", median) / median) / _Z99
+        ms = rng.lognormvariate(math.log(median), sigma)
+    else:
+        raise ValueError(f"unknown latency distribution: {dist}")
+    return max(0.0, ms) / 1000
+
+
+def _text(size: int) -> str:
+    words = "the proxy forwards this simulated answer from the mock server ".split()
+    out, length, i = [], 0, 0
+    while length < size:
+        word = words[i % len(words)]
+        out.append(word)
+        length += len(word) + 1
+        i += 1
+    return " ".join(out)[:size]
+
+
+class MockAskSage:
+    """ASGI app standing in for the Ask Sage Server API."""
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.config = config
+        self.rng = random.Random(config.get("seed", 1))
+        self.stats: Dict[str, Dict[str, int]] = {name: {"calls": 0, "errors": 0} for name in DEFAULTS}
+        self._audio = bytes(range(256)) * (_CHUNK // 256)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return
+        received = 0
+        while True:
+            message = await receive()
+            received += len(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+
+        path = scope["path"]
+        if path == "/_mock/stats":
+            return await self._json(send, 200, self.stats)
+        name = path.rsplit("/", 1)[-1]
+        profile = self.config.get(name)
+        if not path.startswith("/server/") or name not in self.stats:
+            return await self._json(send, 404, {"error": f"no such endpoint: {path}"})
+
+        # Draw everything up front so the sequence does not depend on timing
+        delay = sample_latency(self.rng, profile.get("latency", {}))
+        failed = self.rng.random() < profile.get("error_rate", 0.0)
+        statuses = profile.get("error_status", 500)
+        status = self.rng.choice(statuses) if isinstance(statuses, list) else statuses
+        self.stats[name]["calls"] += 1
+        await asyncio.sleep(delay)
+
+        if failed:
+            self.stats[name]["errors"] += 1
+            headers = [(b"retry-after", b"1")] if status in (429, 503) else []
+            return await self._json(send, status, {"status": status, "message": "mock failure"}, headers)
+        if name == "query":
+            text = _text(profile.get("bytes", 600))
+            return await self._json(send, 200, {
+                "status": 200,
+                "message": text,
+                "usage": {"prompt_tokens": received // 4, "completion_tokens": len(text) // 4, "total_tokens": received // 4 + len(text) // 4},
+            })
+        if name == "get-models":
+            models = [{"id": f"mock-model-{i}", "owned_by": "asksage"} for i in range(profile.get("models", 40))]
+            return await self._json(send, 200, {"object": "list", "data": [{"id": "gpt-4o-mini", "owned_by": "openai"}] + models})
+        if name == "file":
+            return await self._json(send, 200, {"ret": _text(profile.get("bytes", 400)), "status": 200, "response": "OK"})
+        await self._audio_response(send, profile.get("bytes", 32768))
+
+    async def _json(self, send, status: int, body: Any, headers=()) -> None:
+        data = json.dumps(body).encode()
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode()), *headers],
+        })
+        await send({"type": "http.response.body", "body": data})
+
+    async def _audio_response(self, send, size: int) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"audio/mpeg"), (b"content-length", str(size).encode())],
+        })
+        while size > 0:
+            chunk = self._audio[: min(size, _CHUNK)]
+            size -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": size > 0})
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--config", default="", help="JSON file overriding the endpoint profiles")
+    args = parser.parse_args()
+    uvicorn.run(MockAskSage(load_config(args.config)), host=args.host, port=args.port, log_level="warning", lifespan="off")
+
+
+if __name__ == "__main__":
+    main()
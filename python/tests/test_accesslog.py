@@ -0,0 +1,74 @@
+import asyncio
+import io
+import json
+
+from app.accesslog import AccessLog, AccessLogMiddleware, add_sizes, annotate, request_id
+
+
+def _run(log, headers=(), status=200):
+    seen = {}
+
+    async def app(scope, receive, send):
+        seen["id"] = request_id()
+        annotate(model="m")
+        add_sizes(prompt_chars=5)
+        await send({"type": "http.response.start", "status": status, "headers": []})
+        await send({"type": "http.response.body", "body": b"hello"})
+
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"abc", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/x", "headers": list(headers), "client": ("10.0.0.1", 1)}
+    asyncio.run(AccessLogMiddleware(app, log=lambda: log)(scope, receive, send))
+    return seen["id"], dict(sent[0]["headers"])[b"x-request-id"].decode()
+
+
+def _lines(sink):
+    return [json.loads(line) for line in sink.getvalue().splitlines()]
+
+
+def test_request_ids_and_records():
+    sink = io.BytesIO()
+    log = AccessLog(sink, sizes=True)
+    rid, echoed = _run(log, [(b"x-request-id", b"abc-123")])
+    assert rid == echoed == "abc-123"
+    rid, echoed = _run(log, [(b"x-request-id", b"bad id\n")])
+    assert rid == echoed and len(rid) == 32
+    log.close()
+
+    first = _lines(sink)[0]
+    assert first["request_id"] == "abc-123"
+    assert first["ts"].endswith("Z")
+    assert (first["status"], first["response_bytes"], first["peer"]) == (200, 5, "10.0.0.1")
+    assert (first["model"], first["prompt_chars"]) == ("m", 5)
+
+    sink = io.BytesIO()
+    log = AccessLog(sink, sizes=False)
+    _run(log)
+    log.close()
+    assert "prompt_chars" not in _lines(sink)[0]
+
+
+def test_sampling_keeps_errors_and_slow_requests():
+    log = AccessLog(io.BytesIO(), sample_rate=0.1, slow_seconds=1.0, rand=lambda: 0.5)
+    assert not log.wants(200, 0.01)
+    assert log.wants(500, 0.01)
+    assert log.wants(404, 0.01)
+    assert log.wants(200, 2.0)
+    assert log.sampled_out == 1
+    assert AccessLog(io.BytesIO(), sample_rate=0.1, rand=lambda: 0.05).wants(200, 0.01)
+
+
+def test_queue_is_bounded():
+    log = AccessLog(io.BytesIO(), max_queue=2)
+    # The writer thread isn't started until the first record: hold it back
+    log._thread = object()
+    assert log.submit({"ts": 0.0}) and log.submit({"ts": 0.0})
+    assert not log.submit({"ts": 0.0})
+    assert log.stats()["dropped"] == 1
+    assert log.stats()["queue_depth"] == 2
@@ -0,0 +1,107 @@
+import asyncio
+import os
+
+from app.audiocache import AudioCache
+
+
+def _files(directory):
+    # Audio and temporary files, without the index
+    return sorted(n for n in os.listdir(directory) if not n.startswith(".index.sqlite"))
+
+
+async def _put(cache, key, data, media_type="audio/mpeg"):
+    writer = cache.writer(key, media_type)
+    await writer.write(data)
+    await writer.commit()
+
+
+def test_write_commit_and_lookup(tmp_path):
+    cache = AudioCache(str(tmp_path), max_bytes=1024)
+
+    async def run():
+        assert await cache.get("k") is None
+        await _put(cache, "k", b"abc", "audio/x-wav; rate=24000")
+        return await cache.get("k")
+
+    entry = asyncio.run(run())
+    assert entry.media_type == "audio/x-wav"
+    assert entry.size == 3
+    with open(entry.path, "rb") as f:
+        assert f.read() == b"abc"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_aborted_write_leaves_nothing_behind(tmp_path):
+    cache = AudioCache(str(tmp_path), max_bytes=1024)
+
+    async def run():
+        writer = cache.writer("k", "audio/mpeg")
+        await writer.write(b"partial")
+        await writer.abort()
+        return await cache.get("k")
+
+    assert asyncio.run(run()) is None
+    assert _files(tmp_path) == []
+    assert cache.stats()["aborted_writes"] == 1
+
+
+def test_lru_eviction_by_bytes(tmp_path):
+    cache = AudioCache(str(tmp_path), max_bytes=10)
+
+    async def run():
+        await _put(cache, "a", b"1234")
+        await _put(cache, "b", b"1234")
+        await cache.get("a")
+        await _put(cache, "c", b"1234")
+        return [await cache.get(k) is not None for k in ("a", "b", "c")]
+
+    assert asyncio.run(run()) == [True, False, True]
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 8
+    assert len(_files(tmp_path)) == 2
+
+
+def test_entries_survive_restart(tmp_path):
+    cache = AudioCache(str(tmp_path), max_bytes=1024)
+    asyncio.run(_put(cache, "a", b"audio", "audio/ogg"))
+    # A crash mid-write leaves a temporary file, which is cleaned up on load
+    (tmp_path / ".tmp-crashed").write_bytes(b"junk")
+    os.utime(tmp_path / ".tmp-crashed", (0, 0))
+    # Recent ones may be another worker's write in progress
+    (tmp_path / ".tmp-writing").write_bytes(b"part")
+
+    reloaded = AudioCache(str(tmp_path), max_bytes=1024)
+    entry = asyncio.run(reloaded.get("a"))
+    assert entry.media_type == "audio/ogg"
+    assert entry.size == 5
+    assert not (tmp_path / ".tmp-crashed").exists()
+    assert (tmp_path / ".tmp-writing").exists()
+
+
+def test_workers_share_the_index_and_size_bound(tmp_path):
+    first = AudioCache(str(tmp_path), max_bytes=10)
+    second = AudioCache(str(tmp_path), max_bytes=10)
+
+    async def run():
+        await _put(first, "a", b"1234")
+        await _put(second, "b", b"1234")
+        # Seen by the other worker, and used last
+        assert (await second.get("a")).size == 4
+        await _put(first, "c", b"1234")
+        return [await first.get(k) is not None for k in ("a", "b", "c")]
+
+    assert asyncio.run(run()) == [True, False, True]
+    assert first.stats()["bytes"] == 8
+    assert first.stats()["entries"] == 2
+    assert _files(tmp_path) == ["a.audio-mpeg", "c.audio-mpeg"]
+    first.close()
+    second.close()
+
+
+def test_existing_files_are_indexed(tmp_path):
+    (tmp_path / "a.audio-ogg").write_bytes(b"audio")
+    cache = AudioCache(str(tmp_path), max_bytes=1024)
+    entry = asyncio.run(cache.get("a"))
+    assert (entry.media_type, entry.size) == ("audio/ogg", 5)
+    assert cache.stats()["bytes"] == 5
@@ -0,0 +1,90 @@
+import time
+
+import pytest
+
+from app.backends import ROUND_ROBIN, Backend, BackendPool, parse_backends
+
+
+def test_parse_backends():
+    backends = parse_backends("https://a/server|key-a|3, https://b/server/", "default")
+    assert [(b.base_url, b.api_key, b.weight) for b in backends] == [
+        ("https://a/server/", "key-a", 3),
+        ("https://b/server/", "default", 1),
+    ]
+    assert parse_backends("", "default") == []
+    assert backends[0].name == "https://a/server/#ey-a"
+
+
+def test_least_outstanding_spreads_load():
+    a, b = Backend("https://a/", "ka"), Backend("https://b/", "kb")
+    pool = BackendPool([a, b])
+
+    first = pool.select()
+    pool.start(first)
+    second = pool.select()
+    assert second is not first
+    pool.start(second)
+    pool.finish(first, 200, 0.1)
+    assert pool.select() is first
+
+
+def test_weighted_round_robin():
+    a, b = Backend("https://a/", "ka", weight=3), Backend("https://b/", "kb")
+    pool = BackendPool([a, b], strategy=ROUND_ROBIN)
+    picks = [pool.select() for _ in range(8)]
+    assert picks.count(a) == 6
+    assert picks.count(b) == 2
+    # Smooth: the light backend isn't starved for a whole cycle
+    assert b in picks[:4]
+
+    with pytest.raises(ValueError):
+        BackendPool([a], strategy="random")
+
+
+def test_ejection_with_doubling_backoff():
+    a, b = Backend("https://a/", "ka"), Backend("https://b/", "kb")
+    pool = BackendPool([a, b], eject_after=2, eject_seconds=10)
+
+    for status in (429, 503):
+        pool.start(a)
+        pool.finish(a, status, 0.1)
+    assert not a.available(time.monotonic())
+    assert 9 < a.ejected_until - time.monotonic() <= 10
+    assert all(pool.select() is b for _ in range(3))
+
+    # Every backend ejected: fall back to the one that comes back first
+    for _ in range(2):
+        pool.start(b)
+        pool.finish(b, None, 0.1)
+    assert pool.select() is a
+
+    # Failing again right after coming back doubles the backoff
+    a.ejected_until = 0.0
+    for _ in range(2):
+        pool.start(a)
+        pool.finish(a, 500, 0.1)
+    assert 19 < a.ejected_until - time.monotonic() <= 20
+
+    # A success resets the backoff
+    a.ejected_until = 0.0
+    pool.start(a)
+    pool.finish(a, 200, 0.1)
+    for _ in range(2):
+        pool.start(a)
+        pool.finish(a, 500, 0.1)
+    assert a.ejected_until - time.monotonic() <= 10
+
+    stats = pool.stats()["backends"][0]
+    assert stats["ejections"] == 3
+    assert stats["throttled"] == 1
+    assert stats["server_errors"] == 5
+    assert stats["outstanding"] == 0
+
+
+def test_select_excludes_tried_backends():
+    a, b = Backend("https://a/", "ka"), Backend("https://b/", "kb")
+    pool = BackendPool([a, b])
+    assert pool.select(exclude=[a]) is b
+    assert pool.has_alternative([a])
+    assert not pool.has_alternative([a, b])
+    assert pool.select(exclude=[a, b]) is None
@@ -0,0 +1,225 @@
+import asyncio
+import io
+import json
+import os
+
+import pytest
+
+from app.batches import BatchRequestError, BatchRunner, FileStore
+
+URL = "/v1/chat/completions"
+
+
+def _jsonl(*requests):
+    return io.BytesIO(b"".join(json.dumps(r).encode("utf-8") + b"\n" for r in requests))
+
+
+def _request(custom_id, content="Hi"):
+    return {"custom_id": custom_id, "method": "POST", "url": URL, "body": {"messages": [{"role": "user", "content": content}]}}
+
+
+def _lines(store, file_id):
+    with open(store.path(file_id), "rb") as f:
+        return [json.loads(line) for line in f]
+
+
+async def _wait_for(runner, batch_id, *statuses):
+    for _ in range(500):
+        if runner.get(batch_id)["status"] in statuses:
+            return runner.get(batch_id)
+        await asyncio.sleep(0.01)
+    raise AssertionError(runner.get(batch_id)["status"])
+
+
+def test_upload_checks_every_line(tmp_path):
+    store = FileStore(str(tmp_path))
+
+    async def run():
+        good = await store.create(_jsonl(_request("a"), _request("b")), "in.jsonl", "batch", (URL,))
+        with pytest.raises(ValueError, match="line 2: missing custom_id"):
+            await store.create(_jsonl(_request("a"), {"url": URL, "body": {}}), "bad.jsonl", "batch", (URL,))
+        return good
+
+    file = asyncio.run(run())
+    assert file["bytes"] == os.path.getsize(store.path(file["id"]))
+    assert store.requests(file["id"]) == 2
+    assert [f["id"] for f in store.list()] == [file["id"]]
+    # The rejected upload leaves nothing behind
+    assert sorted(os.listdir(store.directory)) == sorted([file["id"], file["id"] + ".json"])
+
+
+def test_batch_runs_requests_with_bounded_workers(tmp_path):
+    store = FileStore(str(tmp_path))
+    active = peak = 0
+
+    async def execute(url, body):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        content = body["messages"][0]["content"]
+        if content == "bad":
+            raise BatchRequestError(400, "bad request")
+        return {"answer": content}
+
+    runner = BatchRunner(str(tmp_path), store, execute, workers=2)
+
+    async def run():
+        await runner.start()
+        requests = [_request(f"r{i}", "bad" if i == 3 else f"q{i}") for i in range(8)]
+        file = await store.create(_jsonl(*requests), "in.jsonl", "batch", (URL,))
+        batch = await runner.create(file["id"], URL, "24h", {"run": "nightly"})
+        assert batch["request_counts"]["total"] == 8
+        return await _wait_for(runner, batch["id"], "completed")
+
+    batch = asyncio.run(run())
+    assert peak == 2
+    assert batch["request_counts"] == {"total": 8, "completed": 7, "failed": 1}
+    assert batch["metadata"] == {"run": "nightly"}
+    output = _lines(store, batch["output_file_id"])
+    assert sorted(r["custom_id"] for r in output) == [f"r{i}" for i in range(8) if i != 3]
+    assert all(r["response"]["status_code"] == 200 for r in output)
+    errors = _lines(store, batch["error_file_id"])
+    assert [(r["custom_id"], r["response"]["status_code"]) for r in errors] == [("r3", 400)]
+    assert store.get(batch["output_file_id"])["purpose"] == "batch_output"
+
+
+def test_throttled_requests_pause_and_retry(tmp_path):
+    store = FileStore(str(tmp_path))
+    calls = 0
+
+    async def execute(url, body):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise BatchRequestError(429, "slow down", retry_after=0.05)
+        return {"ok": True}
+
+    runner = BatchRunner(str(tmp_path), store, execute, workers=1, backoff=0.01)
+
+    async def run():
+        await runner.start()
+        file = await store.create(_jsonl(_request("a")), "in.jsonl", "batch", (URL,))
+        batch = await runner.create(file["id"], URL, "24h", None)
+        return await _wait_for(runner, batch["id"], "completed")
+
+    batch = asyncio.run(run())
+    assert batch["request_counts"]["completed"] == 1
+    assert runner.stats()["retries"] == 1
+    assert batch["error_file_id"] is None
+
+
+def test_batch_resumes_from_checkpoint_after_restart(tmp_path):
+    store = FileStore(str(tmp_path))
+    executed = []
+    release = None
+
+    async def execute(url, body):
+        content = body["messages"][0]["content"]
+        executed.append(content)
+        if content.startswith("slow") and not release.is_set():
+            await release.wait()
+        return {"answer": content}
+
+    requests = [_request(f"r{i}", ("slow" if i >= 5 else "fast") + str(i)) for i in range(10)]
+
+    async def first_run():
+        nonlocal release
+        release = asyncio.Event()
+        runner = BatchRunner(str(tmp_path), store, execute, workers=3, checkpoint_seconds=0)
+        await runner.start()
+        file = await store.create(_jsonl(*requests), "in.jsonl", "batch", (URL,))
+        batch = await runner.create(file["id"], URL, "24h", None)
+        while runner.get(batch["id"])["request_counts"]["completed"] < 5:
+            await asyncio.sleep(0.01)
+        await runner.stop()
+        return batch["id"]
+
+    batch_id = asyncio.run(first_run())
+    assert executed[:5] == [f"fast{i}" for i in range(5)]
+    # A result written after the last checkpoint (crash before the next one) is dropped on resume
+    with open(tmp_path / "batches" / f"{batch_id}.json") as f:
+        output_id = json.load(f)["checkpoint"]["output_file_id"]
+    with open(store.path(output_id), "ab") as f:
+        f.write(b'{"custom_id": "r9", "response": null}\n')
+
+    async def second_run():
+        nonlocal release
+        release = asyncio.Event()
+        release.set()
+        runner = BatchRunner(str(tmp_path), store, execute, workers=3)
+        assert runner.get(batch_id)["status"] == "in_progress"
+        await runner.start()
+        assert runner.stats()["resumed"] == 1
+        return await _wait_for(runner, batch_id, "completed")
+
+    executed.clear()
+    batch = asyncio.run(second_run())
+    # Only the requests without a checkpointed result run again
+    assert sorted(executed) == [f"slow{i}" for i in range(5, 10)]
+    assert batch["request_counts"] == {"total": 10, "completed": 10, "failed": 0}
+    output = _lines(store, batch["output_file_id"])
+    assert sorted(r["custom_id"] for r in output) == sorted(f"r{i}" for i in range(10))
+
+
+def test_cancel_keeps_finished_results(tmp_path):
+    store = FileStore(str(tmp_path))
+
+    async def execute(url, body):
+        if body["messages"][0]["content"] == "hang":
+            await asyncio.Event().wait()
+        return {"ok": True}
+
+    runner = BatchRunner(str(tmp_path), store, execute, workers=2)
+
+    async def run():
+        await runner.start()
+        file = await store.create(_jsonl(_request("a"), _request("b", "hang"), _request("c", "hang")), "in.jsonl", "batch", (URL,))
+        batch = await runner.create(file["id"], URL, "24h", None)
+        while runner.get(batch["id"])["request_counts"]["completed"] < 1:
+            await asyncio.sleep(0.01)
+        cancelling = await runner.cancel(batch["id"])
+        assert cancelling["status"] == "cancelling"
+        return await _wait_for(runner, batch["id"], "cancelled")
+
+    batch = asyncio.run(run())
+    assert batch["request_counts"]["completed"] == 1
+    assert [r["custom_id"] for r in _lines(store, batch["output_file_id"])] == ["a"]
+    assert batch["cancelled_at"] is not None
+
+
+def test_workers_sharing_a_directory_run_batches_once(tmp_path):
+    store = FileStore(str(tmp_path))
+    ran = []
+
+    async def execute(url, body):
+        ran.append(body["messages"][0]["content"])
+        return {"ok": True}
+
+    async def run():
+        owner = BatchRunner(str(tmp_path), store, execute, poll_seconds=0.01)
+        other = BatchRunner(str(tmp_path), store, execute, poll_seconds=0.01)
+        await owner.start()
+        await other.start()
+        assert owner.owner and not other.owner
+
+        # A batch created through the other worker is run by the owner, once
+        file = await store.create(_jsonl(_request("a", "one"), _request("b", "two")), "in.jsonl", "batch", (URL,))
+        batch = await other.create(file["id"], URL, "24h", None)
+        await _wait_for(other, batch["id"], "completed")
+        assert sorted(ran) == ["one", "two"]
+
+        # When the owner goes away, the other worker takes over
+        await owner.stop()
+        for _ in range(100):
+            if other.owner:
+                break
+            await asyncio.sleep(0.01)
+        assert other.owner
+        batch = await other.create(file["id"], URL, "24h", None)
+        await _wait_for(other, batch["id"], "completed")
+        await other.stop()
+
+    asyncio.run(run())
+    assert len(ran) == 4
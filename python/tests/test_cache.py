@@ -0,0 +1,81 @@
+import asyncio
+
+from app.cache import ResponseCache, payload_key
+
+
+def test_payload_key_is_canonical():
+    assert payload_key({"a": 1, "b": "x"}) == payload_key({"b": "x", "a": 1})
+    assert payload_key({"a": 1}) != payload_key({"a": 2})
+
+
+def test_lru_eviction_by_bytes():
+    cache = ResponseCache(max_bytes=10, default_ttl=60)
+
+    async def run():
+        await cache.put("a", b"aaaa")
+        await cache.put("b", b"bbbb")
+        assert await cache.get("a") == b"aaaa"  # "a" is now most recently used
+        await cache.put("c", b"cccc")
+        return await cache.get("a"), await cache.get("b"), await cache.get("c")
+
+    assert asyncio.run(run()) == (b"aaaa", None, b"cccc")
+    assert cache.evictions == 1
+    assert cache.stats()["bytes"] == 8
+
+
+def test_per_entry_ttl(monkeypatch):
+    cache = ResponseCache(max_bytes=1024, default_ttl=60)
+    now = [1000.0]
+    monkeypatch.setattr("app.cache.time.time", lambda: now[0])
+
+    async def run():
+        await cache.put("short", b"1", ttl=5)
+        await cache.put("long", b"2")
+        now[0] += 10
+        return await cache.get("short"), await cache.get("long")
+
+    assert asyncio.run(run()) == (None, b"2")
+    assert cache.expired == 1
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    first = ResponseCache(max_bytes=1024, default_ttl=60, path=path, max_disk_bytes=1024)
+    asyncio.run(first.put("k", b"value"))
+    first.close()
+
+    second = ResponseCache(max_bytes=1024, default_ttl=60, path=path, max_disk_bytes=1024)
+    assert asyncio.run(second.get("k")) == b"value"
+    assert second.disk_hits == 1
+    second.close()
+
+
+def test_disk_tier_is_bounded(tmp_path):
+    cache = ResponseCache(max_bytes=0, default_ttl=60, path=str(tmp_path / "c.sqlite"), max_disk_bytes=10)
+
+    async def run():
+        for k in ("a", "b", "c"):
+            await cache.put(k, b"xxxx")
+        return await cache.get("a"), await cache.get("c")
+
+    assert asyncio.run(run()) == (None, b"xxxx")
+    assert cache.stats()["disk"]["evictions"] == 1
+    cache.close()
+
+
+def test_disk_tier_shared_by_processes_stays_bounded(tmp_path):
+    # Two caches on one file stand in for two worker processes
+    path = str(tmp_path / "shared.sqlite")
+    a = ResponseCache(max_bytes=0, default_ttl=60, path=path, max_disk_bytes=10)
+    b = ResponseCache(max_bytes=0, default_ttl=60, path=path, max_disk_bytes=10)
+
+    async def run():
+        await a.put("k1", b"aaaa")
+        await b.put("k2", b"bbbb")
+        await a.put("k3", b"cccc")
+        return await b.get("k1"), await a.get("k2"), await b.get("k3")
+
+    assert asyncio.run(run()) == (None, b"bbbb", b"cccc")
+    assert a.stats()["disk"]["bytes"] == b.stats()["disk"]["bytes"] == 8
+    a.close()
+    b.close()
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from app.catalog import ModelCatalog
+
+
+def _fetcher(calls, delay=0.0):
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return [{"id": f"model-{len(calls)}"}, {"id": "shared"}, {"id": "shared", "owned_by": "dup"}]
+    return fetch
+
+
+def test_concurrent_misses_share_one_fetch():
+    calls = []
+    catalog = ModelCatalog(_fetcher(calls, delay=0.01), ttl=60)
+
+    async def run():
+        return await asyncio.gather(*(catalog.get("shared") for _ in range(20)))
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+    # First duplicate id wins
+    assert "owned_by" not in results[0]
+
+
+def test_stale_entry_is_served_while_refreshing():
+    calls = []
+    catalog = ModelCatalog(_fetcher(calls), ttl=60, stale_ttl=60)
+
+    async def run():
+        await catalog.list()
+        catalog._fetched_at -= 90  # expired, but inside the stale window
+        stale = await catalog.list()
+        await asyncio.sleep(0)
+        await catalog._background
+        fresh = await catalog.list()
+        return stale, fresh
+
+    stale, fresh = asyncio.run(run())
+    assert stale[0]["id"] == "model-1"
+    assert fresh[0]["id"] == "model-2"
+    assert catalog.stale_hits == 1
+    assert catalog.refreshes == 2
+
+
+def test_fetch_errors_propagate_and_are_counted():
+    async def failing():
+        raise RuntimeError("upstream down")
+
+    catalog = ModelCatalog(failing, ttl=60)
+    with pytest.raises(RuntimeError):
+        asyncio.run(catalog.list())
+    assert catalog.refresh_errors == 1
@@ -0,0 +1,121 @@
+import asyncio
+import gzip
+import zlib
+
+import brotli
+import pytest
+import zstandard
+
+from app.compression import (
+    BodyTooLarge,
+    CompressionMiddleware,
+    Compressor,
+    Decompressor,
+    negotiate,
+)
+
+SETTINGS = {
+    "enabled": True,
+    "minimum_size": 100,
+    "codecs": ["zstd", "br", "gzip"],
+    "levels": {},
+    "max_decompressed_bytes": 1024,
+}
+
+
+def test_negotiate():
+    codecs = ["zstd", "br", "gzip"]
+    assert negotiate("gzip, deflate, br, zstd", codecs) == "zstd"
+    assert negotiate("gzip, br;q=0.9", codecs) == "gzip"
+    assert negotiate("zstd;q=0, *;q=0.5", codecs) == "br"
+    assert negotiate("identity", codecs) is None
+    assert negotiate("", codecs) is None
+    assert negotiate("zstd", ["br", "gzip"]) is None
+
+
+@pytest.mark.parametrize("codec", ["gzip", "br", "zstd"])
+def test_compressor_round_trip(codec):
+    decode = {"gzip": gzip.decompress, "br": brotli.decompress, "zstd": lambda b: zstandard.ZstdDecompressor().decompressobj().decompress(b)}[codec]
+    compressor = Compressor(codec)
+    data = b"".join(compressor.compress(b'{"id": %d}\n' % i) for i in range(1000)) + compressor.finish()
+    assert decode(data) == b"".join(b'{"id": %d}\n' % i for i in range(1000))
+
+
+@pytest.mark.parametrize("codec", ["gzip", "zstd"])
+def test_decompressor_limit(codec):
+    body = gzip.compress(b"\0" * 10_000) if codec == "gzip" else zstandard.ZstdCompressor().compress(b"\0" * 10_000)
+    assert Decompressor(codec, 10_000).decompress(body, final=True) == b"\0" * 10_000
+    with pytest.raises(BodyTooLarge):
+        Decompressor(codec, 9_999).decompress(body, final=True)
+    with pytest.raises(ValueError):
+        Decompressor(codec, 10_000).decompress(b"not compressed", final=True)
+
+
+def _run(app, headers, body=b""):
+    sent = []
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/", "headers": headers}
+    asyncio.run(CompressionMiddleware(app, settings=lambda: SETTINGS)(scope, receive, send))
+    return sent
+
+
+def _app(content_type, chunks, status=200, headers=()):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", content_type), *headers]})
+        for i, chunk in enumerate(chunks):
+            await send({"type": "http.response.body", "body": chunk, "more_body": i < len(chunks) - 1})
+
+    return app
+
+
+def test_sse_is_flushed_per_event():
+    events = [b"data: {\"delta\": \"%d\"}\n\n" % i for i in range(5)]
+    sent = _run(_app(b"text/event-stream", events), [(b"accept-encoding", b"gzip")])
+    start, bodies = sent[0], [m["body"] for m in sent[1:]]
+    assert (b"content-encoding", b"gzip") in start["headers"]
+    assert (b"vary", b"Accept-Encoding") in start["headers"]
+    # Every event can be decoded as soon as its chunk arrives
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert [decoder.decompress(b) for b in bodies] == events
+
+
+def test_small_and_binary_responses_pass_through():
+    small = _run(_app(b"application/json", [b"{}"]), [(b"accept-encoding", b"gzip")])
+    assert small[0]["headers"] == [(b"content-type", b"application/json")]
+    audio = _run(_app(b"audio/mpeg", [b"\0" * 1000]), [(b"accept-encoding", b"gzip")])
+    assert audio[1]["body"] == b"\0" * 1000
+
+
+def test_partial_content_passes_through():
+    body = b"x" * 2000
+    partial = _run(
+        _app(b"text/plain", [body], status=206, headers=[(b"content-range", b"bytes 0-1999/5000")]),
+        [(b"accept-encoding", b"gzip")],
+    )
+    assert (b"content-encoding", b"gzip") not in partial[0]["headers"]
+    assert partial[1]["body"] == body
+    # A Content-Range on another status (e.g. 416's "bytes */5000") too
+    unsatisfiable = _run(
+        _app(b"text/plain", [body], status=416, headers=[(b"content-range", b"bytes */5000")]),
+        [(b"accept-encoding", b"gzip")],
+    )
+    assert unsatisfiable[1]["body"] == body
+
+
+def test_request_bodies():
+    async def echo(scope, receive, send):
+        body = (await receive())["body"]
+        assert dict(scope["headers"]).get(b"content-encoding") is None
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": body})
+
+    sent = _run(echo, [(b"content-encoding", b"gzip")], gzip.compress(b"hello"))
+    assert sent[1]["body"] == b"hello"
+    assert _run(echo, [(b"content-encoding", b"br")], brotli.compress(b"hello"))[0]["status"] == 415
@@ -0,0 +1,30 @@
+import json
+
+import pytest
+
+from app import fastjson
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_roundtrip_matches_stdlib(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(fastjson, "orjson", None)
+    obj = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "héllo \"quoted\"\n"}], "n": 1.5}
+
+    encoded = fastjson.dumps(obj)
+    assert isinstance(encoded, bytes)
+    assert json.loads(encoded) == obj
+    assert fastjson.loads(encoded) == obj
+    with pytest.raises(ValueError):
+        fastjson.loads(b"{not json")
+
+
+def test_values_orjson_rejects_fall_back_to_stdlib():
+    big = 2 ** 70
+    assert fastjson.loads(fastjson.dumps({"big": big})) == {"big": big}
+
+
+def test_response_renders_compact_bytes():
+    resp = fastjson.FastJSONResponse({"a": [1, 2]})
+    assert resp.body == b'{"a":[1,2]}'
+    assert resp.headers["content-type"] == "application/json"
@@ -0,0 +1,47 @@
+import json
+import random
+
+import pytest
+from fastapi import HTTPException
+
+from app.ingest import MessageScanner
+
+
+def _feed(scanner, body, rng):
+    pos = 0
+    while pos < len(body):
+        size = rng.randint(1, 16)
+        scanner.feed(body[pos:pos + size])
+        pos += size
+    return scanner
+
+
+def test_counts_top_level_messages_across_chunk_boundaries():
+    rng = random.Random(0)
+    messages = [{"role": "user", "content": "a\"b\\" * i + "}]{[", "extra": [{"k": "]"}]} for i in range(20)]
+    body = json.dumps({
+        "a": {"messages": [{}, {}]},
+        "m\"essages": [{}],
+        "messages": messages,
+        "tools": [{}, {}],
+    }).encode()
+    largest = max(len(json.dumps(m)) for m in messages)
+    for _ in range(50):
+        scanner = _feed(MessageScanner(max_messages=20, max_message_bytes=largest), body, rng)
+        assert scanner.messages == 20
+
+
+@pytest.mark.parametrize("limits", [{"max_messages": 19}, {"max_message_bytes": 100}])
+def test_rejects_past_a_limit(limits):
+    messages = [{"role": "user", "content": "x" * i * 10} for i in range(20)]
+    body = json.dumps({"messages": messages}).encode()
+    with pytest.raises(HTTPException) as e:
+        _feed(MessageScanner(**limits), body, random.Random(1))
+    assert e.value.status_code == 413
+
+
+def test_rejects_a_huge_message_before_it_ends():
+    scanner = MessageScanner(max_message_bytes=1000)
+    scanner.feed(b'{"messages": [{"role": "user", "content": "')
+    with pytest.raises(HTTPException):
+        scanner.feed(b"x" * 2000)
@@ -0,0 +1,24 @@
+from app.launcher import cpu_quota, default_workers
+
+
+def test_cpu_quota_cgroup_v2(tmp_path):
+    (tmp_path / "cpu.max").write_text("150000 100000\n")
+    assert cpu_quota(str(tmp_path)) == 1.5
+    (tmp_path / "cpu.max").write_text("max 100000\n")
+    assert cpu_quota(str(tmp_path)) is None
+
+
+def test_cpu_quota_cgroup_v1(tmp_path):
+    (tmp_path / "cpu").mkdir()
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text("200000\n")
+    (tmp_path / "cpu" / "cpu.cfs_period_us").write_text("100000\n")
+    assert cpu_quota(str(tmp_path)) == 2.0
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text("-1\n")
+    assert cpu_quota(str(tmp_path)) is None
+
+
+def test_default_workers():
+    assert default_workers(None, 8) == 8
+    assert default_workers(1.5, 8) == 2
+    assert default_workers(0.25, 8) == 1
+    assert default_workers(16.0, 4) == 4
@@ -1,5 +1,10 @@
 import os
 import json
+import asyncio
+import gzip
+import io
+import time
+import httpx
 import pytest
 import respx
 from fastapi.testclient import TestClient
@@ -9,12 +14,25 @@ from httpx import Response
 os.environ["ASKSAGE_API_KEY"] = "test-api-key"
 os.environ["ASKSAGE_SERVER_BASE"] = "https://mock.asksage.server/server/"
 
+import app.main as main
+from app.accesslog import AccessLog
+from app.cache import ResponseCache
 from app.main import app
+from app.metrics import Counter
+from app.ratelimit import ClientRateLimiter
+from app.scheduler import AdmissionController
 
 client = TestClient(app)
 
 MOCK_BASE = "https://mock.asksage.server/server/"
 
+
+@pytest.fixture(autouse=True)
+def _reset_state():
+    main.model_catalog.invalidate()
+    main.upstream_breakers.clear()
+    yield
+
 def test_healthz():
     resp = client.get("/healthz")
     assert resp.status_code == 200
@@ -198,3 +216,926 @@ def test_audio_transcriptions():
     assert resp.status_code == 200
     data = resp.json()
     assert data["text"] == "Extracted text from audio"
+
+
+@respx.mock
+def test_v1_models_served_from_cache():
+    route = respx.post(f"{MOCK_BASE}get-models").mock(
+        return_value=Response(200, json={"data": [{"id": "gpt-4o-mini"}, {"id": "gpt-4o"}]})
+    )
+    before = client.get("/healthz").json()["models_cache"]
+
+    assert client.get("/v1/models").status_code == 200
+    assert client.get("/v1/models/gpt-4o").json()["id"] == "gpt-4o"
+    assert client.get("/v1/models/missing").status_code == 404
+    assert route.call_count == 1
+
+    stats = client.get("/healthz").json()["models_cache"]
+    assert stats["misses"] - before["misses"] == 1
+    assert stats["hits"] - before["hits"] == 2
+
+
+@respx.mock
+def test_admin_models_refresh(monkeypatch):
+    route = respx.post(f"{MOCK_BASE}get-models").mock(
+        return_value=Response(200, json={"data": [{"id": "gpt-4o-mini"}]})
+    )
+
+    # Disabled unless an admin token is configured
+    assert client.post("/admin/models/refresh").status_code == 404
+
+    monkeypatch.setattr(main, "ASKSAGE_ADMIN_TOKEN", "s3cret")
+    assert client.post("/admin/models/refresh", headers={"x-admin-token": "nope"}).status_code == 403
+
+    client.get("/v1/models")
+    resp = client.post("/admin/models/refresh", headers={"x-admin-token": "s3cret"})
+    assert resp.status_code == 200
+    assert resp.json()["cached_models"] == 1
+    assert route.call_count == 2
+
+
+@respx.mock
+def test_chat_completions_response_cache(monkeypatch):
+    monkeypatch.setattr(main, "response_cache", ResponseCache(max_bytes=1024 * 1024, default_ttl=60))
+    route = respx.post(f"{MOCK_BASE}query").mock(
+        return_value=Response(200, json={"message": "Cached answer"})
+    )
+    payload = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "Hi"}], "temperature": 0}
+
+    first = client.post("/v1/chat/completions", json=payload)
+    assert first.headers["x-asksage-cache"] == "miss"
+
+    second = client.post("/v1/chat/completions", json=payload)
+    assert second.headers["x-asksage-cache"] == "hit"
+    assert second.json()["choices"][0]["message"]["content"] == "Cached answer"
+
+    streamed = client.post("/v1/chat/completions", json=dict(payload, stream=True))
+    assert streamed.headers["x-asksage-cache"] == "hit"
+    assert "Cached answer" in streamed.text
+
+    bypass = client.post("/v1/chat/completions", json=payload, headers={"Cache-Control": "no-cache"})
+    assert bypass.headers["x-asksage-cache"] == "bypass"
+
+    bad_ttl = client.post("/v1/chat/completions", json=dict(payload, asksage={"cache_ttl": "abc"}))
+    assert bad_ttl.status_code == 400
+
+    # Non-deterministic sampling is never cached
+    client.post("/v1/chat/completions", json=dict(payload, temperature=0.7))
+    assert route.call_count == 3
+    assert main.response_cache.stats()["hits"] == 2
+
+
+@respx.mock
+def test_identical_chat_requests_are_coalesced():
+    async def slow_query(request):
+        await asyncio.sleep(0.05)
+        return Response(200, json={"message": "Shared answer"})
+
+    route = respx.post(f"{MOCK_BASE}query").mock(side_effect=slow_query)
+    payload = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "Same prompt"}]}
+
+    async def burst():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as ac:
+            return await asyncio.gather(*(ac.post("/v1/chat/completions", json=payload) for _ in range(5)))
+
+    responses = asyncio.run(burst())
+    assert [r.status_code for r in responses] == [200] * 5
+    assert all(r.json()["choices"][0]["message"]["content"] == "Shared answer" for r in responses)
+    assert route.call_count == 1
+
+    # Sampling requests are independent and never share a completion
+    payload["temperature"] = 0.8
+    asyncio.run(burst())
+    assert route.call_count == 6
+
+
+@respx.mock
+def test_requests_with_a_deadline_are_not_coalesced(monkeypatch):
+    monkeypatch.setattr(main, "ABANDONED", Counter("abandoned", "", ("reason",)))
+    calls = []
+
+    async def slow_query(request):
+        calls.append(request)
+        await asyncio.sleep(0.2)
+        return Response(200, json={"message": "Answer"})
+
+    respx.post(f"{MOCK_BASE}query").mock(side_effect=slow_query)
+    payload = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "Same prompt"}]}
+
+    async def pair():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as ac:
+            hurried = ac.post("/v1/chat/completions", json=payload, headers={"X-Request-Timeout": "0.05"})
+            return await asyncio.gather(hurried, ac.post("/v1/chat/completions", json=payload))
+
+    hurried, patient = asyncio.run(pair())
+    assert hurried.status_code == 504
+    # The request without a deadline made its own call rather than sharing the one that timed out
+    assert patient.status_code == 200
+    assert len(calls) == 2
+
+
+@respx.mock
+def test_audio_speech_is_streamed_in_chunks(monkeypatch):
+    monkeypatch.setattr(main, "ASKSAGE_STREAM_CHUNK_BYTES", 1024)
+    mock_audio = bytes(range(256)) * 40
+    respx.post(f"{MOCK_BASE}get-text-to-speech").mock(
+        return_value=Response(200, content=mock_audio, headers={"Content-Type": "audio/wav"})
+    )
+
+    sent = []
+
+    async def run():
+        body = [{"type": "http.request", "body": json.dumps({"input": "Hello"}).encode(), "more_body": False}]
+        done = asyncio.Event()
+
+        async def receive():
+            if body:
+                return body.pop()
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+            if message["type"] == "http.response.body" and not message.get("more_body"):
+                done.set()
+
+        scope = {
+            "type": "http", "http_version": "1.1", "method": "POST", "path": "/v1/audio/speech",
+            "raw_path": b"/v1/audio/speech", "query_string": b"", "root_path": "", "scheme": "http",
+            "headers": [(b"content-type", b"application/json")], "client": ("test", 1), "server": ("proxy", 80),
+        }
+        await app(scope, receive, send)
+
+    asyncio.run(run())
+    start = sent[0]
+    assert start["status"] == 200
+    headers = dict(start["headers"])
+    assert headers[b"content-type"] == b"audio/wav"
+    assert headers[b"content-length"] == str(len(mock_audio)).encode()
+    chunks = [m["body"] for m in sent[1:] if m.get("body")]
+    assert b"".join(chunks) == mock_audio
+    assert len(chunks) > 1
+    assert max(len(c) for c in chunks) <= 1024
+
+
+@respx.mock
+def test_audio_speech_upstream_error():
+    respx.post(f"{MOCK_BASE}get-text-to-speech").mock(return_value=Response(503, text="busy"))
+
+    resp = client.post("/v1/audio/speech", json={"input": "Hello"})
+    assert resp.status_code == 502
+    assert "503" in resp.json()["detail"]
+
+
+@respx.mock
+def test_audio_transcriptions_streams_multipart_upstream(monkeypatch):
+    monkeypatch.setattr(main, "ASKSAGE_UPLOAD_CHUNK_BYTES", 1000)
+    route = respx.post(f"{MOCK_BASE}file").mock(return_value=Response(200, json={"ret": "ok"}))
+    audio = os.urandom(10_000)
+
+    resp = client.post("/v1/audio/transcriptions", files={"file": ("meeting.wav", audio, "audio/wav")})
+    assert resp.status_code == 200
+
+    sent = route.calls.last.request
+    body = sent.content
+    assert sent.headers["content-length"] == str(len(body))
+    boundary = sent.headers["content-type"].split("boundary=")[1]
+    assert body.startswith(f"--{boundary}\r\n".encode())
+    assert b'name="file"; filename="meeting.wav"' in body
+    assert b"Content-Type: audio/wav\r\n\r\n" + audio + f"\r\n--{boundary}--\r\n".encode() in body
+
+
+@respx.mock
+def test_audio_transcriptions_upload_limit(monkeypatch):
+    monkeypatch.setattr(main, "ASKSAGE_MAX_UPLOAD_BYTES", 4096)
+    route = respx.post(f"{MOCK_BASE}file").mock(return_value=Response(200, json={"ret": "ok"}))
+
+    # Rejected from the declared Content-Length
+    resp = client.post("/v1/audio/transcriptions", files={"file": ("big.wav", b"x" * 8192, "audio/wav")})
+    assert resp.status_code == 413
+
+    # Rejected while streaming a chunked body that has no Content-Length
+    def chunks():
+        yield b"--b\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.wav\"\r\n\r\n"
+        for _ in range(8):
+            yield b"x" * 1024
+        yield b"\r\n--b--\r\n"
+
+    resp = client.post(
+        "/v1/audio/transcriptions",
+        content=chunks(),
+        headers={"Content-Type": "multipart/form-data; boundary=b"},
+    )
+    assert resp.status_code == 413
+    assert not route.called
+
+
+def _sse_events(text):
+    return [line for line in text.split("\n\n") if line]
+
+
+@respx.mock
+def test_chat_completions_stream_heartbeats_and_deltas(monkeypatch):
+    monkeypatch.setattr(main, "ASKSAGE_SSE_HEARTBEAT_SECONDS", 0.01)
+    monkeypatch.setattr(main, "ASKSAGE_SSE_CHUNK_CHARS", 10)
+    answer = "The quick brown fox jumps over the lazy dog, twice over."
+
+    async def slow_query(request):
+        await asyncio.sleep(0.1)
+        return Response(200, json={"message": answer})
+
+    respx.post(f"{MOCK_BASE}query").mock(side_effect=slow_query)
+    payload = {"messages": [{"role": "user", "content": "Hi"}], "stream": True}
+    resp = client.post("/v1/chat/completions", json=payload)
+    assert resp.status_code == 200
+
+    events = _sse_events(resp.text)
+    first = json.loads(events[0][len("data: "):])
+    assert first["choices"][0]["delta"] == {"role": "assistant", "content": ""}
+    assert events[1] == ": keepalive"
+
+    data = [json.loads(e[len("data: "):]) for e in events if e.startswith("data: {")]
+    deltas = [d["choices"][0]["delta"].get("content", "") for d in data]
+    assert "".join(deltas) == answer
+    assert len([d for d in deltas if d]) > 3
+    assert data[-1]["choices"][0]["finish_reason"] == "stop"
+    assert events[-1] == "data: [DONE]"
+
+
+@respx.mock
+def test_chat_completions_stream_upstream_error():
+    respx.post(f"{MOCK_BASE}query").mock(return_value=Response(500, json={"error": "boom"}))
+
+    payload = {"messages": [{"role": "user", "content": "Hi"}], "stream": True}
+    resp = client.post("/v1/chat/completions", json=payload)
+    assert resp.status_code == 200
+
+    events = _sse_events(resp.text)
+    error = json.loads(events[1][len("data: "):])["error"]
+    assert error["code"] == 502
+    assert "AskSage request failed" in error["message"]
+    assert events[-1] == "data: [DONE]"
+
+
+def test_http_client_pool_settings(monkeypatch):
+    monkeypatch.setattr(main, "ASKSAGE_POOL_MAX_CONNECTIONS", 7)
+    monkeypatch.setattr(main, "ASKSAGE_POOL_MAX_KEEPALIVE", 3)
+    monkeypatch.setattr(main, "HTTP_CONNECT_TIMEOUT", 2.5)
+    monkeypatch.setattr(main, "ASKSAGE_HTTP2", True)
+
+    http_client = main._build_http_client()
+    pool = http_client._transport._pool
+    assert pool._max_connections == 7
+    assert pool._max_keepalive_connections == 3
+    assert pool._http2 is True
+    assert http_client.timeout.connect == 2.5
+    assert http_client.timeout.read == main.HTTP_READ_TIMEOUT
+    asyncio.run(http_client.aclose())
+
+
+@respx.mock
+def test_startup_warm_up(monkeypatch):
+    monkeypatch.setattr(main, "ASKSAGE_WARMUP_CONNECTIONS", 3)
+    route = respx.head(MOCK_BASE).mock(return_value=Response(405))
+
+    with TestClient(app) as lifespan_client:
+        health = lifespan_client.get("/healthz").json()
+
+    assert route.call_count == 3
+    assert health["warmup"]["ok"] == 3
+    assert health["http_pool"]["max_connections"] == main.ASKSAGE_POOL_MAX_CONNECTIONS
+    assert "idle" in health["http_pool"]
+
+
+@respx.mock
+def test_chat_completions_admission_control(monkeypatch):
+    monkeypatch.setattr(main, "admission", AdmissionController(max_concurrency=1, max_queue=1, max_wait=5))
+
+    async def slow_query(request):
+        await asyncio.sleep(0.1)
+        return Response(200, json={"message": "ok"})
+
+    route = respx.post(f"{MOCK_BASE}query").mock(side_effect=slow_query)
+
+    async def burst():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as ac:
+            async def post(i):
+                await asyncio.sleep(0.01 * i)
+                payload = {"messages": [{"role": "user", "content": f"prompt {i}"}]}
+                return await ac.post("/v1/chat/completions", json=payload)
+            return await asyncio.gather(*(post(i) for i in range(3)))
+
+    responses = asyncio.run(burst())
+    assert [r.status_code for r in responses] == [200, 200, 429]
+    assert int(responses[2].headers["retry-after"]) >= 1
+    assert route.call_count == 2
+    assert client.get("/healthz").json()["admission"]["rejected_full"] == 1
+
+
+@respx.mock
+def test_chat_completions_per_client_rate_limit(monkeypatch):
+    monkeypatch.setattr(main, "rate_limiter", ClientRateLimiter(requests_per_second=0.1, burst=1, tokens_per_minute=1000))
+    monkeypatch.setattr(main, "ASKSAGE_CLIENT_ID_HEADER", "x-client-id")
+    route = respx.post(f"{MOCK_BASE}query").mock(return_value=Response(200, json={"message": "ok"}))
+    payload = {"messages": [{"role": "user", "content": "x" * 400}]}
+
+    first = client.post("/v1/chat/completions", json=payload, headers={"X-Client-Id": "agent"})
+    assert first.status_code == 200
+    assert first.headers["x-ratelimit-limit-requests"] == "1"
+    assert first.headers["x-ratelimit-remaining-requests"] == "0"
+    assert first.headers["x-ratelimit-limit-tokens"] == "1000"
+    assert 0 < int(first.headers["x-ratelimit-remaining-tokens"]) < 1000
+
+    limited = client.post("/v1/chat/completions", json=payload, headers={"X-Client-Id": "agent"})
+    assert limited.status_code == 429
+    assert limited.json()["detail"]["limit"] == "requests"
+    assert int(limited.headers["retry-after"]) >= 9
+    assert limited.headers["x-ratelimit-remaining-requests"] == "0"
+
+    # Another client, and streamed responses, get their own budget and headers
+    other = client.post("/v1/chat/completions", json=dict(payload, stream=True), headers={"X-Client-Id": "web-ui"})
+    assert other.status_code == 200
+    assert other.headers["x-ratelimit-remaining-requests"] == "0"
+    assert route.call_count == 2
+    assert client.get("/healthz").json()["rate_limits"]["limited_requests"] == 1
+
+
+@respx.mock
+def test_server_timing_phases():
+    respx.post(f"{MOCK_BASE}query").mock(return_value=Response(200, json={"message": "ok"}))
+    payload = {"messages": [{"role": "user", "content": "Hi"}], "asksage": {"timing": True}}
+
+    resp = client.post("/v1/chat/completions", json=payload)
+    assert resp.status_code == 200
+    phases = [entry.split(";")[0] for entry in resp.headers["server-timing"].split(", ")]
+    assert phases == ["parse", "prompt", "admission", "upstream", "serialize", "total"]
+    # The body has the phases up to serialization
+    timing = resp.json()["x-proxy-timing"]
+    assert list(timing) == ["parse", "prompt", "admission", "upstream", "total"]
+    assert timing["upstream"] <= timing["total"]
+
+    assert "x-proxy-timing" not in client.post("/v1/chat/completions", json=dict(payload, asksage={})).json()
+
+
+@respx.mock
+def test_request_and_window_profiles(monkeypatch):
+    respx.post(f"{MOCK_BASE}query").mock(return_value=Response(200, json={"message": "ok"}))
+    payload = {"messages": [{"role": "user", "content": "Hi"}]}
+    profile = {"X-Proxy-Profile": "1"}
+    assert client.post("/v1/chat/completions", json=payload, headers=profile).status_code == 404
+
+    monkeypatch.setattr(main, "ASKSAGE_ADMIN_TOKEN", "s3cret")
+    monkeypatch.setattr(main, "ASKSAGE_PROFILE_INTERVAL_MS", 0.5)
+    assert client.post("/v1/chat/completions", json=payload, headers=profile).status_code == 403
+
+    admin = {"X-Admin-Token": "s3cret"}
+    resp = client.post("/v1/chat/completions", json=payload, headers={**profile, **admin})
+    assert resp.status_code == 200
+    profile_id = resp.headers["x-proxy-profile"]
+    folded = client.get(f"/admin/profiles/{profile_id}", headers=admin)
+    assert folded.status_code == 200
+    assert folded.headers["content-disposition"] == f'attachment; filename="{profile_id}.folded"'
+    for line in folded.text.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0 and stack
+    assert client.get("/admin/profiles/nope", headers=admin).status_code == 404
+
+    window = client.post("/admin/profile?seconds=0.05", headers=admin)
+    assert window.status_code == 200
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in window.text.splitlines()) > 0
+    assert client.post("/admin/profile?seconds=3600", headers=admin).status_code == 400
+
+
+@respx.mock
+def test_response_and_request_compression(monkeypatch):
+    route = respx.post(f"{MOCK_BASE}query").mock(return_value=Response(200, json={"message": "lorem ipsum " * 200}))
+    payload = {"messages": [{"role": "user", "content": "Hi"}]}
+
+    resp = client.post("/v1/chat/completions", json=payload, headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["content-encoding"] == "gzip"
+    assert resp.json()["choices"][0]["message"]["content"] == "lorem ipsum " * 200
+    # The proxy asks Ask Sage for a compressed response too
+    assert "gzip" in route.calls.last.request.headers["accept-encoding"]
+    assert "content-encoding" not in client.get("/nope", headers={"Accept-Encoding": "gzip"}).headers
+    assert "content-encoding" not in client.post("/v1/chat/completions", json=payload, headers={"Accept-Encoding": "identity"}).headers
+
+    body = gzip.compress(json.dumps(payload).encode())
+    resp = client.post("/v1/chat/completions", content=body, headers={"Content-Encoding": "gzip", "Content-Type": "application/json"})
+    assert resp.status_code == 200
+
+    monkeypatch.setattr(main, "ASKSAGE_MAX_DECOMPRESSED_BYTES", 1000)
+    bomb = gzip.compress(json.dumps(dict(payload, user=" " * 100_000)).encode())
+    assert len(bomb) < 1000
+    resp = client.post("/v1/chat/completions", content=bomb, headers={"Content-Encoding": "gzip", "Content-Type": "application/json"})
+    assert resp.status_code == 413
+
+    monkeypatch.setattr(main, "ASKSAGE_UPSTREAM_COMPRESSION", False)
+    http_client = main._build_http_client()
+    assert http_client.headers["accept-encoding"] == "identity"
+    asyncio.run(http_client.aclose())
+
+
+@respx.mock
+def test_access_log_and_request_ids(monkeypatch):
+    secret = "the secret prompt"
+    route = respx.post(f"{MOCK_BASE}query").mock(return_value=Response(200, json={"message": "the secret answer", "usage": {"prompt_tokens": 4}}))
+    sink = io.BytesIO()
+    log = AccessLog(sink, sample_rate=0.0, sizes=True)
+    monkeypatch.setattr(main, "access_log", log)
+    payload = {"messages": [{"role": "user", "content": secret}]}
+
+    resp = client.post("/v1/chat/completions", json=payload, headers={"X-Request-ID": "req-42"})
+    assert resp.headers["x-request-id"] == "req-42"
+    assert route.calls.last.request.headers["x-request-id"] == "req-42"
+    generated = client.post("/v1/chat/completions", json=payload).headers["x-request-id"]
+    assert route.calls.last.request.headers["x-request-id"] == generated
+    # Sampled out: only errors and slow requests are logged
+    assert client.post("/v1/chat/completions", content=b"{").status_code == 400
+    monkeypatch.setattr(log, "sample_rate", 1.0)
+    client.post("/v1/chat/completions", json=payload, headers={"X-Request-ID": "req-43"})
+    log.close()
+
+    assert b"secret" not in sink.getvalue()
+    records = [json.loads(line) for line in sink.getvalue().splitlines()]
+    assert [r["status"] for r in records] == [400, 200]
+    record = records[1]
+    assert record["request_id"] == "req-43"
+    assert record["route"] == "/v1/chat/completions"
+    assert record["model"] == main.ASKSAGE_DEFAULT_MODEL
+    assert (record["upstream_calls"], record["upstream_status"]) == (1, "200")
+    assert (record["completion_chars"], record["prompt_tokens"]) == (len("the secret answer"), 4)
+    assert record["prompt_chars"] > len(secret)
+    assert log.stats()["sampled_out"] == 2
+
+
+@respx.mock
+def test_prometheus_metrics():
+    respx.post(f"{MOCK_BASE}query").mock(
+        return_value=Response(200, json={"message": "hi", "usage": {"prompt_tokens": 7, "completion_tokens": 3}})
+    )
+    respx.post(f"{MOCK_BASE}get-models").mock(return_value=Response(200, json={"data": [{"id": "m"}]}))
+
+    client.post("/v1/chat/completions", json={"messages": [{"role": "user", "content": "Hi"}]})
+    client.get("/v1/models/m")
+    client.get("/v1/models/m")
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    text = resp.text
+    assert 'asksage_proxy_requests_total{method="POST",route="/v1/chat/completions",status="200"}' in text
+    assert 'asksage_proxy_requests_total{method="GET",route="/v1/models/{model}",status="200"}' in text
+    assert 'asksage_proxy_upstream_requests_total{path="query",status="200"}' in text
+    assert 'asksage_proxy_upstream_duration_seconds_count{path="get-models"}' in text
+    assert 'asksage_proxy_tokens_total{type="completion"}' in text
+    assert "asksage_proxy_prompt_chars_bucket" in text
+    assert 'asksage_proxy_request_bytes_total{route="/v1/chat/completions"}' in text
+    assert "asksage_proxy_requests_in_flight 1" in text  # the scrape itself
+
+
+def test_chat_completions_rejects_invalid_json():
+    resp = client.post("/v1/chat/completions", content=b"{not json", headers={"Content-Type": "application/json"})
+    assert resp.status_code == 400
+
+    resp = client.post("/v1/chat/completions", json=["not", "an", "object"])
+    assert resp.status_code == 400
+
+
+@respx.mock
+def test_chat_completions_ingestion_limits(monkeypatch):
+    route = respx.post(f"{MOCK_BASE}query").mock(return_value=Response(200, json={"message": "ok"}))
+    monkeypatch.setattr(main, "ASKSAGE_MAX_CHAT_MESSAGES", 3)
+    monkeypatch.setattr(main, "ASKSAGE_MAX_MESSAGE_BYTES", 1000)
+    monkeypatch.setattr(main, "ASKSAGE_MAX_CHAT_BODY_BYTES", 10000)
+
+    ok = {"messages": [{"role": "user", "content": "Hi"}] * 3}
+    assert client.post("/v1/chat/completions", json=ok).status_code == 200
+    too_many = {"messages": [{"role": "user", "content": "Hi"}] * 4}
+    resp = client.post("/v1/chat/completions", json=too_many)
+    assert resp.status_code == 413
+    assert "more than 3 messages" in resp.json()["detail"]
+    too_long = {"messages": [{"role": "user", "content": "x" * 2000}]}
+    assert client.post("/v1/chat/completions", json=too_long).status_code == 413
+
+    def chunks():
+        yield b'{"messages": [{"role": "user", "content": "'
+        for _ in range(20):
+            yield b"y" * 1000
+        yield b'"}]}'
+
+    # Without a Content-Length the body is cut off as it streams in
+    assert client.post("/v1/chat/completions", content=chunks()).status_code == 413
+    assert route.call_count == 1
+
+
+@respx.mock
+def test_chat_completions_deadline():
+    async def slow(request):
+        await asyncio.sleep(1)
+        return Response(200, json={"message": "late"})
+
+    respx.post(f"{MOCK_BASE}query").mock(side_effect=slow)
+    payload = {"messages": [{"role": "user", "content": "Hi"}]}
+
+    resp = client.post("/v1/chat/completions", json=payload, headers={"X-Request-Timeout": "0.05"})
+    assert resp.status_code == 504
+
+    resp = client.post("/v1/chat/completions", json={**payload, "timeout": 0.05, "stream": True})
+    assert resp.status_code == 200
+    assert '"code": 504' in resp.text or '"code":504' in resp.text
+    assert resp.text.endswith("data: [DONE]\n\n")
+
+    resp = client.post("/v1/chat/completions", json=payload, headers={"X-Request-Timeout": "soon"})
+    assert resp.status_code == 400
+
+    text = client.get("/metrics").text
+    assert 'asksage_proxy_abandoned_requests_total{reason="deadline"} 2' in text
+
+
+@respx.mock
+def test_chat_completions_cancelled_on_client_disconnect():
+    cancelled = []
+
+    async def slow(request):
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return Response(200, json={"message": "late"})
+
+    respx.post(f"{MOCK_BASE}query").mock(side_effect=slow)
+    sent = []
+
+    async def run():
+        body = json.dumps({"messages": [{"role": "user", "content": "Hi"}]}).encode()
+        messages = [{"type": "http.disconnect"}, {"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive():
+            if len(messages) == 1:
+                await asyncio.sleep(0.05)
+            return messages.pop()
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http", "http_version": "1.1", "method": "POST", "path": "/v1/chat/completions",
+            "raw_path": b"/v1/chat/completions", "query_string": b"", "root_path": "", "scheme": "http",
+            "headers": [(b"content-type", b"application/json")], "client": ("test", 1), "server": ("proxy", 80),
+        }
+        await asyncio.wait_for(app(scope, receive, send), timeout=2)
+
+    asyncio.run(run())
+    assert sent[0]["status"] == 499
+    assert cancelled == [True]
+    assert 'asksage_proxy_abandoned_requests_total{reason="client_disconnect"}' in client.get("/metrics").text
+
+
+@respx.mock
+def test_upstream_backends_failover(monkeypatch):
+    from app.backends import Backend, BackendPool
+
+    pool = BackendPool(
+        [Backend("https://a.asksage.test/server/", "key-a"), Backend("https://b.asksage.test/server/", "key-b")],
+        eject_after=1,
+    )
+    monkeypatch.setattr(main, "upstream_pool", pool)
+    route_a = respx.post("https://a.asksage.test/server/query").mock(return_value=Response(503, text="busy"))
+    route_b = respx.post("https://b.asksage.test/server/query").mock(return_value=Response(200, json={"message": "from b"}))
+
+    payload = {"messages": [{"role": "user", "content": "Hi"}]}
+    for _ in range(3):
+        resp = client.post("/v1/chat/completions", json=payload)
+        assert resp.status_code == 200
+        assert resp.json()["choices"][0]["message"]["content"] == "from b"
+
+    # a failed once and was ejected, so later calls went straight to b
+    assert route_a.call_count == 1
+    assert route_b.call_count == 3
+    assert route_b.calls[0].request.headers["x-access-tokens"] == "key-b"
+
+    backends = client.get("/healthz").json()["upstream"]["backends"]
+    assert backends[0]["ejected"] is True
+    assert backends[0]["server_errors"] == 1
+    assert backends[1]["requests"] == 3
+    assert 'asksage_proxy_backend_ejected{backend="https://a.asksage.test/server/#ey-a"} 1' in client.get("/metrics").text
+
+    # Connection failures fail over too; a non-retryable error does not
+    pool.backends[0].ejected_until = 0.0
+    route_a.mock(side_effect=httpx.ConnectError("refused"))
+    route_b.mock(return_value=Response(500, json={"message": "boom"}))
+    resp = client.post("/v1/chat/completions", json=payload)
+    assert resp.status_code == 502
+    assert route_b.call_count == 4
+
+
+@respx.mock
+def test_upstream_retries_with_backoff_and_budget(monkeypatch):
+    from app.resilience import RetryBudget
+
+    monkeypatch.setattr(main, "ASKSAGE_RETRY_BACKOFF", 0.001)
+    monkeypatch.setattr(main, "retry_budget", RetryBudget(ratio=0.0, min_per_second=0.3, window=10))
+    route = respx.post(f"{MOCK_BASE}query").mock(
+        side_effect=[
+            httpx.ConnectError("refused"),
+            Response(429, headers={"Retry-After": "0"}),
+            Response(200, json={"message": "ok"}),
+        ]
+    )
+    payload = {"messages": [{"role": "user", "content": "Hi"}]}
+    resp = client.post("/v1/chat/completions", json=payload)
+    assert resp.status_code == 200
+    assert route.call_count == 3
+
+    # One retry left in the budget: the second 503 is returned as is
+    route.mock(return_value=Response(503, text="down"))
+    resp = client.post("/v1/chat/completions", json=payload)
+    assert resp.status_code == 502
+    assert route.call_count == 5
+    assert client.get("/healthz").json()["retries"] == {
+        "ratio": 0.0, "min_per_second": 0.3, "retries": 3, "exhausted": 1,
+    }
+
+
+@respx.mock
+def test_upstream_circuit_breaker(monkeypatch):
+    monkeypatch.setattr(main, "ASKSAGE_BREAKER_FAILURES", 2)
+    monkeypatch.setattr(main, "ASKSAGE_RETRY_MAX", 0)
+    route = respx.post(f"{MOCK_BASE}query").mock(return_value=Response(500, json={"message": "boom"}))
+    payload = {"messages": [{"role": "user", "content": "Hi"}]}
+
+    for _ in range(2):
+        assert client.post("/v1/chat/completions", json=payload).status_code == 502
+    resp = client.post("/v1/chat/completions", json=payload)
+    assert resp.status_code == 503
+    assert int(resp.headers["retry-after"]) >= 1
+    assert route.call_count == 2
+
+    health = client.get("/healthz").json()
+    assert health["circuit_breakers"]["query"]["state"] == "open"
+    assert 'asksage_proxy_circuit_open{path="query"} 1' in client.get("/metrics").text
+
+    # After the open period a probe goes through and closes the circuit on success
+    main.upstream_breakers["query"].opened_until = 0.0
+    route.mock(return_value=Response(200, json={"message": "back"}))
+    assert client.post("/v1/chat/completions", json=payload).status_code == 200
+    assert client.get("/healthz").json()["circuit_breakers"]["query"]["state"] == "closed"
+
+
+@respx.mock
+def test_audio_speech_cache(monkeypatch, tmp_path):
+    from app.audiocache import AudioCache
+
+    monkeypatch.setattr(main, "tts_cache", AudioCache(str(tmp_path), max_bytes=1024 * 1024))
+    mock_audio = bytes(range(256)) * 4
+    route = respx.post(f"{MOCK_BASE}get-text-to-speech").mock(
+        return_value=Response(200, content=mock_audio, headers={"Content-Type": "audio/wav"})
+    )
+    payload = {"input": "Hello", "voice": "nova"}
+
+    miss = client.post("/v1/audio/speech", json=payload)
+    assert miss.status_code == 200
+    assert miss.headers["x-asksage-cache"] == "miss"
+    etag = miss.headers["etag"]
+
+    hit = client.post("/v1/audio/speech", json=payload)
+    assert hit.status_code == 200
+    assert hit.headers["x-asksage-cache"] == "hit"
+    assert hit.headers["etag"] == etag
+    assert hit.headers["content-type"] == "audio/wav"
+    assert hit.content == mock_audio
+    assert route.call_count == 1
+
+    not_modified = client.post("/v1/audio/speech", json=payload, headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+
+    partial = client.post("/v1/audio/speech", json=payload, headers={"Range": "bytes=100-199", "If-Range": etag})
+    assert partial.status_code == 206
+    assert partial.headers["content-range"] == f"bytes 100-199/{len(mock_audio)}"
+    assert partial.content == mock_audio[100:200]
+
+    # A different voice is a different entry
+    client.post("/v1/audio/speech", json={**payload, "voice": "alloy"})
+    assert route.call_count == 2
+    assert client.get("/healthz").json()["tts_cache"]["entries"] == 2
+
+
+def test_speech_cache_writer_starts_with_the_body(tmp_path):
+    from app.audiocache import AudioCache
+
+    cache = AudioCache(str(tmp_path), max_bytes=1024)
+
+    async def audio():
+        yield b"abc"
+        yield b"def"
+
+    async def run():
+        # Response dropped before its body was iterated: no temporary file
+        main._tee_to_cache(audio(), cache, "k", "audio/mpeg", None)
+        assert os.listdir(tmp_path) == []
+        # Client gone after the first chunk: the partial entry is discarded
+        body = main._tee_to_cache(audio(), cache, "k", "audio/mpeg", None)
+        assert await body.__anext__() == b"abc"
+        await body.aclose()
+        assert await cache.get("k") is None
+
+    asyncio.run(run())
+    assert cache.stats()["aborted_writes"] == 1
+    assert not [n for n in os.listdir(tmp_path) if n.startswith(".tmp-")]
+
+
+@respx.mock
+def test_audio_transcriptions_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        main, "transcription_cache", ResponseCache(max_bytes=1024 * 1024, default_ttl=60, path=str(tmp_path / "stt.db"))
+    )
+    monkeypatch.setattr(main, "transcription_flight", main.SingleFlight())
+
+    async def slow_file(request):
+        await asyncio.sleep(0.05)
+        return Response(200, json={"ret": "transcript"})
+
+    route = respx.post(f"{MOCK_BASE}file").mock(side_effect=slow_file)
+    audio = b"\x00\x01" * 5000
+
+    async def burst():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as ac:
+            return await asyncio.gather(*(
+                ac.post("/v1/audio/transcriptions", files={"file": ("a.wav", audio, "audio/wav")}) for _ in range(3)
+            ))
+
+    responses = asyncio.run(burst())
+    assert [r.json()["text"] for r in responses] == ["transcript"] * 3
+    assert route.call_count == 1
+
+    resp = client.post("/v1/audio/transcriptions", files={"file": ("b.wav", audio, "audio/wav")})
+    assert resp.headers["x-asksage-cache"] == "hit"
+    assert resp.json() == {"text": "transcript"}
+    assert route.call_count == 1
+
+    # Different model or different audio: uploaded again
+    client.post("/v1/audio/transcriptions", files={"file": ("a.wav", audio, "audio/wav")}, data={"model": "other"})
+    client.post("/v1/audio/transcriptions", files={"file": ("a.wav", audio + b"!", "audio/wav")})
+    assert route.call_count == 3
+
+    stats = client.get("/healthz").json()["transcription_cache"]
+    assert stats["hits"] == 1
+    assert stats["coalesced"] == 2
+    assert stats["bytes_not_uploaded"] >= 3 * len(audio)
+    assert 0 < stats["hit_ratio"] < 1
+
+
+@respx.mock
+def test_chat_completions_prompt_budget(monkeypatch):
+    monkeypatch.setattr(main, "ASKSAGE_MODEL_CONTEXT_TOKENS", {"small-model": 300})
+    route = respx.post(f"{MOCK_BASE}query").mock(return_value=Response(200, json={"message": "ok"}))
+    messages = [{"role": "system", "content": "Be brief."}]
+    for i in range(50):
+        messages.append({"role": "user", "content": f"question {i} " + "x" * 100})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "y" * 100})
+    messages.append({"role": "user", "content": "final"})
+
+    resp = client.post("/v1/chat/completions", json={"model": "small-model", "messages": messages, "max_tokens": 100})
+    assert resp.status_code == 200
+    dropped = int(resp.headers["x-asksage-prompt-dropped-messages"])
+    assert 0 < dropped < len(messages)
+    sent = json.loads(route.calls[0].request.content)["message"]
+    assert len(sent) <= 200 * 4 + 100
+    assert sent.startswith("System:\nBe brief.") and "final" in sent
+
+    resp = client.post("/v1/chat/completions", json={"model": "gpt-4o", "messages": messages})
+    assert "x-asksage-prompt-dropped-messages" not in resp.headers
+
+
+@respx.mock
+def test_chat_completions_n_choices(monkeypatch):
+    answers = iter(["one", "two", "three"])
+
+    async def sample(request):
+        await asyncio.sleep(0.01)
+        return Response(200, json={"message": next(answers), "usage": {"prompt_tokens": 5, "completion_tokens": 2}})
+
+    route = respx.post(f"{MOCK_BASE}query").mock(side_effect=sample)
+    payload = {"messages": [{"role": "user", "content": "Hi"}], "temperature": 0.9, "n": 3}
+
+    resp = client.post("/v1/chat/completions", json=payload)
+    assert resp.status_code == 200
+    data = resp.json()
+    assert [c["index"] for c in data["choices"]] == [0, 1, 2]
+    assert sorted(c["message"]["content"] for c in data["choices"]) == ["one", "three", "two"]
+    assert data["usage"] == {"prompt_tokens": 15, "completion_tokens": 6}
+    assert route.call_count == 3
+
+    # Deterministic payloads: every choice would be the same, so one call serves them all
+    route.mock(return_value=Response(200, json={"message": "same", "usage": {"completion_tokens": 2}}))
+    data = client.post("/v1/chat/completions", json={**payload, "temperature": 0}).json()
+    assert [c["message"]["content"] for c in data["choices"]] == ["same"] * 3
+    assert data["usage"] == {"completion_tokens": 2}
+    assert route.call_count == 4
+
+    assert client.post("/v1/chat/completions", json={**payload, "n": 0}).status_code == 400
+    assert client.post("/v1/chat/completions", json={**payload, "n": 1000}).status_code == 400
+
+
+@respx.mock
+def test_chat_completions_n_partial_failure(monkeypatch):
+    monkeypatch.setattr(main, "ASKSAGE_RETRY_MAX", 0)
+    responses = iter([Response(200, json={"message": "ok"}), Response(500, json={"message": "boom"})])
+    respx.post(f"{MOCK_BASE}query").mock(side_effect=lambda request: next(responses))
+    payload = {"messages": [{"role": "user", "content": "Hi"}], "temperature": 1, "n": 2}
+
+    resp = client.post("/v1/chat/completions", json=payload)
+    assert resp.status_code == 200
+    assert len(resp.json()["choices"]) == 1
+    assert resp.headers["x-asksage-failed-choices"] == "1"
+
+    monkeypatch.setattr(main, "ASKSAGE_N_FAILURE_POLICY", "fail")
+    responses = iter([Response(200, json={"message": "ok"}), Response(500, json={"message": "boom"})])
+    assert client.post("/v1/chat/completions", json=payload).status_code == 502
+
+
+@respx.mock
+def test_chat_completions_n_stream_interleaves_by_index():
+    async def sample(request):
+        delay = next(delays)
+        await asyncio.sleep(delay)
+        return Response(200, json={"message": f"slept {delay}"})
+
+    delays = iter([0.1, 0.01])
+    respx.post(f"{MOCK_BASE}query").mock(side_effect=sample)
+    payload = {"messages": [{"role": "user", "content": "Hi"}], "temperature": 1, "n": 2, "stream": True}
+
+    resp = client.post("/v1/chat/completions", json=payload)
+    events = [json.loads(e[len("data: "):]) for e in _sse_events(resp.text) if e.startswith("data: {")]
+    assert [e["choices"][0]["delta"].get("role") for e in events[:2]] == ["assistant", "assistant"]
+    finished = [e["choices"][0]["index"] for e in events if e["choices"][0]["finish_reason"] == "stop"]
+    assert finished == [1, 0]  # the faster choice is sent first
+    content = {i: "".join(e["choices"][0]["delta"].get("content", "") for e in events if e["choices"][0]["index"] == i) for i in (0, 1)}
+    assert content == {0: "slept 0.1", 1: "slept 0.01"}
+    assert resp.text.endswith("data: [DONE]\n\n")
+
+
+@respx.mock
+def test_batch_api(monkeypatch, tmp_path):
+    from app.batches import BatchRunner, FileStore
+
+    files = FileStore(str(tmp_path))
+    monkeypatch.setattr(main, "batch_files", files)
+    monkeypatch.setattr(main, "batch_runner", BatchRunner(str(tmp_path), files, main._execute_batch_request, workers=2))
+
+    def answer(request):
+        prompt = json.loads(request.content)["message"]
+        if "fail" in prompt:
+            return Response(400, json={"message": "rejected"})
+        return Response(200, json={"message": f"echo {prompt.split()[1]}", "usage": {"total_tokens": 3}})
+
+    route = respx.post(f"{MOCK_BASE}query").mock(side_effect=answer)
+    lines = [
+        {"custom_id": f"req-{i}", "method": "POST", "url": "/v1/chat/completions",
+         "body": {"model": "gpt-4o", "temperature": 1, "messages": [{"role": "user", "content": "fail" if i == 2 else f"q{i}"}]}}
+        for i in range(4)
+    ]
+    upload = "\n".join(json.dumps(line) for line in lines).encode("utf-8")
+
+    with TestClient(app) as c:
+        resp = c.post("/v1/files", data={"purpose": "batch"}, files={"file": ("input.jsonl", upload, "application/jsonl")})
+        assert resp.status_code == 200
+        file = resp.json()
+        assert file["object"] == "file" and file["bytes"] == len(upload)
+
+        bad = c.post("/v1/files", data={"purpose": "batch"}, files={"file": ("bad.jsonl", b'{"custom_id": 1}', "application/jsonl")})
+        assert bad.status_code == 400
+
+        resp = c.post("/v1/batches", json={"input_file_id": file["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h"})
+        assert resp.status_code == 200
+        batch_id = resp.json()["id"]
+        assert c.post("/v1/batches", json={"input_file_id": "file-missing", "endpoint": "/v1/chat/completions"}).status_code == 400
+
+        for _ in range(200):
+            batch = c.get(f"/v1/batches/{batch_id}").json()
+            if batch["status"] == "completed":
+                break
+            time.sleep(0.01)
+        assert batch["request_counts"] == {"total": 4, "completed": 3, "failed": 1}
+        assert route.call_count == 4
+        assert c.get("/v1/batches").json()["data"][0]["id"] == batch_id
+
+        output = [json.loads(line) for line in c.get(f"/v1/files/{batch['output_file_id']}/content").text.splitlines()]
+        by_id = {r["custom_id"]: r["response"] for r in output}
+        assert by_id["req-0"]["body"]["choices"][0]["message"]["content"] == "echo q0"
+        assert by_id["req-0"]["body"]["usage"] == {"total_tokens": 3}
+        errors = c.get(f"/v1/files/{batch['error_file_id']}/content").text.splitlines()
+        assert json.loads(errors[0])["response"]["status_code"] == 502
+
+        assert c.delete(f"/v1/files/{file['id']}").json()["deleted"] is True
+        assert c.get(f"/v1/files/{file['id']}").status_code == 404
+        assert c.get("/healthz").json()["batches"]["requests_completed"] == 3
+
+
+def test_batch_api_disabled():
+    assert client.get("/v1/batches").status_code == 404
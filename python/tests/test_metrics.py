@@ -0,0 +1,57 @@
+from app.fastjson import dumps, loads
+from app.metrics import Counter, Histogram, Registry, merge_snapshots, render_metrics
+
+
+def test_counter_and_histogram_exposition():
+    registry = Registry()
+    requests = registry.counter("reqs_total", "Requests", ("route", "status"))
+    latency = registry.histogram("lat_seconds", "Latency", ("route",), buckets=(0.1, 1.0))
+
+    requests.inc(1.0, ("/v1/models", "200"))
+    requests.inc(2.0, ("/v1/models", "200"))
+    latency.observe(0.05, ("/v1/models",))
+    latency.observe(0.5, ("/v1/models",))
+    latency.observe(5.0, ("/v1/models",))
+
+    text = registry.render()
+    assert "# TYPE reqs_total counter" in text
+    assert 'reqs_total{route="/v1/models",status="200"} 3' in text
+    assert 'lat_seconds_bucket{route="/v1/models",le="0.1"} 1' in text
+    assert 'lat_seconds_bucket{route="/v1/models",le="1"} 2' in text
+    assert 'lat_seconds_bucket{route="/v1/models",le="+Inf"} 3' in text
+    assert 'lat_seconds_count{route="/v1/models"} 3' in text
+    assert 'lat_seconds_sum{route="/v1/models"} 5.55' in text
+
+
+def test_label_values_are_escaped_and_collectors_rendered():
+    registry = Registry()
+    c = registry.counter("odd_total", "Odd labels", ("v",))
+    c.inc(1.0, ('a"b\\c\nd',))
+
+    def collect():
+        h = Histogram("scraped", "Computed at scrape time")
+        h.observe(1.0)
+        return [h, Counter("empty_total", "No samples")]
+
+    registry.add_collector(collect)
+    text = registry.render()
+    assert 'odd_total{v="a\\"b\\\\c\\nd"} 1' in text
+    assert "scraped_count 1" in text
+    assert "# TYPE empty_total counter" in text
+
+
+def test_snapshots_from_several_workers_are_summed():
+    snapshots = []
+    for n in (1, 2):
+        registry = Registry()
+        registry.counter("reqs_total", "Requests", ("route",)).inc(n, ("/v1/models",))
+        registry.gauge("in_flight", "In flight").set(n)
+        registry.histogram("lat_seconds", "Latency", buckets=(1.0,)).observe(0.5 * n)
+        # Snapshots travel between processes as JSON
+        snapshots.append(loads(dumps(registry.snapshot())))
+
+    text = render_metrics(merge_snapshots(snapshots))
+    assert 'reqs_total{route="/v1/models"} 3' in text
+    assert "in_flight 3" in text
+    assert 'lat_seconds_bucket{le="1"} 2' in text
+    assert "lat_seconds_count 2" in text
@@ -0,0 +1,91 @@
+from app.prompt import PromptBuilder, estimate_tokens
+
+
+def _conversation(turns, size=40):
+    messages = [{"role": "system", "content": "Be brief."}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " + "q" * size})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "a" * size})
+    messages.append({"role": "user", "content": "last question"})
+    return messages
+
+
+def test_flattening_format():
+    prompt = PromptBuilder().build([
+        {"role": "system", "content": "Rules"},
+        {"role": "user", "content": [{"type": "text", "text": "Hi"}, {"type": "image_url", "image_url": {}}]},
+        {"role": "assistant", "content": "Hello"},
+        {"role": "system", "content": "More rules"},
+        {"role": "tool", "content": "result"},
+    ]).prompt
+    assert prompt == "System:\nRules\n\nMore rules\n\nUser: Hi\nAssistant: Hello\nUser: result\nAssistant:"
+
+
+def test_append_only_conversation_reuses_prefix():
+    builder = PromptBuilder()
+    messages = _conversation(50)
+    first = builder.build(messages).prompt
+    assert builder.stats()["messages_rendered"] == len(messages)
+
+    messages += [{"role": "assistant", "content": "reply"}, {"role": "user", "content": "next"}]
+    second = builder.build(messages).prompt
+    assert second == PromptBuilder().build(messages).prompt
+    assert second.startswith(first[: -len("Assistant:")])
+    stats = builder.stats()
+    assert stats["prefix_hits"] == 1
+    assert stats["messages_rendered"] == len(messages)  # only the 2 new turns the second time
+    assert stats["messages_reused"] == len(messages) - 2
+
+    # An edited earlier turn is a different conversation
+    messages[3] = {"role": "user", "content": "edited"}
+    assert "edited" in builder.build(messages).prompt
+
+
+def test_memo_is_bounded():
+    builder = PromptBuilder(memo_max_bytes=1000)
+    for i in range(20):
+        builder.build([{"role": "user", "content": f"{i}" * 300}])
+    assert builder.stats()["memo_bytes"] <= 1000
+
+
+def test_memo_entries_sharing_a_key_are_accounted_once():
+    builder = PromptBuilder(memo_max_bytes=1000)
+    # Same length, first and last message: the same memo key
+    for middle in range(10):
+        builder.build([
+            {"role": "user", "content": "first"},
+            {"role": "assistant", "content": f"{middle}" * 100},
+            {"role": "user", "content": "last"},
+        ])
+    stats = builder.stats()
+    assert stats["memo_entries"] == 1
+    assert stats["memo_bytes"] < 200
+
+
+def test_truncation_keeps_system_first_user_and_recent_turns():
+    builder = PromptBuilder()
+    messages = _conversation(100)
+    full = builder.build(messages)
+    assert full.dropped == 0
+
+    result = builder.build(messages, budget_tokens=200)
+    assert result.dropped > 0
+    assert result.tokens <= 200
+    assert result.prompt.startswith("System:\nBe brief.\n\nUser: question 0 ")
+    assert "answer 99" in result.prompt
+    assert "question 50 " not in result.prompt
+    assert result.prompt.endswith("User: last question\nAssistant:")
+    assert builder.stats()["truncated"] == 1
+
+    capped = PromptBuilder(keep_recent_turns=3).build(messages, budget_tokens=200)
+    assert "answer 99" in capped.prompt and "question 99" in capped.prompt
+    assert "answer 98" not in capped.prompt
+
+    no_first = PromptBuilder(keep_first_user=False).build(messages, budget_tokens=200)
+    assert "question 0 " not in no_first.prompt
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd") == 1
+    assert estimate_tokens("abcde") == 2
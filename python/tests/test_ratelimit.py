@@ -0,0 +1,68 @@
+from app.ratelimit import ClientRateLimiter, client_id
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_client_identity():
+    assert client_id({"x-client-id": "agent-7", "authorization": "Bearer sk-1"}, "x-client-id", "10.0.0.1") == "agent-7"
+    by_key = client_id({"authorization": "Bearer sk-1"}, "x-client-id", "10.0.0.1")
+    assert by_key.startswith("key-") and "sk-1" not in by_key
+    assert by_key == client_id({"authorization": "bearer sk-1"}, "", "10.0.0.2")
+    assert client_id({}, "x-client-id", "10.0.0.1") == "ip-10.0.0.1"
+
+
+def test_request_bucket_refills_and_reports_headers():
+    clock = FakeClock()
+    limiter = ClientRateLimiter(requests_per_second=2, burst=2, clock=clock)
+
+    assert limiter.check("a").allowed and limiter.check("a").allowed
+    denied = limiter.check("a")
+    assert (denied.allowed, denied.limit, denied.retry_after) == (False, "requests", 0.5)
+    assert dict(denied.headers) == {
+        "x-ratelimit-limit-requests": "2",
+        "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-reset-requests": "1s",
+    }
+    # Other clients have their own buckets
+    assert limiter.check("b").allowed
+    clock.now = 0.5
+    assert limiter.check("a").allowed
+    assert limiter.stats()["limited_requests"] == 1
+
+
+def test_token_bucket_allows_one_oversized_prompt_then_waits():
+    clock = FakeClock()
+    limiter = ClientRateLimiter(tokens_per_minute=600, clock=clock)
+
+    assert limiter.check("a", 1000).allowed
+    denied = limiter.check("a", 10)
+    assert (denied.allowed, denied.limit) == (False, "tokens")
+    # 400 tokens of debt plus 10 at 10 tokens/second
+    assert denied.retry_after == 41
+    assert dict(denied.headers)["x-ratelimit-reset-tokens"] == "1m40s"
+    clock.now = 41
+    assert limiter.check("a", 10).allowed
+
+
+def test_idle_clients_are_evicted_and_the_table_is_bounded():
+    clock = FakeClock()
+    limiter = ClientRateLimiter(requests_per_second=1, max_clients=3, clock=clock)
+
+    for name in ("a", "b", "c"):
+        limiter.check(name)
+    # a..c are full again after a second, so they go as new clients arrive
+    clock.now = 1.0
+    limiter.check("d")
+    assert limiter.stats()["clients"] == 1
+
+    for name in ("e", "f", "g", "h"):
+        limiter.check(name)
+    # Still refilling, but the table holds at most max_clients
+    assert limiter.stats()["clients"] == 3
+    assert limiter.stats()["evicted"] == 5
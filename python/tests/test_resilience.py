@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+from app.resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, RetryBudget, backoff_delay
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, open_seconds=30)
+    for _ in range(2):
+        breaker.record(False, breaker.before_call())
+    breaker.record(True, breaker.before_call())
+    assert breaker.state == CLOSED
+
+    for _ in range(3):
+        breaker.record(False, breaker.before_call())
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpen) as exc:
+        breaker.before_call()
+    assert 29 <= exc.value.retry_after <= 30
+    assert breaker.stats()["opens"] == 1
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_breaker_half_open_probes():
+    breaker = CircuitBreaker(failure_threshold=1, open_seconds=30, half_open_calls=1)
+    breaker.record(False, breaker.before_call())
+    breaker.opened_until = time.monotonic()  # open period over
+    assert breaker.state == HALF_OPEN
+
+    probe = breaker.before_call()
+    assert probe is True
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()  # only one probe at a time
+
+    # A failed probe reopens the circuit
+    breaker.record(False, probe)
+    assert breaker.state == OPEN
+    assert breaker.stats()["opens"] == 2
+
+    breaker.opened_until = time.monotonic()
+    probe = breaker.before_call()
+    breaker.release(probe)  # cancelled probes free their slot
+    probe = breaker.before_call()
+    breaker.record(True, probe)
+    assert breaker.state == CLOSED
+    assert breaker.before_call() is False
+
+
+def test_breaker_disabled():
+    breaker = CircuitBreaker(failure_threshold=0)
+    for _ in range(10):
+        breaker.record(False, breaker.before_call())
+    assert breaker.state == CLOSED
+
+
+def test_retry_budget_limits_retries_to_a_ratio_of_requests():
+    budget = RetryBudget(ratio=0.1, min_per_second=0.2, window=10)
+    # Floor of 2 retries per window with no traffic
+    assert budget.try_withdraw()
+    assert budget.try_withdraw()
+    assert not budget.try_withdraw()
+
+    for _ in range(50):
+        budget.record_request()
+    allowed = sum(budget.try_withdraw() for _ in range(20))
+    assert allowed == 5
+    assert budget.stats()["retries"] == 7
+    assert budget.stats()["exhausted"] == 16
+
+
+def test_backoff_delay():
+    for attempt in range(1, 6):
+        delay = backoff_delay(attempt, base=0.5, cap=4)
+        assert 0 <= delay <= min(4, 0.5 * 2 ** (attempt - 1))
+    assert backoff_delay(1, base=0.5, cap=4, retry_after=3) == 3
+    assert backoff_delay(1, base=0.5, cap=4, retry_after=30) == 4
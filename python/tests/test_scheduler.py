@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from app.scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, AdmissionController, AdmissionRejected
+
+
+def test_global_limit_queues_in_priority_order():
+    ctl = AdmissionController(max_concurrency=1)
+    order = []
+
+    async def call(name, priority, hold=0.01):
+        async with ctl.slot("m", priority):
+            order.append(name)
+            await asyncio.sleep(hold)
+
+    async def run():
+        first = asyncio.create_task(call("first", PRIORITY_BATCH))
+        await asyncio.sleep(0)
+        batch = asyncio.create_task(call("batch", PRIORITY_BATCH))
+        interactive = asyncio.create_task(call("interactive", PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+        assert ctl.stats()["queue_depth"] == 2
+        await asyncio.gather(first, batch, interactive)
+
+    asyncio.run(run())
+    assert order == ["first", "interactive", "batch"]
+    assert ctl.active == 0
+    assert ctl.stats()["queued"] == 2
+
+
+def test_model_limit_does_not_block_other_models():
+    ctl = AdmissionController(model_limits={"slow": 1})
+    started = []
+
+    async def call(model):
+        async with ctl.slot(model):
+            started.append(model)
+            await asyncio.sleep(0.02)
+
+    async def run():
+        tasks = [asyncio.create_task(call(m)) for m in ("slow", "slow", "fast")]
+        await asyncio.sleep(0.005)
+        assert started == ["slow", "fast"]
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert started == ["slow", "fast", "slow"]
+
+
+def test_full_queue_and_wait_timeout_are_rejected():
+    ctl = AdmissionController(max_concurrency=1, max_queue=1, max_wait=0.02)
+
+    async def run():
+        await ctl.acquire("m")
+        waiting = asyncio.create_task(ctl.acquire("m"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as full:
+            await ctl.acquire("m")
+        assert full.value.reason == "queue full"
+        assert full.value.retry_after >= 1
+        with pytest.raises(AdmissionRejected):
+            await waiting
+        ctl.release("m")
+
+    asyncio.run(run())
+    stats = ctl.stats()
+    assert (stats["rejected_full"], stats["rejected_timeout"], stats["queue_depth"], stats["active"]) == (1, 1, 0, 0)
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    ctl = AdmissionController(max_concurrency=1)
+
+    async def run():
+        await ctl.acquire("m")
+        waiting = asyncio.create_task(ctl.acquire("m"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert ctl.stats()["queue_depth"] == 0
+        ctl.release("m")
+        assert ctl.active == 0
+
+    asyncio.run(run())
+
+
+def test_queued_calls_are_shared_fairly_between_clients():
+    ctl = AdmissionController(max_concurrency=1, weights={"ui": 2})
+    order = []
+
+    async def call(client):
+        async with ctl.slot("m", PRIORITY_BATCH, client):
+            order.append(client)
+            await asyncio.sleep(0.001)
+
+    async def run():
+        await ctl.acquire("m")
+        # A runaway client queues 6 calls before two others show up
+        tasks = [asyncio.create_task(call("agent")) for _ in range(6)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(call("ui")) for _ in range(4)]
+        tasks += [asyncio.create_task(call("cli")) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert ctl.stats()["clients_queued"] == 3
+        ctl.release("m")
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    # ui (weight 2) gets two slots per agent/cli slot; the agent's backlog runs last
+    assert order == ["ui", "agent", "ui", "cli", "ui", "agent", "ui", "cli", "agent", "agent", "agent", "agent"]
+    assert ctl.stats()["clients_queued"] == 0
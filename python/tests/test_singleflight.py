@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from app.singleflight import SingleFlight
+
+
+def test_identical_calls_share_one_result():
+    flight = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"answer": 42}
+
+    async def run():
+        return await asyncio.gather(*(flight.do("k", work) for _ in range(10)))
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(r == {"answer": 42} for r in results)
+    assert (flight.started, flight.shared, flight.in_flight()) == (1, 9, 0)
+
+
+def test_errors_fan_out_to_every_waiter():
+    flight = SingleFlight()
+
+    async def boom():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def run():
+        return await asyncio.gather(*(flight.do("k", boom) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+def test_cancelled_waiter_does_not_cancel_shared_call():
+    flight = SingleFlight()
+    release = None
+
+    async def work():
+        await release.wait()
+        return "done"
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        leaving = asyncio.create_task(flight.do("k", work))
+        staying = asyncio.create_task(flight.do("k", work))
+        await asyncio.sleep(0)
+        leaving.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leaving
+        return await staying
+
+    assert asyncio.run(run()) == "done"
+
+
+def test_last_waiter_leaving_cancels_the_call():
+    flight = SingleFlight()
+    cancelled = []
+
+    async def work():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def run():
+        waiter = asyncio.create_task(flight.do("k", work))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert cancelled == [True]
+    assert flight.in_flight() == 0
+
+
+def test_caller_arriving_after_cancel_starts_a_fresh_call():
+    flight = SingleFlight()
+    started = []
+
+    async def work():
+        started.append(1)
+        try:
+            await asyncio.sleep(10 if len(started) == 1 else 0)
+        except asyncio.CancelledError:
+            # Slow cleanup keeps the cancelled task pending for a while
+            await asyncio.sleep(0.05)
+            raise
+        return "fresh"
+
+    async def run():
+        waiter = asyncio.create_task(flight.do("k", work))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        late = await flight.do("k", work)
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return late
+
+    assert asyncio.run(run()) == "fresh"
+    assert len(started) == 2